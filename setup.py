@@ -104,8 +104,8 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['ase >=3.9',
                       'matplotlib >=1.5',
-                      'numpy >=1.11',
-                      'scipy >=0.18',
+                      'numpy >=1.17',
+                      'scipy >=1.7',
                       'tqdm >=4.8',
                       'colorama',
                       'ruamel.yaml',
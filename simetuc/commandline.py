@@ -36,6 +36,7 @@ usage = f'''{DESCRIPTION}, version {VERSION}
 Usage:
     simetuc (-h | --help)
     simetuc --version
+    simetuc migrate [<lattice_folder>]
     simetuc <config_filename> [options]
     simetuc <config_filename> -l [options]
     simetuc <config_filename> -d [options]
@@ -47,10 +48,12 @@ Usage:
     
 Commands:
     plot                              plots the results stored in saved_simulation.hdf5
+    migrate                           converts the lattice files in lattice_folder (default: latticeData) to the current format
 
 Arguments:
     config_filename                   configuration filename for the simulation
     saved_simulation.hdf5             saved file to plot
+    lattice_folder                    folder with lattice files
 
 Simulation types:
     -l, --lattice                     generate the lattice
@@ -67,6 +70,11 @@ Options:
     --average                         use average rate equations instead of microscopic
     --no-save                         don't save results
     -N, --N-samples N_SAMPLES         number of samples
+    -j, --jobs JOBS                   number of processes for the power dependence, sampling and optimization
+    --prefit                          optimize the average rate equations first and refine with the microscopic ones
+    --profile                         print the time of each phase, the ODE solver statistics and the peak memory
+    --stream FILE                     write the populations of the dynamics to FILE while solving and save the results there
+    --resume                          continue an interrupted dynamics simulation streamed to the same FILE (with --stream)
 '''
 
 def parse_args(args: Any) -> Dict:
@@ -131,16 +139,27 @@ def command_plot(args: Dict) -> None:
     
     with disable_loggers(['simetuc.settings', 'settings_parser.settings']):
         if 'dynamics' in filename:
-            sol = simulations.DynamicsSolution.load(filename)
+            sol = simulations.DynamicsSolution.load(filename, lazy=True)
         elif 'conc_dep' in filename:
-            sol = simulations.ConcentrationDependenceSolution.load(filename)
+            sol = simulations.ConcentrationDependenceSolution.load(filename, lazy=True)
         elif 'pow_dep' in filename:
-            sol = simulations.PowerDependenceSolution.load(filename)
+            sol = simulations.PowerDependenceSolution.load(filename, lazy=True)
             
     sol.log_errors()
     sol.plot()
     logger.info('Close the plot window to exit.')
     plt.show()
+    sol.close()
+
+
+def command_migrate(args: Dict) -> None:
+    '''User invoked the command migrate'''
+    logger = logging.getLogger('simetuc')
+
+    folder = args['<lattice_folder>'] or 'latticeData'
+    logger.info('Converting the lattice files in %s...', folder)
+    migrated = lattice.migrate(folder)
+    logger.info('%d lattice files converted.', len(migrated))
 
 
 def command_simulation(args: Dict) -> None:
@@ -168,6 +187,9 @@ def command_simulation(args: Dict) -> None:
     N_samples = args.get('--N-samples', None)
     N_samples = int(N_samples) if N_samples else None
     cte['N_samples'] = N_samples
+    jobs = int(args['--jobs']) if args.get('--jobs') else None
+    # file the populations of the dynamics are written to while solving
+    stream_file = None  # type: Optional[str]
 
     # solution of the simulation
     solution: Union[simulations.Solution, simulations.SolutionList, optimize.OptimSolution, None] = None
@@ -182,9 +204,12 @@ def command_simulation(args: Dict) -> None:
         sim = simulations.Simulations(cte)
         if args['--N-samples'] is not None:
             solution = sim.sample_simulation(sim.simulate_dynamics, N_samples=N_samples,
-                                             average=args['--average'])
+                                             average=args['--average'], jobs=jobs)
         else:
-            solution = sim.simulate_dynamics(average=args['--average'])
+            stream_file = args.get('--stream')
+            solution = sim.simulate_dynamics(average=args['--average'],
+                                             stream_to=stream_file,
+                                             resume=bool(args.get('--resume')))
         solution.log_errors()
 
     elif args['--steady-state']:  # simulate steady state
@@ -197,7 +222,8 @@ def command_simulation(args: Dict) -> None:
         logger.info('Simulating power dependence...')
         sim = simulations.Simulations(cte)
         power_dens_list = cte.power_dependence
-        solution = sim.simulate_power_dependence(power_dens_list, average=args['--average'])
+        solution = sim.simulate_power_dependence(power_dens_list, average=args['--average'],
+                                                 jobs=jobs)
         print('')
 
     elif args['--concentration-dependence'] and not args['--optimize']:  # simulate concentration dependence
@@ -210,7 +236,8 @@ def command_simulation(args: Dict) -> None:
             solution = sim.sample_simulation(sim.simulate_concentration_dependence,
                                              N_samples=N_samples,
                                              concentrations=conc_list, N_uc_list=N_uc_list, 
-                                             dynamics=args['--dynamics'], average=args['--average'])
+                                             dynamics=args['--dynamics'], average=args['--average'],
+                                             jobs=jobs)
         else:
             solution = sim.simulate_concentration_dependence(conc_list, N_uc_list,
                                                              dynamics=args['--dynamics'],
@@ -220,16 +247,30 @@ def command_simulation(args: Dict) -> None:
     elif args['--optimize']:  # optimize
         logger.info('Optimizing parameters...')
         if args['--concentration'] or args['--concentration-dependence']:
-            solution = optimize.optimize_concentrations(cte, average=args['--average'],
-                                                        N_samples=N_samples)
+            optimize_function = optimize.optimize_concentrations
         else:
-            solution = optimize.optimize_dynamics(cte, average=args['--average'],
-                                                  N_samples=N_samples)
+            optimize_function = optimize.optimize_dynamics
+        if args['--prefit']:
+            solution = optimize.optimize_prefit(optimize_function, cte,
+                                                N_samples=N_samples, jobs=jobs)
+        else:
+            solution = optimize_function(cte, average=args['--average'],
+                                         N_samples=N_samples, jobs=jobs)
+
+    # where the simulation spent its time
+    if args.get('--profile') and isinstance(solution, (simulations.Solution,
+                                                       simulations.SolutionList)):
+        print('Profile (total time: {:.2f}s):'.format(solution.time))
+        print(solution.profile)
 
     # save results to disk
     if solution is not None and not args['--no-save']:
         logger.info('Saving results to file.')
-        solution.save()
+        if stream_file:
+            # the populations are already in the streamed file, don't copy them
+            solution.save(stream_file)
+        else:
+            solution.save()
         solution.save_txt(cmd=' '.join(sys.argv))
 
     logger.info('Program finished!')
@@ -242,6 +283,9 @@ def command_simulation(args: Dict) -> None:
         logger.info('Close the plot window to exit.')
         plt.show()
 
+    if stream_file:
+        solution.close()
+
 
 def main(ext_args: Optional[List[str]] = None) -> None:
     '''Main entry point for the command line interface'''
@@ -251,14 +295,14 @@ def main(ext_args: Optional[List[str]] = None) -> None:
         args = parse_args(ext_args)
 
     # choose console logger level
-    if args['--verbose'] or args['plot']:
+    if args['--verbose'] or args['plot'] or args['migrate']:
         console_level = logging.INFO
     elif args['--quiet']:
         console_level = logging.ERROR
     else:
         console_level = logging.WARNING
     
-    _setup_logging(console_level, only_console=args['plot'])
+    _setup_logging(console_level, only_console=args['plot'] or args['migrate'])
     
     logger = logging.getLogger('simetuc')
     logger.info('Starting program...')
@@ -266,6 +310,8 @@ def main(ext_args: Optional[List[str]] = None) -> None:
 
     if args['plot']:
         command_plot(args)
+    elif args['migrate']:
+        command_migrate(args)
     else:        
         command_simulation(args)
         
@@ -9,11 +9,13 @@ Created on Mon Nov  9 17:52:23 2015
 import os
 import time
 import logging
+import itertools
 from typing import Dict, List, Tuple, Union
 import warnings
-from collections import Counter
 
 import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from scipy.spatial import cKDTree
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     import h5py
@@ -35,6 +37,13 @@ class LatticeError(Exception):
     '''The generated lattice is not valid'''
     pass
 
+# version of the format of the lattice files:
+# 1: interactions of each ion padded to the same length and the dense dist_array
+# 2: interactions of each ion type pair stored as CSR arrays (indptr_X, index_X and dist_X)
+LATTICE_FORMAT_VERSION = 2
+# S interact with S, S with A, A with S and A with A
+INTERACTION_LABELS = ['S_k', 'S_l', 'A_k', 'A_l']
+
 @log_exceptions_warnings(ignore_warns=SettingsExtraValueWarning)
 def _check_lattice_settings(cte: settings.Settings) -> None:
     '''Checks that the settings for the lattice are correct.'''
@@ -79,153 +88,95 @@ def _check_lattice_settings(cte: settings.Settings) -> None:
 
 
 
-def _create_lattice(spacegroup: Union[int, str], cell_par: List[float], num_uc: int,
-                    sites_pos: List[float], sites_occ: List[float]) -> ase.Atoms:
-    '''Creates the lattice with the specified parameters.
-        Returns an ase.Atoms object with all atomic positions
+def _create_unit_cell(spacegroup: Union[int, str], cell_par: List[float],
+                      sites_pos: List[float], sites_occ: List[float]) -> Tuple[ase.Atoms, np.array]:
+    '''Creates the unit cell with the specified parameters.
+        Returns an ase.Atoms object with all the sites of the unit cell
+        and an array with the occupation of each site.
     '''
-    atoms = crystal(symbols=['Y']*len(sites_pos), basis=sites_pos,
-                    spacegroup=spacegroup,
-                    cellpar=cell_par, size=(num_uc, num_uc, num_uc))
-
-    # eliminate atoms in sites with occupations less than one
-    num_sites = len(sites_occ)
-    rand_num = np.random.random_sample((len(atoms),))
-    del atoms[[at.index for at in atoms if rand_num[at.index] > sites_occ[at.index % num_sites]]]
+    unit_cell = crystal(symbols=['Y']*len(sites_pos), basis=sites_pos,
+                        spacegroup=spacegroup, cellpar=cell_par)
+    # basis site that each site of the unit cell comes from
+    site_kinds = unit_cell.get_array('spacegroup_kinds')
+    occupations = np.asarray(sites_occ, dtype=np.float64)[site_kinds]
 
-    return atoms
+    return unit_cell, occupations
 
-def _create_lattice_cif(cif_file: str, num_uc: int, ion_sites: dict) -> ase.Atoms:
-    '''Creates the lattice from a .cif file.
-        Returns an ase.Atoms object with all atomic positions
+def _create_unit_cell_cif(cif_file: str, ion_sites: dict) -> ase.Atoms:
+    '''Creates the unit cell from a .cif file.
+        Returns an ase.Atoms object with the S and A sites of the unit cell
     '''
-    atoms = ase.io.read(cif_file)
-    atoms = crystal(atoms, onduplicates='replace')
-    
-    # delete sites with ions that are not S or A
-    del atoms[[at.index for at in atoms if at.symbol not in ion_sites.values()]]
-    
-    atoms = atoms.repeat(num_uc)
-
-    return atoms
-
-def _make_spherical(atoms: ase.Atoms, radius: float) -> ase.Atoms:
-    '''Makes the lattice spherical with the given radius by deleting all atoms outside.
-       It also places the center at 0,0,0'''
-
-    # find center of the lattice
-    max_pos = np.max(atoms.get_positions(), axis=0)
-    min_pos = np.min(atoms.get_positions(), axis=0)
-    center = (max_pos - min_pos)/2 + min_pos
-
-    # delete ions outside
-    del atoms[[at.index for at in atoms if np.linalg.norm((at.position-center)) > radius]]
-    # change positions so the center is at 0,0,0
-    for atom in atoms:
-        atom.position -= center
-
-    return atoms
-
-def _impurify_lattice(atoms: ase.Atoms, S_conc: float, A_conc: float) -> np.array:
-    '''Impurifies the lattice atoms with the specified concentration of
-       sensitizers and activators (in %).
-       Returns an array with the dopant positions and another with the ion type
-    '''
-    # convert from percentage
-    S_conc = S_conc/100.0
-    A_conc = A_conc/100.0
-
-    num_atoms = len(atoms)
-    # populate the lattice with the requested concentrations of sensitizers and activators
-    ion_type = np.zeros((3*int(np.ceil(num_atoms*(S_conc+A_conc))),),
-                        dtype=np.uint32)  # preallocate 3x more
-    num_doped_atoms = 0  # number of doped ions
-
-    np.random.seed()
-
-    # for each atom in atoms (random numbers denoted by rand_num_x):
-    # if rand_num_2 <= S_conc+A_conc then we'll populate it, otherwise eliminate
-    # if rand_num_3 <= S_conc then that ion is a sensitizer, otherwise is an activator
-    del_list = []
-    for atom in atoms:
-        rand_num_2 = np.random.rand()  # doped or un doped site
-        rand_num_3 = np.random.uniform(0, A_conc+S_conc)  # sensitizer or activator
-
-        # doped site
-        if rand_num_2 < (A_conc+S_conc):
-            if rand_num_3 < S_conc:  # sensitizer
-                ion_type[num_doped_atoms] = 0
-            else:  # activator
-                ion_type[num_doped_atoms] = 1
-            num_doped_atoms += 1
-        else:
-            del_list.append(atom.index)
-    # delete un-doped positions
-    del atoms[del_list]
-
-    # eliminate extra zeros from preallocation
-    ion_type = ion_type[:num_doped_atoms]
-
-    return ion_type
+    unit_cell = ase.io.read(cif_file)
+    unit_cell = crystal(unit_cell, onduplicates='replace')
 
-def _impurify_lattice_cif(atoms: ase.Atoms, S_conc: float, A_conc: float, 
-                          ion_sites: dict) -> np.array:
-    '''Impurifies the lattice atoms with the specified concentration of
-       sensitizers and activators (in %).
-       Returns an array with the ion type
+    # delete sites with ions that are not S or A
+    symbols = np.array(unit_cell.get_chemical_symbols())
+    del unit_cell[~np.isin(symbols, list(ion_sites.values()))]
+
+    return unit_cell
+
+def _create_doped_lattice(unit_cell: ase.Atoms, num_uc: int,
+                          S_probs: np.array, A_probs: np.array, radius: float = None,
+                          rng: np.random.Generator = None) -> Tuple[ase.Atoms, np.array, np.array]:
+    '''Creates a lattice of num_uc x num_uc x num_uc unit cells and dopes it.
+       S_probs and A_probs are the probabilities of each site of the unit cell
+       of being occupied by a sensitizer or an activator.
+       Only the doped sites are created: the site positions are calculated
+       one layer of unit cells at a time and the un-doped ones are discarded.
+       If radius is given, the lattice is a sphere with that radius centered at 0,0,0.
+       The random numbers are drawn from rng (default: a new one).
+       Returns an ase.Atoms object with the doped sites, an array with the ion type (0=S, 1=A)
+       and the number of sites of the lattice of each site of the unit cell.
     '''
-    # convert from percentage
-    S_conc = S_conc/100.0
-    A_conc = A_conc/100.0
-
-    num_atoms = len(atoms)
-    # populate the lattice with the requested concentrations of sensitizers and activators
-    ion_type = np.zeros((3*int(np.ceil(num_atoms*(S_conc+A_conc))),),
-                        dtype=np.uint32)  # preallocate 3x more
-    num_doped_atoms = 0  # number of doped ions
-
-    np.random.seed()
-
-    # for each atom in atoms
-    # if the atom corresponds to S and rand_num is less than S_conc, populate
-    # same for A
-    del_list = []
-    if ion_sites['S'] == ion_sites['A']: # same site
-        for atom in atoms:
-            rand_num_doped = np.random.uniform(0, 1)
-            rand_num_S_or_A = np.random.uniform(0, A_conc+S_conc)
-            if rand_num_doped < (A_conc+S_conc):
-                if rand_num_S_or_A < S_conc: # sensitizer site
-                    ion_type[num_doped_atoms] = 0
-                    num_doped_atoms += 1
-                elif rand_num_S_or_A > S_conc: # activator site
-                    ion_type[num_doped_atoms] = 1
-                    num_doped_atoms += 1
-            else:
-                del_list.append(atom.index)
-    else: # different sites, populate independently
-        for atom in atoms:
-            rand_num_doped = np.random.uniform(0, 1)
-            if atom.symbol == ion_sites['S']:
-                if rand_num_doped < S_conc:
-                    ion_type[num_doped_atoms] = 0
-                    num_doped_atoms += 1
-                else:
-                    del_list.append(atom.index)
-            elif atom.symbol == ion_sites['A']:
-                if rand_num_doped < A_conc:
-                    ion_type[num_doped_atoms] = 1
-                    num_doped_atoms += 1
-                else:
-                    del_list.append(atom.index)
-        
-    # delete un-doped positions
-    del atoms[del_list]
+    if rng is None:
+        rng = np.random.default_rng()
 
-    # eliminate extra zeros from preallocation
-    ion_type = ion_type[:num_doped_atoms]
+    num_sites = len(unit_cell)
+    cell = np.array(unit_cell.cell)
+    scaled_positions = unit_cell.get_scaled_positions()
+    doped_probs = S_probs + A_probs
 
-    return ion_type
+    # the center of the sphere is the center of the lattice
+    center = np.zeros((3,))
+    if radius is not None:
+        site_positions = scaled_positions.dot(cell)
+        # largest and smallest displacement of the last unit cell along each axis
+        displacements = (num_uc-1)*cell
+        min_pos = np.min(site_positions, axis=0) + np.sum(np.minimum(displacements, 0), axis=0)
+        max_pos = np.max(site_positions, axis=0) + np.sum(np.maximum(displacements, 0), axis=0)
+        center = (max_pos - min_pos)/2 + min_pos
+
+    # unit cells of each layer
+    layer_cells = np.array(list(itertools.product(range(num_uc), repeat=2)))
+    layer_sites = np.tile(np.arange(num_sites), len(layer_cells))
+
+    positions = []  # type: List[np.array]
+    numbers = []  # type: List[np.array]
+    ion_types = []  # type: List[np.array]
+    num_lattice_sites = np.zeros((num_sites,), dtype=np.int64)
+    for layer in range(num_uc):
+        cells = np.column_stack((np.full(len(layer_cells), layer), layer_cells))
+        layer_positions = (cells[:, np.newaxis, :] + scaled_positions).reshape(-1, 3).dot(cell)
+        layer_positions -= center
+        sites = layer_sites
+        # only the sites inside the sphere
+        if radius is not None:
+            inside = np.linalg.norm(layer_positions, axis=1) <= radius
+            layer_positions, sites = layer_positions[inside], sites[inside]
+        num_lattice_sites += np.bincount(sites, minlength=num_sites)
+
+        # each site is a sensitizer if its random number is below its S_prob,
+        # an activator if it's between S_prob and S_prob+A_prob, and un-doped otherwise
+        rand_num = rng.random(len(sites))
+        doped = rand_num < doped_probs[sites]
+        positions.append(layer_positions[doped])
+        numbers.append(unit_cell.numbers[sites[doped]])
+        ion_types.append((rand_num[doped] >= S_probs[sites[doped]]).astype(np.uint32))
+
+    atoms = ase.Atoms(numbers=np.concatenate(numbers), positions=np.concatenate(positions),
+                      cell=num_uc*cell, pbc=radius is None)
+
+    return atoms, np.concatenate(ion_types), num_lattice_sites
 
 
 def _calculate_distances(atoms: ase.Atoms, min_im_conv: bool = True,
@@ -256,6 +207,201 @@ def _calculate_distances(atoms: ase.Atoms, min_im_conv: bool = True,
     return dist_array
 
 
+def _calculate_neighbours(atoms: ase.Atoms, d_max: float = np.inf, min_im_conv: bool = True,
+                          no_console: bool = False) -> csr_matrix:
+    '''Calculates the distances between each pair of ions closer than d_max
+       By defaul it uses the minimum image convention
+       It returns a sparse symmetric matrix 'dist_array' with the distances
+       between ions i and j in dist_array[i, j]; pairs further apart than d_max are not stored.
+       The ions are placed in a KD-tree (together with their periodic images
+       if the minimum image convention is used), so only pairs inside the cutoff are calculated.
+    '''
+    num_atoms = len(atoms)
+
+    # all ions interact with each other, a spatial index doesn't help
+    if not np.isfinite(d_max):
+        return csr_matrix(_calculate_distances(atoms, min_im_conv=min_im_conv,
+                                               no_console=no_console))
+
+    # translation vectors of the periodic images around the lattice
+    if min_im_conv and np.any(atoms.pbc):
+        images = [(-1, 0, 1) if pbc else (0,) for pbc in atoms.pbc]
+        shifts = np.array(list(itertools.product(*images))).dot(np.array(atoms.cell))
+    else:
+        shifts = np.zeros((1, 3))
+
+    positions = atoms.positions
+    tree = cKDTree(positions)
+    rows = []  # type: List[np.array]
+    cols = []  # type: List[np.array]
+    dists = []  # type: List[np.array]
+    for shift in tqdm(shifts, unit='images', total=len(shifts), desc='Calculating distances',
+                      disable=no_console):
+        pairs = tree.sparse_distance_matrix(cKDTree(positions + shift), d_max,
+                                            output_type='ndarray')
+        rows.append(pairs['i'])
+        cols.append(pairs['j'])
+        dists.append(pairs['v'])
+    rows_arr = np.concatenate(rows)
+    cols_arr = np.concatenate(cols)
+    dists_arr = np.concatenate(dists)
+
+    # no self-interaction
+    distinct = np.logical_and(rows_arr != cols_arr, dists_arr > 0)
+    rows_arr, cols_arr, dists_arr = rows_arr[distinct], cols_arr[distinct], dists_arr[distinct]
+
+    # minimum image convention: keep only the closest image of each pair
+    order = np.lexsort((dists_arr, cols_arr, rows_arr))
+    rows_arr, cols_arr, dists_arr = rows_arr[order], cols_arr[order], dists_arr[order]
+    first = np.ones_like(rows_arr, dtype=bool)
+    first[1:] = np.logical_or(np.diff(rows_arr) != 0, np.diff(cols_arr) != 0)
+
+    return csr_matrix((dists_arr[first], (rows_arr[first], cols_arr[first])),
+                      shape=(num_atoms, num_atoms), dtype=np.float64)
+
+
+def _pad_interactions(index_list: List[np.array],
+                      dist_list: List[np.array]) -> Tuple[np.array, np.array]:
+    '''Pads the interaction lists of each ion to the same length, as in the version 1 files.
+       The missing positions have an index of -1 and an infinite distance.
+    '''
+    if not index_list:
+        return (np.array(index_list, dtype=np.int64), np.array(dist_list, dtype=np.float64))
+
+    num_ions = len(index_list)
+    max_inter = max(len(row) for row in index_list)
+    index_arr = -1*np.ones((num_ions, max_inter, 1), dtype=np.int64)
+    dist_arr = np.full((num_ions, max_inter), np.inf, dtype=np.float64)
+    for num, (indices, dists) in enumerate(zip(index_list, dist_list)):
+        index_arr[num, :len(indices), 0] = np.ravel(indices)
+        dist_arr[num, :len(dists)] = dists
+
+    return (index_arr, dist_arr)
+
+
+def _interactions_to_csr(index_arr: np.array,
+                         dist_arr: np.array) -> Tuple[np.array, np.array, np.array]:
+    '''Converts the padded interaction arrays of each ion to CSR arrays:
+       the interactions of ion n are indices[indptr[n]:indptr[n+1]]
+       with distances dists[indptr[n]:indptr[n+1]]. The padding is dropped.
+    '''
+    index_arr = np.asarray(index_arr, dtype=np.int64)
+    num_ions = len(index_arr)
+    if num_ions == 0:
+        return (np.zeros((1,), dtype=np.int64), np.array([], dtype=np.int64),
+                np.array([], dtype=np.float64))
+
+    index_arr = index_arr.reshape((num_ions, -1))
+    dist_arr = np.asarray(dist_arr, dtype=np.float64).reshape(index_arr.shape)
+    valid = index_arr != -1
+    indptr = np.concatenate(([0], np.cumsum(np.count_nonzero(valid, axis=1)))).astype(np.int64)
+
+    return (indptr, index_arr[valid], dist_arr[valid])
+
+
+def _lists_to_csr(index_list: List[np.array],
+                  dist_list: List[np.array]) -> Tuple[np.array, np.array, np.array]:
+    '''Converts the interaction lists of each ion to CSR arrays as in _interactions_to_csr.'''
+    indptr = np.zeros((len(index_list) + 1, ), dtype=np.int64)
+    indptr[1:] = np.cumsum([len(indices) for indices in index_list])
+    if not indptr[-1]:
+        return (indptr, np.array([], dtype=np.int64), np.array([], dtype=np.float64))
+    indices = np.concatenate([np.ravel(indices) for indices in index_list]).astype(np.int64)
+    dists = np.concatenate([np.ravel(dists) for dists in dist_list]).astype(np.float64)
+    return (indptr, indices, dists)
+
+
+def save_lattice(full_path: str, lattice_data: Dict) -> None:
+    '''Saves the lattice data to full_path with the current format version.
+       lattice_data has the ion_type, doped_lattice, initial_population, lattice_info,
+       indices_S_i and indices_A_j, and the indptr_X, index_X and dist_X CSR interaction arrays.
+    '''
+    os.makedirs(os.path.dirname(full_path) or '.', exist_ok=True)
+    with h5py.File(full_path, mode='w') as file:
+        file.attrs['format_version'] = LATTICE_FORMAT_VERSION
+        # serialze lattice_info as text and store it as an attribute
+        file.attrs['lattice_info'] = yaml.dump(lattice_data['lattice_info'])
+
+        for label in ['ion_type', 'doped_lattice', 'initial_population',
+                      'indices_S_i', 'indices_A_j']:
+            file.create_dataset(label, data=np.asarray(lattice_data[label]), compression='gzip')
+
+        for label in INTERACTION_LABELS:
+            for name in ['indptr_', 'index_', 'dist_']:
+                file.create_dataset(name + label, data=np.asarray(lattice_data[name + label]),
+                                    compression='gzip')
+
+
+def load_lattice(full_path: str) -> Dict:
+    '''Loads the lattice data saved in full_path with any format version.
+       Returns a dictionary as described in save_lattice,
+       the interactions of the version 1 files are converted to CSR arrays.
+       Exceptions aren't handled by this function
+    '''
+    lattice_data = {}  # type: Dict
+    with h5py.File(full_path, mode='r') as file:
+        version = int(file.attrs.get('format_version', 1))
+        if version > LATTICE_FORMAT_VERSION:
+            msg = ('The format version of the lattice file {} is {}, '.format(full_path, version) +
+                   'but only versions up to {} are supported.'.format(LATTICE_FORMAT_VERSION))
+            raise LatticeError(msg)
+
+        # deserialze lattice_info
+        lattice_data['lattice_info'] = yaml.safe_load(file.attrs['lattice_info'])
+        for label in ['ion_type', 'doped_lattice', 'initial_population',
+                      'indices_S_i', 'indices_A_j']:
+            lattice_data[label] = file[label][()]
+
+        for label in INTERACTION_LABELS:
+            if version == 1:
+                index_list = [np.array(row, dtype=np.int64) for row in file['index_' + label]]
+                dist_list = list(file['dist_' + label][()])
+                interactions = _interactions_to_csr(*_pad_interactions(index_list, dist_list))
+            else:
+                interactions = tuple(file[name + label][()]
+                                     for name in ['indptr_', 'index_', 'dist_'])
+            (lattice_data['indptr_' + label], lattice_data['index_' + label],
+             lattice_data['dist_' + label]) = interactions
+
+    return lattice_data
+
+
+def migrate(folder_path: str = 'latticeData') -> List[str]:
+    '''Converts all lattice files in folder_path (and its subfolders)
+       with an old format version to the current one.
+       Returns the list of converted files.
+    '''
+    logger = logging.getLogger(__name__)
+
+    migrated = []
+    for root, _, filenames in os.walk(folder_path):
+        for filename in sorted(filenames):
+            if not filename.endswith('.hdf5'):
+                continue
+            full_path = os.path.join(root, filename)
+            try:
+                with h5py.File(full_path, mode='r') as file:
+                    if 'lattice_info' not in file.attrs:  # not a lattice
+                        continue
+                    version = int(file.attrs.get('format_version', 1))
+            except OSError:
+                logger.warning('File %s could not be read.', full_path)
+                continue
+            if version >= LATTICE_FORMAT_VERSION:
+                continue
+
+            lattice_data = load_lattice(full_path)
+            # write to a temporary file first so the lattice is never lost
+            temp_path = full_path + '.tmp'
+            save_lattice(temp_path, lattice_data)
+            os.replace(temp_path, full_path)
+            logger.info('Lattice %s converted from format version %d to %d.',
+                        full_path, version, LATTICE_FORMAT_VERSION)
+            migrated.append(full_path)
+
+    return migrated
+
+
 def create_ground_states(ion_type: np.array,
                          lattice_info: Dict) -> Tuple[np.array, np.array, np.array]:
     '''Returns two arrays with the position of the sensitizers' and activators'
@@ -300,16 +446,15 @@ def create_ground_states(ion_type: np.array,
 
 def create_interaction_matrices(ion_type: np.array, dist_array: np.array,
                                 index_S_i: np.array, index_A_j: np.array,
-                                lattice_info: dict) -> Tuple[List[np.array], List[np.array],
-                                                             List[np.array], List[np.array],
-                                                             List[np.array], List[np.array],
-                                                             List[np.array], List[np.array]]:
-    '''It returns the interaction lists distances:
+                                lattice_info: dict) -> Tuple[np.array, ...]:
+    '''It returns the interactions and distances as CSR arrays (see _interactions_to_csr):
         index_S_k = position of the GS of S ions that interact with S ions
         index_S_l = position of the GS of A ions that interact with S ions
         index_A_k = position of the GS of S ions that interact with A ions
         index_A_l = position of the GS of A ions that interact with A ions
-        The same for the dist_X_y arrays
+        The same for the indptr_X_y and dist_X_y arrays,
+        the interactions of the nth ion of each type are index_X_y[indptr_X_y[n]:indptr_X_y[n+1]].
+        dist_array can be a dense array or a sparse matrix with only the pairs that interact.
     '''
     num_atoms = lattice_info['num_total']
     num_A_states = lattice_info['activator_states']
@@ -328,11 +473,23 @@ def create_interaction_matrices(ion_type: np.array, dist_array: np.array,
     index_A_l = []  # position of the GS of A ions that interact with A ions
     dist_A_l = []
 
+    if issparse(dist_array):
+        dist_array = csr_matrix(dist_array)
+        dist_array.sort_indices()
+
     # fill the matrices of interactions
     for i in range(num_atoms):
         # find the ions that this ion interacts with
-        dist_ions = dist_array[i, :]  # distances to ions
-        ions_inter = np.nonzero(dist_ions)[0]  # indices of ions that interact (non-zero distance)
+        if issparse(dist_array):
+            row_slice = slice(dist_array.indptr[i], dist_array.indptr[i+1])
+            ions_inter = dist_array.indices[row_slice]  # indices of ions that interact
+            dist_inter = dist_array.data[row_slice]
+            ions_inter = ions_inter[dist_inter != 0]
+            dist_inter = dist_inter[dist_inter != 0]
+        else:
+            dist_ions = dist_array[i, :]  # distances to ions
+            ions_inter = np.nonzero(dist_ions)[0]  # indices of ions that interact (non-zero distance)
+            dist_inter = dist_ions[ions_inter]
 
         if ion_type[i] != 0:  # activator
             # if there are energy states, else it continues to the next ion
@@ -341,14 +498,14 @@ def create_interaction_matrices(ion_type: np.array, dist_array: np.array,
                 A_inter = ion_type[ions_inter] != 0  # indices of A ions that interact
                 if A_inter.any():
                     index_A_l.append(index_A_j[list(ions_inter[A_inter])])
-                    dist_A_l.append(dist_ions[ions_inter[A_inter]])
+                    dist_A_l.append(dist_inter[A_inter])
                 else:  # this only happens if there's only one activator ion!
                     index_A_l.append([])
                     dist_A_l.append([])
                 S_inter = np.logical_not(A_inter)  # indices of S ions that interact
                 if S_inter.any():
                     index_A_k.append(index_S_i[list(ions_inter[S_inter])])
-                    dist_A_k.append(dist_ions[ions_inter[S_inter]])
+                    dist_A_k.append(dist_inter[S_inter])
                 else:
                     index_A_k.append([])
                     dist_A_k.append([])
@@ -358,19 +515,25 @@ def create_interaction_matrices(ion_type: np.array, dist_array: np.array,
                 A_inter = ion_type[ions_inter] != 0  # indices of A ions that interact
                 if A_inter.any():
                     index_S_l.append(index_A_j[list(ions_inter[A_inter])])
-                    dist_S_l.append(dist_ions[ions_inter[A_inter]])
+                    dist_S_l.append(dist_inter[A_inter])
                 else:
                     index_S_l.append([])
                     dist_S_l.append([])
                 S_inter = np.logical_not(A_inter)  # indices of S ions that interact
                 if S_inter.any():
                     index_S_k.append(index_S_i[list(ions_inter[S_inter])])
-                    dist_S_k.append(dist_ions[ions_inter[S_inter]])
+                    dist_S_k.append(dist_inter[S_inter])
                 else:  # this only happens if there's only one sensitizer ion!
                     index_S_k.append([])
                     dist_S_k.append([])
 
-    return (index_S_k, index_S_l, index_A_k, index_A_l,
+    indptr_S_k, index_S_k, dist_S_k = _lists_to_csr(index_S_k, dist_S_k)
+    indptr_S_l, index_S_l, dist_S_l = _lists_to_csr(index_S_l, dist_S_l)
+    indptr_A_k, index_A_k, dist_A_k = _lists_to_csr(index_A_k, dist_A_k)
+    indptr_A_l, index_A_l, dist_A_l = _lists_to_csr(index_A_l, dist_A_l)
+
+    return (indptr_S_k, indptr_S_l, indptr_A_k, indptr_A_l,
+            index_S_k, index_S_l, index_A_k, index_A_l,
             dist_S_k, dist_S_l, dist_A_k, dist_A_l)
 
 
@@ -398,6 +561,7 @@ def generate(cte: settings.Settings, min_im_conv: bool = True,
     Y = concentration of S
     Z = concentration of A
     min_im_conv=True uses the miminum image convention when calculating distances
+    Only the pairs of ions closer than cte.lattice['d_max'] are stored as interacting
     full_path: will use that path to save the lattice
     no_save: don't save the data, just return it'
     '''
@@ -423,35 +587,46 @@ def generate(cte: settings.Settings, min_im_conv: bool = True,
         logger.info('Size: %.1f A.', radius)
     logger.info('Concentrations: %.2f%% Sensitizer, %.2f%% Activator.', S_conc, A_conc)
 
-    # create a lattice of the given type
-    # it would be more efficient to directly create a doped lattice,
-    # i.e.: without creating un-doped atoms first
-    # however, this is very fast anyways
-    if 'cif_file' in cte.lattice and 'ion_sites' in cte.lattice:
+    # create the doped lattice directly from the sites of the unit cell
+    # each site has a probability of being a S or A ion, the un-doped sites are never created
+    # all random numbers come from this generator, so a seed gives always the same lattice
+    rng = np.random.default_rng(cte.lattice.get('seed', None))
+    use_cif = 'cif_file' in cte.lattice and 'ion_sites' in cte.lattice
+    if use_cif:
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            atoms = _create_lattice_cif(cte.lattice['cif_file'], num_uc, cte.lattice['ion_sites'])
+            unit_cell = _create_unit_cell_cif(cte.lattice['cif_file'], cte.lattice['ion_sites'])
+        symbols = np.array(unit_cell.get_chemical_symbols())
+        is_S_site = symbols == cte.lattice['ion_sites']['S']
+        is_A_site = symbols == cte.lattice['ion_sites']['A']
+        # if S and A share a site, they are populated at the same time
+        S_probs = is_S_site*S_conc/100.0
+        A_probs = is_A_site*A_conc/100.0
     else:
-        atoms = _create_lattice(cte.lattice['spacegroup'], cte.lattice['cell_par'],
-                                num_uc, cte.lattice['sites_pos'], cte.lattice['sites_occ'])
-    num_atoms = len(atoms)
-    logger.info('Total number of atoms: %d', num_atoms)
-
-    # make nanoparticle of a given radius
+        unit_cell, occupations = _create_unit_cell(cte.lattice['spacegroup'],
+                                                   cte.lattice['cell_par'],
+                                                   cte.lattice['sites_pos'],
+                                                   cte.lattice['sites_occ'])
+        # sites with occupations less than one are doped less often
+        S_probs = occupations*S_conc/100.0
+        A_probs = occupations*A_conc/100.0
+
+    # make nanoparticle of a given radius, it has no periodic images
     if radius is not None:
-        atoms = _make_spherical(atoms, radius)
         min_im_conv = False
-
-    # modify a lattice to get the concentration of S and A ions
-    # it deletes all non-doped ions from atoms and returns an array with ions types
-    if 'cif_file' in cte.lattice and 'ion_sites' in cte.lattice:
-        # number of A and S sites before impurifying
-        count = Counter(atoms.get_chemical_symbols())
-        count_S = count[cte.lattice['ion_sites']['S']]
-        count_A = count[cte.lattice['ion_sites']['A']]
-        ion_type = _impurify_lattice_cif(atoms, S_conc, A_conc, cte.lattice['ion_sites'])
+    atoms, ion_type, num_lattice_sites = _create_doped_lattice(unit_cell, num_uc,
+                                                               S_probs, A_probs,
+                                                               radius=radius, rng=rng)
+    if use_cif:
+        # number of A and S sites
+        count_S = np.sum(num_lattice_sites[is_S_site])
+        count_A = np.sum(num_lattice_sites[is_A_site])
+        num_atoms = np.sum(num_lattice_sites)
     else:
-        ion_type = _impurify_lattice(atoms, S_conc, A_conc)
+        # average number of occupied sites
+        num_atoms = int(np.round(np.sum(num_lattice_sites*occupations)))
+    logger.info('Total number of atoms: %d', num_atoms)
+
     doped_lattice = atoms.positions
     # number of sensitizers and activators
     num_doped_atoms = len(atoms)
@@ -466,7 +641,7 @@ def generate(cte: settings.Settings, min_im_conv: bool = True,
                ' the concentrations are too small, or the number of energy states is zero!')
         raise LatticeError(msg)
         
-    if 'cif_file' in cte.lattice and 'ion_sites' in cte.lattice:
+    if use_cif:
         logger.info('Number of sensitizers (percentage): %d (%.2f%%).',
                     num_S, num_S/count_S*100)
         logger.info('Number of activators (percentage): %d (%.2f%%).',
@@ -486,8 +661,10 @@ def generate(cte: settings.Settings, min_im_conv: bool = True,
     logger.info('Calculating distances...')
     dist_time = time.time()
 
-    dist_array = _calculate_distances(atoms, min_im_conv=min_im_conv,
-                                      no_console=cte.no_console)
+    d_max = cte.lattice.get('d_max', np.inf)
+    dist_array = _calculate_neighbours(atoms, d_max=d_max, min_im_conv=min_im_conv,
+                                       no_console=cte.no_console)
+    logger.info('Number of interacting pairs: {:,}.'.format(dist_array.nnz//2))  # pylint: disable=W1202
 
     elapsed_time = time.time()-dist_time
     formatted_time = time.strftime("%Mm %Ss", time.localtime(elapsed_time))
@@ -508,7 +685,9 @@ def generate(cte: settings.Settings, min_im_conv: bool = True,
 
     indices_S_i, indices_A_j, initial_population = create_ground_states(ion_type, lattice_info)
 
-    (index_S_k, index_S_l,
+    (indptr_S_k, indptr_S_l,
+     indptr_A_k, indptr_A_l,
+     index_S_k, index_S_l,
      index_A_k, index_A_l,
      dist_S_k, dist_S_l,
      dist_A_k, dist_A_l) = create_interaction_matrices(ion_type, dist_array,
@@ -523,29 +702,18 @@ def generate(cte: settings.Settings, min_im_conv: bool = True,
             radius = cte.lattice.get('radius', None)
             full_path = make_full_path(folder_path, num_uc, S_conc, A_conc, radius=radius)
 
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        with h5py.File(full_path, mode='w') as file:
-            file.create_dataset('dist_array', data=dist_array, compression='gzip')
-            file.create_dataset('ion_type', data=ion_type, compression='gzip')
-            file.create_dataset('doped_lattice', data=doped_lattice, compression='gzip')
-            file.create_dataset('initial_population', data=initial_population, compression='gzip')
-            # serialze lattice_info as text and store it as an attribute
-            file.attrs['lattice_info'] = yaml.dump(lattice_info)
-
-            file.create_dataset('indices_S_i', data=np.array(indices_S_i), compression='gzip')
-            file.create_dataset('indices_A_j', data=np.array(indices_A_j), compression='gzip')
-
-            file.create_dataset('index_S_k', data=index_S_k, compression='gzip')
-            file.create_dataset('dist_S_k', data=dist_S_k, compression='gzip')
-
-            file.create_dataset('index_S_l', data=index_S_l, compression='gzip')
-            file.create_dataset('dist_S_l', data=dist_S_l, compression='gzip')
-
-            file.create_dataset('index_A_k', data=index_A_k, compression='gzip')
-            file.create_dataset('dist_A_k', data=dist_A_k, compression='gzip')
-
-            file.create_dataset('index_A_l', data=index_A_l, compression='gzip')
-            file.create_dataset('dist_A_l', data=dist_A_l, compression='gzip')
+        save_lattice(full_path, {'ion_type': ion_type, 'doped_lattice': doped_lattice,
+                                 'initial_population': initial_population,
+                                 'lattice_info': lattice_info,
+                                 'indices_S_i': indices_S_i, 'indices_A_j': indices_A_j,
+                                 'indptr_S_k': indptr_S_k, 'index_S_k': index_S_k,
+                                 'dist_S_k': dist_S_k,
+                                 'indptr_S_l': indptr_S_l, 'index_S_l': index_S_l,
+                                 'dist_S_l': dist_S_l,
+                                 'indptr_A_k': indptr_A_k, 'index_A_k': index_A_k,
+                                 'dist_A_k': dist_A_k,
+                                 'indptr_A_l': indptr_A_l, 'index_A_l': index_A_l,
+                                 'dist_A_l': dist_A_l})
 
     # plot lattice
     if plot_toggle:
@@ -557,10 +725,10 @@ def generate(cte: settings.Settings, min_im_conv: bool = True,
 
     return (dist_array, ion_type, doped_lattice, initial_population, lattice_info,
             indices_S_i, indices_A_j,
-            index_S_k, dist_S_k,
-            index_S_l, dist_S_l,
-            index_A_k, dist_A_k,
-            index_A_l, dist_A_l)
+            indptr_S_k, index_S_k, dist_S_k,
+            indptr_S_l, index_S_l, dist_S_l,
+            indptr_A_k, index_A_k, dist_A_k,
+            indptr_A_l, index_A_l, dist_A_l)
 
 
 #if __name__ == "__main__":
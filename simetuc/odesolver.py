@@ -11,18 +11,22 @@ Created on Thu Dec  1 14:44:51 2016
 import logging
 import warnings
 
-from typing import Callable, Tuple
+from typing import Callable, Tuple, Union, Any, Dict
 
 import numpy as np
+import numba
 
-from scipy.sparse import csr_matrix
-from scipy.integrate import ode
+from scipy.sparse import csr_matrix, csc_matrix, diags
+from scipy.sparse.linalg import spsolve, MatrixRankWarning
+from scipy.integrate import ode, BDF
 
 #from scipy.integrate import solve_ivp
 
 # nice progress bar
 from tqdm import tqdm
 
+from simetuc.util import add_solver_stats
+
 ### TODO: USE scipy.integrate.solve_ivp
 # seems to be slower than using ode
 # try this: https://ilovesymposia.com/2017/03/12/scipys-new-lowlevelcallable-is-a-game-changer/
@@ -80,6 +84,259 @@ def _jac_rate_eq_pulse(t: np.array, y: np.array, abs_matrix: np.array, decay_mat
                                                coop_ET_matrix, coop_jac_indices)
 
 
+def _jac_rate_eq_sparse(t: np.array, y: np.array, decay_matrix: csr_matrix,
+                        UC_matrix: csr_matrix, jac_indices: np.array,
+                        coop_ET_matrix: csr_matrix, coop_jac_indices: np.array) -> csc_matrix:
+    ''' Calculates the jacobian of the ODE for the relaxation as a sparse matrix
+    '''
+    y_values = y[jac_indices[:, 2]]
+    nJ_matrix = csr_matrix((y_values, (jac_indices[:, 0], jac_indices[:, 1])),
+                           shape=(UC_matrix.shape[1], UC_matrix.shape[0]), dtype=np.float64)
+    UC_J_matrix = UC_matrix.dot(nJ_matrix)
+
+    y_coop_values = y[coop_jac_indices[:, 2]]*y[coop_jac_indices[:, 3]]
+    nJ_coop_matrix = csr_matrix((y_coop_values, (coop_jac_indices[:, 0], coop_jac_indices[:, 1])),
+                                shape=(coop_ET_matrix.shape[1], coop_ET_matrix.shape[0]),
+                                dtype=np.float64)
+    UC_J_coop_matrix = coop_ET_matrix.dot(nJ_coop_matrix)
+
+    return csc_matrix(decay_matrix + UC_J_matrix + UC_J_coop_matrix)
+
+
+def _jac_rate_eq_pulse_sparse(t: np.array, y: np.array, abs_matrix: csr_matrix,
+                              decay_matrix: csr_matrix,
+                              UC_matrix: csr_matrix, jac_indices: np.array,
+                              coop_ET_matrix: csr_matrix,
+                              coop_jac_indices: np.array) -> csc_matrix:
+    ''' Calculates the jacobian of the ODE for the excitation pulse as a sparse matrix
+    '''
+    return csc_matrix(abs_matrix + _jac_rate_eq_sparse(t, y, decay_matrix, UC_matrix, jac_indices,
+                                                       coop_ET_matrix, coop_jac_indices))
+
+
+@numba.jit(nopython=True, cache=False, nogil=True)
+def _rate_eq_kernel(y: np.array, out: np.array,
+                    lin_indptr: np.array, lin_indices: np.array, lin_data: np.array,
+                    ET_indptr: np.array, ET_indices: np.array, ET_data: np.array,
+                    N_indices: np.array,
+                    coop_indptr: np.array, coop_indices: np.array, coop_data: np.array,
+                    coop_N_indices: np.array) -> None:  # pragma: no cover
+    '''Fused rhs of the ODE, written into out.
+        The linear matrix (decay plus absorption) is in csr format,
+        the ET and cooperative matrices are in csc format (one column per interaction).
+    '''
+    for row in range(out.shape[0]):
+        value = 0.0
+        for pos in range(lin_indptr[row], lin_indptr[row+1]):
+            value += lin_data[pos]*y[lin_indices[pos]]
+        out[row] = value
+    for col in range(N_indices.shape[0]):
+        prod = y[N_indices[col, 0]]*y[N_indices[col, 1]]
+        for pos in range(ET_indptr[col], ET_indptr[col+1]):
+            out[ET_indices[pos]] += ET_data[pos]*prod
+    for col in range(coop_N_indices.shape[0]):
+        prod = y[coop_N_indices[col, 0]]*y[coop_N_indices[col, 1]]*y[coop_N_indices[col, 2]]
+        for pos in range(coop_indptr[col], coop_indptr[col+1]):
+            out[coop_indices[pos]] += coop_data[pos]*prod
+
+
+@numba.jit(nopython=True, cache=False, nogil=True)
+def _jac_rate_eq_kernel(y: np.array, out: np.array, const_data: np.array,
+                        ET_slots: np.array, ET_indptr: np.array, ET_data: np.array,
+                        jac_indices: np.array,
+                        coop_slots: np.array, coop_indptr: np.array, coop_data: np.array,
+                        coop_jac_indices: np.array) -> None:  # pragma: no cover
+    '''Fills the jacobian data array out in place.
+        Each row of the jacobian indices adds the ET column of its interaction
+        times the population to the positions given by the slots
+        (in the same order as in _jac_slots_kernel).
+    '''
+    for pos in range(out.shape[0]):
+        out[pos] = const_data[pos]
+    num = 0
+    for row in range(jac_indices.shape[0]):
+        col = jac_indices[row, 0]
+        value = y[jac_indices[row, 2]]
+        for pos in range(ET_indptr[col], ET_indptr[col+1]):
+            out[ET_slots[num]] += ET_data[pos]*value
+            num += 1
+    num = 0
+    for row in range(coop_jac_indices.shape[0]):
+        col = coop_jac_indices[row, 0]
+        value = y[coop_jac_indices[row, 2]]*y[coop_jac_indices[row, 3]]
+        for pos in range(coop_indptr[col], coop_indptr[col+1]):
+            out[coop_slots[num]] += coop_data[pos]*value
+            num += 1
+
+
+@numba.jit(nopython=True, cache=False, nogil=True)
+def _jac_slot(row: int, col: int, pattern_indptr: np.array, pattern_indices: np.array,
+              num_states: int) -> int:  # pragma: no cover
+    '''Position of the element (row, col) in the jacobian data array.
+        If there's no pattern it's the flattened (C order) dense jacobian,
+        otherwise the data array of a csc matrix with sorted indices.
+    '''
+    if pattern_indptr.shape[0] == 0:
+        return row*num_states + col
+    low = pattern_indptr[col]
+    high = pattern_indptr[col+1]
+    while low < high:
+        mid = (low + high)//2
+        if pattern_indices[mid] < row:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+@numba.jit(nopython=True, cache=False, nogil=True)
+def _jac_slots_kernel(indptr: np.array, indices: np.array, jac_indices: np.array,
+                      pattern_indptr: np.array, pattern_indices: np.array,
+                      num_states: int, slots: np.array) -> None:  # pragma: no cover
+    '''Position in the jacobian data array of each contribution of the
+        ET (or cooperative) matrix in csc format to the jacobian.
+    '''
+    num = 0
+    for row in range(jac_indices.shape[0]):
+        col = jac_indices[row, 0]
+        state = jac_indices[row, 1]
+        for pos in range(indptr[col], indptr[col+1]):
+            slots[num] = _jac_slot(indices[pos], state, pattern_indptr, pattern_indices,
+                                   num_states)
+            num += 1
+
+
+def _setup_numba_kernels(abs_matrix: csr_matrix, decay_matrix: csr_matrix,
+                         UC_matrix: csr_matrix, N_indices: np.array, jac_indices: np.array,
+                         coop_ET_matrix: csr_matrix,
+                         coop_N_indices: np.array, coop_jac_indices: np.array,
+                         jacobian: str = 'dense') -> Tuple[Callable, Callable]:
+    '''Prepare the compiled rhs and jacobian of the ODE.
+        abs_matrix can be None for the relaxation.
+        Returns the functions fun(t, y) and jfun(t, y), they write into preallocated
+        buffers and return them, so the result is overwritten by the next call.
+        If jacobian is 'sparse' jfun returns a csc_matrix with a fixed sparsity pattern.
+    '''
+    num_states = decay_matrix.shape[0]
+    lin_matrix = csr_matrix(decay_matrix if abs_matrix is None else decay_matrix + abs_matrix,
+                            dtype=np.float64)
+    lin_matrix.sum_duplicates()
+    ET_matrix = csc_matrix(UC_matrix, dtype=np.float64)
+    ET_matrix.sort_indices()
+    coop_matrix = csc_matrix(coop_ET_matrix, dtype=np.float64)
+    coop_matrix.sort_indices()
+    N_indices = np.ascontiguousarray(N_indices, dtype=np.int64).reshape(-1, 2)
+    coop_N_indices = np.ascontiguousarray(coop_N_indices, dtype=np.int64).reshape(-1, 3)
+    jac_indices = np.ascontiguousarray(jac_indices, dtype=np.int64).reshape(-1, 3)
+    coop_jac_indices = np.ascontiguousarray(coop_jac_indices, dtype=np.int64).reshape(-1, 4)
+
+    def get_structure(matrix: csc_matrix, jac_ind: np.array) -> csc_matrix:
+        '''Non-zero elements of the product of matrix and the jacobian indices.'''
+        nJ_matrix = csr_matrix((np.ones((jac_ind.shape[0], ), dtype=np.float64),
+                                (jac_ind[:, 0], jac_ind[:, 1])),
+                               shape=(matrix.shape[1], num_states))
+        return abs(matrix).dot(nJ_matrix)
+
+    if jacobian == 'sparse':
+        pattern = csc_matrix(abs(lin_matrix) + get_structure(ET_matrix, jac_indices) +
+                             get_structure(coop_matrix, coop_jac_indices))
+        pattern.sort_indices()
+        pattern_indptr = pattern.indptr
+        pattern_indices = pattern.indices
+        jac_size = pattern.nnz
+    else:
+        pattern_indptr = pattern_indices = np.zeros((0, ), dtype=np.int32)
+        jac_size = num_states*num_states
+    slot_dtype = np.int32 if jac_size < np.iinfo(np.int32).max else np.int64
+
+    # positions of the linear elements and of each ET and cooperative contribution
+    lin_coo = lin_matrix.tocoo()
+    const_data = np.zeros((jac_size, ), dtype=np.float64)
+    lin_slots = [_jac_slot(row, col, pattern_indptr, pattern_indices, num_states)
+                 for row, col in zip(lin_coo.row, lin_coo.col)]
+    np.add.at(const_data, np.array(lin_slots, dtype=np.int64), lin_coo.data)
+
+    def get_slots(matrix: csc_matrix, jac_ind: np.array) -> np.array:
+        '''Slots of the contributions of matrix to the jacobian.'''
+        num_contributions = np.sum(np.diff(matrix.indptr)[jac_ind[:, 0]])
+        slots = np.zeros((num_contributions, ), dtype=slot_dtype)
+        _jac_slots_kernel(matrix.indptr, matrix.indices, jac_ind,
+                          pattern_indptr, pattern_indices, num_states, slots)
+        return slots
+    ET_slots = get_slots(ET_matrix, jac_indices)
+    coop_slots = get_slots(coop_matrix, coop_jac_indices)
+
+    rhs_buffer = np.zeros((num_states, ), dtype=np.float64)
+    jac_buffer = np.zeros((jac_size, ), dtype=np.float64)
+    if jacobian == 'sparse':
+        jac_matrix = csc_matrix((jac_buffer, pattern_indices, pattern_indptr),
+                                shape=(num_states, num_states), copy=False)
+    else:
+        jac_matrix = jac_buffer.reshape((num_states, num_states))
+
+    def fun(t: float, y: np.array) -> np.array:
+        '''Compiled rhs of the ODE'''
+        _rate_eq_kernel(y, rhs_buffer,
+                        lin_matrix.indptr, lin_matrix.indices, lin_matrix.data,
+                        ET_matrix.indptr, ET_matrix.indices, ET_matrix.data, N_indices,
+                        coop_matrix.indptr, coop_matrix.indices, coop_matrix.data,
+                        coop_N_indices)
+        return rhs_buffer
+
+    def jfun(t: float, y: np.array) -> np.array:
+        '''Compiled jacobian of the ODE'''
+        _jac_rate_eq_kernel(y, jac_buffer, const_data,
+                            ET_slots, ET_matrix.indptr, ET_matrix.data, jac_indices,
+                            coop_slots, coop_matrix.indptr, coop_matrix.data, coop_jac_indices)
+        return jac_matrix
+
+    return fun, jfun
+
+
+def _log_solver_warning(logger: logging.Logger, err: Exception) -> None:
+    '''Log the warning or error raised by the ode solver.'''
+    logger.warning(str(err))
+    logger.warning('Most likely the ode solver is taking too many steps.')
+    logger.warning('Either change your settings or increase "nsteps".')
+    logger.warning('The program will continue, but the accuracy of the ' +
+                   'results cannot be guaranteed.')
+
+
+def _get_vode_stats(ode_obj: ode) -> Dict[str, int]:
+    '''Statistics of the VODE integrator, they are cumulative over all integrate calls.'''
+    iwork = ode_obj._integrator.iwork
+    # see the description of IWORK in the DVODE documentation
+    return {'steps': iwork[10], 'rhs_calls': iwork[11], 'jac_calls': iwork[12],
+            'lu_decompositions': iwork[18],
+            'failed_steps': iwork[20] + iwork[21]}  # convergence and error test failures
+
+
+def _allocate_output(N_steps: int, num_states: int,
+                     projection: Union[np.array, csr_matrix] = None,
+                     out: Any = None) -> Tuple[np.array, Callable]:
+    '''Returns the array where the solver stores its output at each time
+        and the function that reduces the populations to that output.
+        If out is given it's used instead of a new array.
+    '''
+    if projection is None:
+        num_outputs = num_states
+        project = np.asarray  # type: Callable
+    elif projection.shape[1] != num_states:
+        msg = 'The projection must have {} columns, not {}.'
+        raise ValueError(msg.format(num_states, projection.shape[1]))
+    else:
+        num_outputs = projection.shape[0]
+
+        def project(y: np.array) -> np.array:
+            '''Projection of the populations y.'''
+            return projection.dot(np.ravel(y))
+
+    if out is None:
+        return np.zeros((N_steps, num_outputs), dtype=np.float64), project
+    if tuple(out.shape) != (N_steps, num_outputs):
+        msg = 'The output must have shape {}, not {}.'
+        raise ValueError(msg.format((N_steps, num_outputs), tuple(out.shape)))
+    return out, project
 
 
 def _solve_ode(t_arr: np.array,
@@ -87,14 +344,28 @@ def _solve_ode(t_arr: np.array,
                jfun: Callable, jargs: Tuple,
                initial_population: np.array,
                rtol: float = 1e-3, atol: float = 1e-15, nsteps: int = 1000,
-               method: str = 'bdf', quiet: bool = True) -> np.array:
+               method: str = 'bdf', quiet: bool = True, jacobian: str = 'dense',
+               projection: Union[np.array, csr_matrix] = None, out: Any = None) -> np.array:
     ''' Solve the ode for the times t_arr using rhs fun and jac jfun
         with their arguments as tuples.
+        If jacobian is 'sparse', jfun must return a sparse matrix and the system is solved
+        with a BDF integrator that uses a sparse LU decomposition.
+        If projection (a dense or sparse matrix with one row per output) is given,
+        only the product of projection and the populations is stored at each time.
+        The output is stored in out if given (an array-like object such as a SolutionWriter),
+        which is then returned.
     '''
+    if jacobian == 'sparse':
+        return _solve_ode_sparse(t_arr, fun, fargs, jfun, jargs, initial_population,
+                                 rtol=rtol, atol=atol, nsteps=nsteps, quiet=quiet,
+                                 projection=projection, out=out)
+    elif jacobian != 'dense':
+        raise ValueError('Wrong jacobian type: {}. Use "dense" or "sparse".'.format(jacobian))
+
     logger = logging.getLogger(__name__)
 
     N_steps = len(t_arr)
-    y_arr = np.zeros((N_steps, len(initial_population)), dtype=np.float64)
+    y_arr, project = _allocate_output(N_steps, len(initial_population), projection, out)
 
     # setup the ode solver with the method
     ode_obj = ode(fun, jfun)
@@ -104,7 +375,7 @@ def _solve_ode(t_arr: np.array,
     ode_obj.set_jac_params(*jargs)
 
     # initial conditions
-    y_arr[0, :] = initial_population
+    y_arr[0, :] = project(initial_population)
     step = 1
 
     # console bar enabled for INFO
@@ -123,16 +394,89 @@ def _solve_ode(t_arr: np.array,
         while ode_obj.successful() and step < N_steps:
             try:
                 # advance ode to the next time step
-                y_arr[step, :] = ode_obj.integrate(t_arr[step])
+                y_arr[step, :] = project(ode_obj.integrate(t_arr[step]))
                 step += 1
                 pbar_cmd.update(1)
             except (UserWarning, FloatingPointError) as err:  # pragma: no cover
-                logger.warning(str(err))
-                logger.warning('Most likely the ode solver is taking too many steps.')
-                logger.warning('Either change your settings or increase "nsteps".')
-                logger.warning('The program will continue, but the accuracy of the ' +
-                               'results cannot be guaranteed.')
+                _log_solver_warning(logger, err)
+        pbar_cmd.update(1)
+    add_solver_stats(_get_vode_stats(ode_obj))
+
+    return y_arr
+
+
+def _solve_ode_sparse(t_arr: np.array,
+                      fun: Callable, fargs: Tuple,
+                      jfun: Callable, jargs: Tuple,
+                      initial_population: np.array,
+                      rtol: float = 1e-3, atol: float = 1e-15, nsteps: int = 1000,
+                      quiet: bool = True, projection: Union[np.array, csr_matrix] = None,
+                      out: Any = None) -> np.array:
+    ''' Solve the ode for the times t_arr using rhs fun and the sparse jacobian jfun
+        with their arguments as tuples.
+        The jacobian is never converted to a dense array, the Newton iterations of the
+        BDF integrator use a sparse LU decomposition instead.
+        nsteps is the maximum number of internal steps between two output times, like in VODE.
+        projection and out are used like in _solve_ode.
+    '''
+    logger = logging.getLogger(__name__)
+
+    def ode_fun(t: float, y: np.array) -> np.array:
+        '''RHS with the arguments'''
+        return fun(t, y, *fargs)
+
+    def ode_jfun(t: float, y: np.array) -> csc_matrix:
+        '''Jacobian with the arguments'''
+        return jfun(t, y, *jargs)
+
+    N_steps = len(t_arr)
+    y_arr, project = _allocate_output(N_steps, len(initial_population), projection, out)
+
+    # initial conditions
+    y_arr[0, :] = project(initial_population)
+    step = 1
+    num_internal_steps = 0
+    total_steps = 0
+    solver = None
+
+    with warnings.catch_warnings(),\
+         np.errstate(invalid='raise', divide='raise', over='raise', under='ignore'),\
+         tqdm(total=N_steps, unit='step', smoothing=0.1,
+              disable=quiet, desc='ODE progress') as pbar_cmd:
+        # transform warnings into exceptions that we can catch
+        warnings.filterwarnings('error')
+        try:
+            solver = BDF(ode_fun, t_arr[0], np.array(initial_population, dtype=np.float64),
+                         t_arr[-1], rtol=rtol, atol=atol, jac=ode_jfun)
+            while step < N_steps and solver.status == 'running':
+                # BDF reads uninitialized rows of its difference array in the first steps
+                # (they are overwritten before being used), so check the result instead
+                with np.errstate(all='ignore'):
+                    message = solver.step()
+                num_internal_steps += 1
+                total_steps += 1
+                if solver.status == 'failed':  # pragma: no cover
+                    raise UserWarning(message)
+                if not np.all(np.isfinite(solver.y)):  # pragma: no cover
+                    raise FloatingPointError('Non-finite solution at t={:.3e}.'.format(solver.t))
+                # store all output times reached in this internal step
+                if solver.t >= t_arr[step]:
+                    interpolant = solver.dense_output()
+                    while step < N_steps and t_arr[step] <= solver.t:
+                        y_arr[step, :] = project(interpolant(t_arr[step]))
+                        step += 1
+                        pbar_cmd.update(1)
+                    num_internal_steps = 0
+                elif num_internal_steps > nsteps:  # pragma: no cover
+                    raise UserWarning('Excess work done: more than {} steps '.format(nsteps) +
+                                      'taken before reaching t={:.3e}.'.format(t_arr[step]))
+        except (UserWarning, FloatingPointError) as err:  # pragma: no cover
+            _log_solver_warning(logger, err)
         pbar_cmd.update(1)
+    # the BDF solver doesn't count its rejected steps
+    if solver is not None:
+        add_solver_stats({'steps': total_steps, 'rhs_calls': solver.nfev,
+                          'jac_calls': solver.njev, 'lu_decompositions': solver.nlu})
 
     return y_arr
 
@@ -181,16 +525,32 @@ def solve_pulse(t_pulse: np.array, initial_pop: np.array,
                 coop_ET_matrix: csr_matrix,
                 coop_N_indices: np.array, coop_jac_indices: np.array,
                 nsteps: int = 1000, rtol: float = 1e-3, atol: float = 1e-15,
-                quiet: bool = False, method: str = 'bdf') -> np.array:
-    '''Solve the response to an excitation pulse.'''
+                quiet: bool = False, method: str = 'bdf', jacobian: str = 'dense',
+                backend: str = 'scipy',
+                projection: Union[np.array, csr_matrix] = None) -> np.array:
+    '''Solve the response to an excitation pulse.
+        jacobian can be 'dense' or 'sparse'.
+        backend can be 'scipy' or 'numba' (compiled rhs and jacobian).
+        If projection is given only its product with the populations is returned.'''
+    if backend == 'numba':
+        fun, jfun = _setup_numba_kernels(abs_matrix, decay_matrix, UC_matrix, N_indices,
+                                         jac_indices, coop_ET_matrix,
+                                         coop_N_indices, coop_jac_indices, jacobian=jacobian)
+        return _solve_ode(t_pulse, fun, (), jfun, (), initial_pop, method=method,
+                          rtol=rtol, atol=atol, nsteps=nsteps, quiet=quiet, jacobian=jacobian,
+                          projection=projection)
+    elif backend != 'scipy':
+        raise ValueError('Wrong backend: {}. Use "scipy" or "numba".'.format(backend))
+    jfun = _jac_rate_eq_pulse_sparse if jacobian == 'sparse' else _jac_rate_eq_pulse
     return _solve_ode(t_pulse, _rate_eq_pulse,
                       (abs_matrix, decay_matrix, UC_matrix, N_indices,
                        coop_ET_matrix, coop_N_indices),
-                      _jac_rate_eq_pulse,
+                      jfun,
                       (abs_matrix, decay_matrix, UC_matrix, jac_indices,
                        coop_ET_matrix, coop_jac_indices),
                       initial_pop, method=method,
-                      rtol=rtol, atol=atol, nsteps=nsteps, quiet=quiet)
+                      rtol=rtol, atol=atol, nsteps=nsteps, quiet=quiet, jacobian=jacobian,
+                      projection=projection)
 
 
 def solve_relax(t_sol: np.array, initial_pop: np.array,
@@ -199,11 +559,128 @@ def solve_relax(t_sol: np.array, initial_pop: np.array,
                 coop_ET_matrix: csr_matrix,
                 coop_N_indices: np.array, coop_jac_indices: np.array,
                 nsteps: int = 1000, rtol: float = 1e-3, atol: float = 1e-15,
-                quiet: bool = False) -> np.array:
-    '''Solve the relaxation after a pulse.'''
+                quiet: bool = False, jacobian: str = 'dense',
+                backend: str = 'scipy',
+                projection: Union[np.array, csr_matrix] = None, out: Any = None) -> np.array:
+    '''Solve the relaxation after a pulse.
+        jacobian can be 'dense' or 'sparse'.
+        backend can be 'scipy' or 'numba' (compiled rhs and jacobian).
+        If projection is given only its product with the populations is returned.
+        If out is given the solution is stored there (see _solve_ode).'''
+    if backend == 'numba':
+        fun, jfun = _setup_numba_kernels(None, decay_matrix, UC_matrix, N_indices,
+                                         jac_indices, coop_ET_matrix,
+                                         coop_N_indices, coop_jac_indices, jacobian=jacobian)
+        return _solve_ode(t_sol, fun, (), jfun, (), initial_pop, rtol=rtol, atol=atol,
+                          nsteps=nsteps, quiet=quiet, jacobian=jacobian, projection=projection,
+                          out=out)
+    elif backend != 'scipy':
+        raise ValueError('Wrong backend: {}. Use "scipy" or "numba".'.format(backend))
+    jfun = _jac_rate_eq_sparse if jacobian == 'sparse' else _jac_rate_eq
     return _solve_ode(t_sol, _rate_eq,
                       (decay_matrix, UC_matrix, N_indices, coop_ET_matrix, coop_N_indices),
-                      _jac_rate_eq,
+                      jfun,
                       (decay_matrix, UC_matrix, jac_indices, coop_ET_matrix, coop_jac_indices),
                       initial_pop, rtol=rtol, atol=atol,
-                      nsteps=nsteps, quiet=quiet)
+                      nsteps=nsteps, quiet=quiet, jacobian=jacobian, projection=projection,
+                      out=out)
+
+
+def solve_steady_state(initial_pop: np.array, ion_states: np.array,
+                       abs_matrix: csr_matrix, decay_matrix: csr_matrix,
+                       UC_matrix: csr_matrix, N_indices: np.array, jac_indices: np.array,
+                       coop_ET_matrix: csr_matrix,
+                       coop_N_indices: np.array, coop_jac_indices: np.array,
+                       tol: float = 1e-12, max_iter: int = 50,
+                       jacobian: str = 'dense', backend: str = 'scipy') -> np.array:
+    '''Find the steady state of a CW excitation with Newton's method.
+        The rate equations conserve the total population of each ion,
+        ion_states has the ion number of each state. The equation of the first state
+        of each ion is replaced by that condition so the jacobian is not singular.
+        jacobian can be 'dense' or 'sparse' (the linear systems are solved with a sparse LU).
+        Returns the populations or None if there's no convergence to a physical solution.
+    '''
+    logger = logging.getLogger(__name__)
+
+    if backend == 'numba':
+        fun, jfun = _setup_numba_kernels(abs_matrix, decay_matrix, UC_matrix, N_indices,
+                                         jac_indices, coop_ET_matrix,
+                                         coop_N_indices, coop_jac_indices, jacobian=jacobian)
+    elif backend == 'scipy':
+        def fun(t: float, y: np.array) -> np.array:
+            '''RHS with the arguments'''
+            return _rate_eq_pulse(t, y, abs_matrix, decay_matrix, UC_matrix, N_indices,
+                                  coop_ET_matrix, coop_N_indices)
+        jac_rate_eq = _jac_rate_eq_pulse_sparse if jacobian == 'sparse' else _jac_rate_eq_pulse
+        def jfun(t: float, y: np.array) -> np.array:
+            '''Jacobian with the arguments'''
+            return jac_rate_eq(t, y, abs_matrix, decay_matrix, UC_matrix,
+                               jac_indices, coop_ET_matrix, coop_jac_indices)
+    else:
+        raise ValueError('Wrong backend: {}. Use "scipy" or "numba".'.format(backend))
+
+    num_states = len(initial_pop)
+    ion_states = np.asarray(ion_states, dtype=np.int64)
+    _, first_states = np.unique(ion_states, return_index=True)
+    keep_rows = np.ones((num_states, ), dtype=np.float64)
+    keep_rows[first_states] = 0
+    # sum of the populations of each ion, in the row of its first state
+    conservation_matrix = csr_matrix((np.ones((num_states, ), dtype=np.float64),
+                                      (first_states[ion_states], np.arange(num_states))),
+                                     shape=(num_states, num_states))
+    y = np.array(initial_pop, dtype=np.float64)
+    total_pop = conservation_matrix.dot(y)
+
+    def get_residual(y: np.array) -> np.array:
+        '''Rate equations with the population conservation conditions'''
+        return keep_rows*fun(0, y) + conservation_matrix.dot(y) - total_pop
+
+    if jacobian == 'sparse':
+        def solve_newton_step(y: np.array, residual: np.array) -> np.array:
+            '''Newton step using the jacobian of get_residual'''
+            jac = csc_matrix(diags(keep_rows).dot(jfun(0, y)) + conservation_matrix)
+            return spsolve(jac, -residual)
+    else:
+        conservation_array = conservation_matrix.toarray()
+        def solve_newton_step(y: np.array, residual: np.array) -> np.array:
+            '''Newton step using the jacobian of get_residual'''
+            jac = keep_rows[:, np.newaxis]*jfun(0, y) + conservation_array
+            return np.linalg.solve(jac, -residual)
+
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        # singular matrices are a failure of the method, not an error
+        warnings.simplefilter('ignore', MatrixRankWarning)
+        residual = get_residual(y)
+        initial_norm = np.linalg.norm(residual)
+        num_iter = -1  # no iterations if max_iter is 0
+        for num_iter in range(max_iter):
+            try:
+                delta_y = solve_newton_step(y, residual)
+            except np.linalg.LinAlgError:
+                break
+            if not np.all(np.isfinite(delta_y)):
+                break
+            # keep the populations positive and
+            # backtrack if the step doesn't reduce the residual
+            step = 1.0
+            new_y = np.maximum(y + delta_y, 0)
+            new_residual = get_residual(new_y)
+            while (not np.linalg.norm(new_residual) < np.linalg.norm(residual) and
+                   step > 1e-3):
+                step /= 2
+                new_y = np.maximum(y + step*delta_y, 0)
+                new_residual = get_residual(new_y)
+            change = np.max(np.abs(new_y - y))
+            y = new_y
+            residual = new_residual
+            if change < tol:
+                add_solver_stats({'newton_iterations': num_iter+1})
+                # with the populations clipped at zero it can stop outside of a solution
+                if np.linalg.norm(residual) > np.sqrt(tol)*initial_norm:
+                    logger.debug('Newton method stopped outside of a physical solution.')
+                    return None
+                logger.debug('Newton method converged in %d iterations.', num_iter+1)
+                return y
+    logger.debug('Newton method did not converge after %d iterations.', num_iter+1)
+    add_solver_stats({'newton_iterations': num_iter+1})
+    return None
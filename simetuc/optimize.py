@@ -7,10 +7,23 @@ Created on Tue Oct 11 15:58:58 2016
 
 import logging
 import datetime
-from typing import Tuple, Callable, List
+from typing import Tuple, Callable, List, Dict, Iterator, Any
 import functools
+import multiprocessing
+from contextlib import contextmanager
+import hashlib
+import enum
+import os
+import warnings
+import copy
 
 import numpy as np
+from scipy import interpolate
+from scipy.optimize import OptimizeResult
+from scipy.spatial.distance import cdist
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    import h5py
 # pylint: disable=E1101
 # pylint: disable=W0613
 import tqdm
@@ -19,16 +32,19 @@ from lmfit.minimizer import MinimizerResult
 
 import simetuc.simulations as simulations
 import simetuc.settings as settings
-from simetuc.util import disable_loggers, disable_console_handler, EneryTransferProcess
-from simetuc.util import save_file_full_name
+from simetuc.util import disable_loggers, disable_console_handler, EneryTransferProcess, ConfigWarning
+from simetuc.util import save_file_full_name, Excitation
 
 class OptimSolution():
     def __init__(self, result: MinimizerResult, cte: settings.Settings, optim_progress: List[str],
-                 total_time: float) -> None:
+                 total_time: float, cache_hits: int = 0, cache_misses: int = 0) -> None:
         self.result = result
         self.cte = cte
         self.optim_progress = optim_progress
         self.time = total_time
+        # evaluations found and not found in the cache
+        self.cache_hits = cache_hits
+        self.cache_misses = cache_misses
 
         # total time
         hours, remainder = divmod(total_time, 3600)
@@ -42,6 +58,12 @@ class OptimSolution():
         else:
             self.min_f = np.sqrt((result.residual**2).sum())
 
+    @property
+    def cache_hit_rate(self) -> float:
+        '''Fraction of the evaluations that were found in the cache.'''
+        num_evals = self.cache_hits + self.cache_misses
+        return self.cache_hits/num_evals if num_evals else 0.0
+
     def plot(self) -> None:  # pragma: no cover
         pass
 
@@ -70,20 +92,231 @@ class OptimSolution():
             csvfile.write('\r\n')
 
             csvfile.write(f'Total time: {self.formatted_time}.' + '\r\n')
+            if self.cache_hits + self.cache_misses:
+                csvfile.write(f'Cache hit rate: {100*self.cache_hit_rate:.1f}% ' +
+                              f'({self.cache_hits} of {self.cache_hits + self.cache_misses}).' + '\r\n')
             csvfile.write(f'Optimized RMS error: {self.min_f:.3e}.' + '\r\n')
             csvfile.write('Parameters name and value:' + '\r\n')
             for name, best_val in zip(self.result.params.keys(), self.best_params.T):
                 csvfile.write(f'{name}: {best_val:.3e}.' + '\r\n')
 
 
+def _to_key(obj: Any) -> Any:
+    '''Convert settings to nested lists of strings whose repr doesn't change between runs.'''
+    if isinstance(obj, dict):
+        return [(str(key), _to_key(value))
+                for key, value in sorted(obj.items(), key=lambda item: str(item[0]))]
+    elif isinstance(obj, (set, frozenset)):
+        return sorted((_to_key(value) for value in obj), key=repr)
+    elif isinstance(obj, (list, tuple)):
+        return [_to_key(value) for value in obj]
+    elif isinstance(obj, np.ndarray):
+        return _to_key(obj.tolist())
+    elif isinstance(obj, enum.Enum):
+        return str(obj)
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        # the repr of the transitions and processes rounds the values
+        return [type(obj).__name__, _to_key(vars(obj))]
+    return repr(obj)
+
+
+def _excitation_key(excitation: Excitation) -> Any:
+    '''Key of an excitation without its active flag,
+        the optimization activates the excitations it simulates.'''
+    return _to_key({attr: value for attr, value in vars(excitation).items() if attr != 'active'})
+
+
+# simulation parameters that don't change the errors
+_CACHE_IGNORED_PARAMS = ('jobs', 'lattice_cache_size', 'compression')
+
+
+class EvaluationCache():
+    '''Error vectors of the optimization saved to disk and reused in later optimizations.
+        The key is a hash of the settings that change the simulation:
+        lattice, states, decay, energy transfer, optimization processes and excitations,
+        simulation parameters and context (the objective function, average and N_samples).'''
+    def __init__(self, full_path: str, context: Tuple = ()) -> None:
+        self.full_path = full_path
+        self.context = context
+        self.hits = 0
+        self.misses = 0
+        self._errors = {}  # type: Dict[str, np.array]
+        if os.path.isfile(full_path) and h5py.is_hdf5(full_path):
+            with h5py.File(full_path, 'r') as file:
+                for key, dataset in file.items():
+                    self._errors[key] = np.array(dataset)
+
+    def __len__(self) -> int:
+        return len(self._errors)
+
+    def get_key(self, sim: simulations.Simulations) -> str:
+        '''Return the key of the current settings of sim.'''
+        cte = sim.cte
+        # the requested excitations or the active ones
+        exc_labels = cte.optimization.get('excitations', None)
+        if not exc_labels:
+            exc_labels = [label for label, exc_lst in cte.excitations.items() if exc_lst[0].active]
+        key_data = [self.context, cte.lattice, cte.states, cte.decay, cte.energy_transfer,
+                    [(process.name, process.value) for process in cte.optimization['processes']],
+                    [(label, [_excitation_key(exc) for exc in cte.excitations[label]])
+                     for label in exc_labels],
+                    {key: value for key, value in cte.get('simulation_params', {}).items()
+                     if key not in _CACHE_IGNORED_PARAMS},
+                    cte.get('concentration_dependence', None)]
+        return hashlib.sha1(repr(_to_key(key_data)).encode()).hexdigest()
+
+    def get(self, key: str) -> np.array:
+        '''Return the errors saved with key, or None.'''
+        errors = self._errors.get(key, None)
+        if errors is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return errors
+
+    def add(self, key: str, errors: np.array) -> None:
+        '''Save the errors with key.'''
+        self._errors[key] = np.array(errors)
+        os.makedirs(os.path.dirname(self.full_path) or '.', exist_ok=True)
+        with h5py.File(self.full_path, 'a') as file:
+            if key not in file:
+                file.create_dataset(key, data=self._errors[key])
+
+
+# pool of processes used to simulate several excitations or jacobian points at the same time
+# and cache of the evaluations during an optimization
+_optim_worker_state = {}  # type: Dict
+
+
+def _init_optim_worker() -> None:
+    '''The workers run the simulations serially and don't use the cache.'''
+    _optim_worker_state.clear()
+
+
+def _optim_worker(task: Tuple[Callable, simulations.Simulations, str]) -> np.array:
+    '''Simulate with only the exc_label excitation active and return the squared errors.
+        function must be a method of sim, they are sent together so it uses the worker's copy.'''
+    function, sim, exc_label = task
+    # the workers are daemonic, they can't start more processes
+    sim.cte.simulation_params['jobs'] = 1
+    sim.cte.excitations[exc_label][0].active = True
+    solution = function()
+    return solution.errors**2
+
+
+def _optim_jacobian_worker(task: Tuple[Callable, Parameters, Tuple]) -> np.array:
+    '''Return the error vector of the objective function for the params.
+        The first element of args must be the Simulations object.'''
+    function, params, args = task
+    # the workers are daemonic, they can't start more processes
+    args[0].cte.simulation_params['jobs'] = 1
+    return function(params, *args)
+
+
+def _parallel_jacobian(function: Callable, params: Parameters, args: Tuple,
+                       epsfcn: float = 1e-10, base_residual: np.array = None
+                      ) -> Tuple[np.array, List[Tuple[Parameters, np.array]]]:
+    '''Forward-difference jacobian of the objective function at params.
+        The params and the perturbation of each parameter are evaluated in the pool at the same time.
+        If base_residual is the error vector at params it's used instead of simulating them again.
+        Like leastsq, the relative step is sqrt(epsfcn) of the internal (bounded) value.
+        Returns the jacobian and the parameters and error vector of each new evaluation.'''
+    var_names = [name for name, par in params.items() if par.vary]
+    list_params = [params]
+    steps = []
+    for name in var_names:
+        par = params[name]
+        internal_value = par.setup_bounds()
+        internal_step = np.sqrt(epsfcn)*abs(internal_value) or np.sqrt(epsfcn)
+        new_params = params.copy()
+        new_params[name].value = par.from_internal(internal_value + internal_step)
+        list_params.append(new_params)
+        steps.append(new_params[name].value - par.value)
+
+    # only simulate the evaluations that aren't in the cache
+    residuals = [None]*len(list_params)  # type: List[np.array]
+    cache = _optim_worker_state.get('cache', None)
+    keys = [''] * len(list_params)
+    if cache is not None:
+        sim = args[0]
+        for num, new_params in enumerate(list_params):
+            _update_param_values(new_params, sim)
+            keys[num] = cache.get_key(sim)
+            residuals[num] = cache.get(keys[num])
+    if base_residual is not None:
+        residuals[0] = base_residual
+    missing = [num for num, resid in enumerate(residuals) if resid is None]
+
+    pool = _optim_worker_state['pool']
+    new_residuals = pool.map(_optim_jacobian_worker, [(function, list_params[num], args)
+                                                      for num in missing])
+    for num, resid in zip(missing, new_residuals):
+        residuals[num] = resid
+        if cache is not None:
+            cache.add(keys[num], resid)
+
+    # the step is zero if the parameter is at one of its bounds
+    jacobian = np.column_stack([(resid - residuals[0])/step if step else np.zeros_like(resid)
+                                for resid, step in zip(residuals[1:], steps)])
+    evaluations = list(zip(list_params, residuals))
+    return jacobian, evaluations if base_residual is None else evaluations[1:]
+
+
+@contextmanager
+def _optim_worker_pool(processes: int) -> Iterator[None]:
+    '''Start the pool of processes used by optim_fun and the jacobian if there's more than one.
+        The same processes are used during the whole optimization,
+        so the lattice and matrices they cache are reused in every iteration.'''
+    if processes <= 1:
+        yield
+        return
+    with multiprocessing.Pool(processes=processes, initializer=_init_optim_worker) as pool:
+        _optim_worker_state['pool'] = pool
+        try:
+            yield
+        finally:
+            del _optim_worker_state['pool']
+
+
+@contextmanager
+def _optim_evaluation_cache(cache: EvaluationCache) -> Iterator[None]:
+    '''Use the cache in optim_fun and the jacobian if it isn't None.'''
+    if cache is None:
+        yield
+        return
+    _optim_worker_state['cache'] = cache
+    try:
+        yield
+    finally:
+        del _optim_worker_state['cache']
+
+
+def _update_param_values(params: Parameters, sim: simulations.Simulations) -> None:
+    '''Update the values of the optimization processes.'''
+    for num, new_value in enumerate(params.valuesdict().values()):
+        sim.cte.optimization['processes'][num].value = new_value
+
+
 def optim_fun(function: Callable, params: Parameters, sim: simulations.Simulations) -> np.array:
     '''Update parameter values, simulate dynamics and return total error.
     function should be something like sim.simulate_dynamics or sim.simulate_concentration_dependence
-    with no parameters, and it must return an object with an errors attribute.'''
+    with no parameters, and it must return an object with an errors attribute.
+    If there's a cache of evaluations, the errors are only simulated if they aren't in it.'''
     # update optimization parameter values
-    for num, new_value in enumerate(params.valuesdict().values()):
-        sim.cte.optimization['processes'][num].value = new_value
-
+    _update_param_values(params, sim)
+
+    cache = _optim_worker_state.get('cache', None)
+    if cache is None:
+        return _simulate_errors(function, sim)
+    key = cache.get_key(sim)
+    errors = cache.get(key)
+    if errors is None:
+        errors = _simulate_errors(function, sim)
+        cache.add(key, errors)
+    return errors
+
+def _simulate_errors(function: Callable, sim: simulations.Simulations) -> np.array:
+    '''Simulate the active or optimization excitations and return the total error.'''
     # if the user didn't select several excitations to optimize, use the active one
     # otherwise, go through all requested exitations and calculate errors
     if not sim.cte.optimization.get('excitations', False):
@@ -97,6 +330,13 @@ def optim_fun(function: Callable, params: Parameters, sim: simulations.Simulatio
 
         total_errors = np.zeros((sim.cte.states['activator_states'] +
                                  sim.cte.states['sensitizer_states'],), dtype=np.float64)
+        # simulate the excitations at the same time if there's a pool of workers
+        pool = _optim_worker_state.get('pool', None)
+        if pool is not None:
+            tasks = [(function, sim, exc_label) for exc_label in sim.cte.optimization['excitations']]
+            for squared_errors in pool.map(_optim_worker, tasks):
+                total_errors += squared_errors
+            return np.sqrt(total_errors)
         # then, go through all required excitations, calculate errors and add all of them
         for exc_label in sim.cte.optimization['excitations']:
             # switch on one excitation, solve and switch off again
@@ -133,6 +373,101 @@ def optim_fun_dynamics_conc(params: Parameters, sim: simulations.Simulations,
     return optim_fun(function, params, sim)
 
 
+def _latin_hypercube(num_points: int, dim: int, rng: np.random.Generator) -> np.array:
+    '''Return num_points in the unit hypercube, one in each of num_points slices of every dimension.'''
+    slices = np.array([rng.permutation(num_points) for _ in range(dim)]).T
+    return (slices + rng.random((num_points, dim)))/num_points
+
+
+def _surrogate_minimize(fun: Callable, x0: np.array, args: Tuple = (), params: Parameters = None,
+                        max_evals: int = None, seed: int = None, **options: Any) -> OptimizeResult:
+    '''Minimize fun with a radial basis function surrogate of all evaluated points.
+        Only the most promising candidate of the surrogate is evaluated in each iteration:
+        it balances a low predicted error and the distance to the evaluated points
+        (stochastic response surface method).
+        It's used as a custom scipy minimize method, so fun takes lmfit's internal values.
+        The search is done in the unit cube between the bounds of params,
+        in log scale for the ET parameters. By default max_evals is 10*(N_params+1).'''
+    rng = np.random.default_rng(seed)
+    pars = [copy.deepcopy(par) for par in params.values() if par.vary]
+    dim = len(pars)
+    if not all(np.isfinite([par.min for par in pars] + [par.max for par in pars])):
+        raise ValueError('The surrogate method needs finite bounds for all parameters.')
+    max_evals = max_evals or 10*(dim+1)
+    log_scale = np.array([par.min > 0 and par.max/par.min > 100 for par in pars])
+    low = np.array([np.log10(par.min) if log else par.min for par, log in zip(pars, log_scale)])
+    high = np.array([np.log10(par.max) if log else par.max for par, log in zip(pars, log_scale)])
+
+    def to_external(unit_point: np.array) -> np.array:
+        values = low + np.clip(unit_point, 0, 1)*(high - low)
+        return np.where(log_scale, 10**values, values)
+
+    def to_internal(unit_point: np.array) -> np.array:
+        internal = np.empty((dim,))
+        for num, (par, value) in enumerate(zip(pars, to_external(unit_point))):
+            par.value = value
+            internal[num] = par.setup_bounds()
+        return internal
+
+    points = []  # type: List[np.array]
+    values = []  # type: List[float]
+    def evaluate(unit_point: np.array) -> float:
+        points.append(unit_point)
+        values.append(float(fun(to_internal(unit_point), *args)))
+        return values[-1]
+
+    # initial point and space-filling design
+    values_x0 = np.array([par.value for par in params.values() if par.vary])
+    if np.any(log_scale):
+        values_x0[log_scale] = np.log10(values_x0[log_scale])
+    evaluate(np.clip((values_x0 - low)/(high - low), 0, 1))
+    for point in _latin_hypercube(min(2*(dim+1), max_evals) - 1, dim, rng):
+        evaluate(point)
+
+    # weight of the predicted value vs the distance, cycled to alternate local and global search
+    weights = [0.3, 0.5, 0.8, 0.95]
+    num_candidates = 100*dim
+    sigma, sigma_min = 0.2, 1e-3
+    successes = failures = num_iter = 0
+    while len(values) < max_evals and sigma > sigma_min:
+        best = int(np.argmin(values))
+        # fit the log of the error, it changes by orders of magnitude
+        log_values = np.log10(np.maximum(values, 1e-300))
+        surrogate = interpolate.RBFInterpolator(np.array(points), log_values,
+                                                kernel='thin_plate_spline', smoothing=1e-10)
+        # perturbations of the best point and uniform points
+        candidates = np.vstack([points[best] + sigma*rng.standard_normal((num_candidates, dim)),
+                                rng.random((num_candidates, dim))]).clip(0, 1)
+        distances = cdist(candidates, np.array(points)).min(axis=1)
+        candidates, distances = candidates[distances > 1e-6], distances[distances > 1e-6]
+        if not len(candidates):  # pragma: no cover
+            break
+        predicted = surrogate(candidates)
+
+        def scale(values: np.array) -> np.array:
+            span = np.ptp(values)
+            return (values - np.min(values))/span if span > 0 else np.zeros_like(values)
+        weight = weights[num_iter % len(weights)]
+        score = weight*scale(predicted) + (1 - weight)*(1 - scale(distances))
+        new_value = evaluate(candidates[np.argmin(score)])
+        num_iter += 1
+
+        # expand the local search after several improvements and shrink it after failures
+        if new_value < values[best] - 1e-3*abs(values[best]):
+            successes, failures = successes + 1, 0
+        else:
+            successes, failures = 0, failures + 1
+        if successes >= 3:
+            sigma, successes = min(2*sigma, 0.5), 0
+        elif failures >= max(4, dim):
+            sigma, failures = sigma/2, 0
+
+    best = int(np.argmin(values))
+    return OptimizeResult(x=to_internal(points[best]), fun=values[best], nfev=len(values),
+                          nit=num_iter, success=True,
+                          message='Surrogate optimization finished after {} evaluations.'.format(len(values)))
+
+
 def setup_optim(cte: settings.Settings) -> Tuple[str, Parameters, dict]:
     '''Returns the method, process_list and options for the optimization'''
     logger = logging.getLogger(__name__)
@@ -143,7 +478,7 @@ def setup_optim(cte: settings.Settings) -> Tuple[str, Parameters, dict]:
     method = cte.get('optimization', {}).get('method', 'leastsq').lower().replace('-', '')
     if method not in (list(minimizer.SCALAR_METHODS.keys()) +
                       list(minimizer.SCALAR_METHODS.values()) +
-                      ['leastsq', 'least_squares', 'brute']):
+                      ['leastsq', 'least_squares', 'brute', 'surrogate']):
         raise ValueError('Wrong optimization method ({})!'.format(method))
     logger.info('Optimization method: %s.', method)
 
@@ -175,16 +510,24 @@ def setup_optim(cte: settings.Settings) -> Tuple[str, Parameters, dict]:
     options_dict = {}  # type: dict
     if 'brute' in method:
         options_dict['Ns'] = cte.optimization['options'].get('N_points', 10)
+    if method == 'surrogate':
+        options_dict['max_evals'] = cte.optimization['options'].get('max_evals', None)
+        options_dict['seed'] = cte.get('simulation_params', {}).get('seed', None)
+    elif 'max_evals' in cte.optimization['options']:
+        options_dict['max_nfev'] = cte.optimization['options']['max_evals']
 
     return method, params, options_dict
 
 
 def optimize(function: Callable, cte: settings.Settings, average: bool = False,
              material_text: str = '', N_samples: int = None,
-             full_path: str = None) -> OptimSolution:
+             full_path: str = None, jobs: int = None) -> OptimSolution:
     ''' Minimize the error between experimental data and simulation for the settings in cte
         average = True -> optimize average rate equations instead of microscopic ones.
         function returns the error vector and accepts: parameters, sim, and average.
+        jobs is the number of processes used to simulate the optimization excitations,
+        and all the points of the jacobian at once with leastsq,
+        by default simulation_params['jobs'] or 1.
     '''
     logger = logging.getLogger(__name__)
 
@@ -216,18 +559,73 @@ def optimize(function: Callable, cte: settings.Settings, average: bool = False,
 
     method, parameters, options_dict = setup_optim(cte)
 
+    if jobs is None:
+        jobs = cte.simulation_params.get('jobs', 1)
+    num_excitations = len(cte.optimization.get('excitations', None) or [])
+    if method == 'leastsq':
+        # one perturbation per parameter, the params are already evaluated
+        processes = min(jobs, max(len(parameters), num_excitations))
+    else:
+        processes = min(jobs, num_excitations)
+    if processes > 1:
+        logger.info('Using %d processes.', processes)
+
+    last_evaluation = {}  # type: Dict
+
+    def objective_fun(params: Parameters, sim: simulations.Simulations,
+                      average: bool = False, N_samples: int = None) -> np.array:
+        ''' Return the error vector and keep it for the jacobian at the same params.'''
+        resid = function(params, sim, average, N_samples)
+        last_evaluation['values'] = list(params.valuesdict().values())
+        last_evaluation['resid'] = resid
+        return resid
+
+    def jacobian_fun(params: Parameters, sim: simulations.Simulations,
+                     average: bool = False, N_samples: int = None) -> np.array:
+        ''' Calculate the jacobian in the pool of processes.
+            leastsq always evaluates the params before their jacobian, so that error vector is reused.
+            Every new evaluation is counted and shown in the progress like the rest.
+        '''
+        base_residual = None
+        if last_evaluation.get('values', None) == list(params.valuesdict().values()):
+            base_residual = last_evaluation['resid']
+        jacobian, evaluations = _parallel_jacobian(function, params, (sim, average, N_samples),
+                                                   base_residual=base_residual)
+        for eval_params, resid in evaluations:
+            minimizer.result.nfev += 1
+            callback_fun(eval_params, minimizer.result.nfev, resid, sim, average, N_samples)
+        return jacobian
+
+    objective = function
+    if method == 'leastsq' and processes > 1:
+        options_dict['Dfun'] = jacobian_fun
+        objective = objective_fun
+
+    cache = None
+    if cte.optimization['options'].get('cache', False):
+        cache = EvaluationCache(save_file_full_name(cte.lattice, 'optim_cache') + '.hdf5',
+                                context=(getattr(function, '__name__', ''), average, N_samples))
+        logger.info('Using %d cached evaluations from %s.', len(cache), cache.full_path)
+
     optim_progbar = tqdm.tqdm(desc='Optimizing', unit='points', disable=cte['no_console'])
     param_names = ', '.join(name for name in parameters.keys())
     header = 'Iter num\tTime\t\tRMSD\t\tParameters ({})'.format(param_names)
     optim_progress.append(header)
     tqdm.tqdm.write(header)
-    minimizer = Minimizer(function, parameters, fcn_args=(sim, average, N_samples),
+    minimizer = Minimizer(objective, parameters, fcn_args=(sim, average, N_samples),
                           iter_cb=callback_fun)
     # minimize logging only warnings or worse to console.
     with disable_loggers(['simetuc.simulations', 'simetuc.precalculate', 'simetuc.lattice',
                           'simetuc.simulations.conc_dep']):
-        with disable_console_handler(__name__):
-            result = minimizer.minimize(method=method, **options_dict)
+        with disable_console_handler(__name__), _optim_evaluation_cache(cache), \
+                _optim_worker_pool(processes):
+            if method == 'surrogate':
+                surrogate_method = functools.partial(_surrogate_minimize, params=parameters,
+                                                     **options_dict)
+                result = minimizer.scalar_minimize(method=surrogate_method)
+                result.method = method
+            else:
+                result = minimizer.minimize(method=method, **options_dict)
 
     optim_progbar.update(1)
     optim_progbar.close()
@@ -253,28 +651,90 @@ def optimize(function: Callable, cte: settings.Settings, average: bool = False,
     for name, best_val in zip(parameters.keys(), best_x.T):
         logger.info('%s: %.3e.', name, best_val)
 
-    optim_solution = OptimSolution(result, cte, optim_progress, total_time.total_seconds())
+    if cache is not None:
+        logger.info('Cache hit rate: %.1f%% (%d of %d evaluations).',
+                    100*cache.hits/max(cache.hits + cache.misses, 1),
+                    cache.hits, cache.hits + cache.misses)
+
+    optim_solution = OptimSolution(result, cte, optim_progress, total_time.total_seconds(),
+                                   cache_hits=cache.hits if cache else 0,
+                                   cache_misses=cache.misses if cache else 0)
 
     return optim_solution
 
 def optimize_dynamics(cte: settings.Settings,
                       average: bool = False, full_path: str = None,
-                      N_samples: int = None) -> OptimSolution:
+                      N_samples: int = None, jobs: int = None) -> OptimSolution:
     material = '{}: {}% {}, {}% {}.'.format(cte.lattice['name'],
                                             cte.lattice['S_conc'], cte.states['sensitizer_ion_label'],
                                             cte.lattice['A_conc'], cte.states['activator_ion_label'])
     return optimize(optim_fun_dynamics, cte, average=average, material_text=material,
-                    N_samples=N_samples, full_path=full_path)
+                    N_samples=N_samples, full_path=full_path, jobs=jobs)
 
 def optimize_concentrations(cte: settings.Settings,
                             average: bool = False, full_path: str = None,
-                            N_samples: int = None) -> OptimSolution:
+                            N_samples: int = None, jobs: int = None) -> OptimSolution:
     materials = ['{}% {}, {}% {}.'.format(S_conc, cte.states['sensitizer_ion_label'],
                                           A_conc, cte.states['activator_ion_label'])
                 for (S_conc, A_conc) in cte.concentration_dependence['concentrations']]
     materials_text = '{}: '.format(cte.lattice['name']) + '; '.join(materials)
     return optimize(optim_fun_dynamics_conc, cte, average=average, material_text=materials_text,
-                    N_samples=N_samples, full_path=full_path)
+                    N_samples=N_samples, full_path=full_path, jobs=jobs)
+
+def optimize_prefit(optimize_function: Callable, cte: settings.Settings,
+                    full_path: str = None, N_samples: int = None, jobs: int = None) -> OptimSolution:
+    ''' Optimize the average rate equations first and use their best parameters
+        as the starting point of the microscopic optimization,
+        with bounds narrowed to prefit_factor (default 10) times around them.
+        If max_evals isn't given, the microscopic optimization stops after 5*(N_params+1) evaluations.
+        optimize_function is optimize_dynamics or optimize_concentrations.
+        The solution has the progress and total time of both optimizations.
+        If an optimized process has a separate strength_avg the average and microscopic
+        strengths are different quantities, so the pre-fit is skipped with a warning.
+    '''
+    logger = logging.getLogger(__name__)
+    start_time = datetime.datetime.now()
+
+    avg_procs = [process.name for process in cte.optimization['processes']
+                 if isinstance(process, EneryTransferProcess) and process.has_strength_avg]
+    if avg_procs:
+        msg = ('The processes {} have a strength_avg different from their microscopic strength, '
+               'the average pre-fit can\'t be used. '
+               'Optimizing the microscopic rate equations only.').format(', '.join(avg_procs))
+        logger.warning(msg)
+        warnings.warn(msg, ConfigWarning)
+        return optimize_function(cte, average=False, full_path=full_path,
+                                 N_samples=N_samples, jobs=jobs)
+
+    logger.info('Pre-fitting the parameters with the average rate equations...')
+    avg_solution = optimize_function(cte, average=True, full_path=full_path, jobs=jobs)
+
+    # start from the average results with narrower bounds and fewer evaluations
+    for process, value in zip(cte.optimization['processes'], avg_solution.best_params):
+        process.value = value
+    options = cte.optimization['options']
+    old_options = dict(options)
+    prefit_factor = options.get('prefit_factor', 10)
+    options['max_factor'] = prefit_factor
+    options['min_factor'] = 1/prefit_factor
+    options.setdefault('max_evals', 5*(len(cte.optimization['processes'])+1))
+    logger.info('Optimizing the microscopic rate equations...')
+    try:
+        micro_solution = optimize_function(cte, average=False, full_path=full_path,
+                                           N_samples=N_samples, jobs=jobs)
+    finally:
+        options.clear()
+        options.update(old_options)
+
+    total_time = (datetime.datetime.now() - start_time).total_seconds()
+    solution = OptimSolution(micro_solution.result, cte,
+                             avg_solution.optim_progress + micro_solution.optim_progress,
+                             total_time,
+                             cache_hits=avg_solution.cache_hits + micro_solution.cache_hits,
+                             cache_misses=avg_solution.cache_misses + micro_solution.cache_misses)
+    logger.info('Pre-fit time: %s. Microscopic optimization time: %s. Total time: %s.',
+                avg_solution.formatted_time, micro_solution.formatted_time, solution.formatted_time)
+    return solution
 
 #if __name__ == "__main__":
 #    logger = logging.getLogger()
@@ -170,6 +170,31 @@ def plot_state_decay_data(t_sol: np.ndarray, sim_data_array: np.ndarray,
     plt.xlabel('t (ms)')
 
 
+def plot_steady_state_populations(populations: np.ndarray, state_labels: List[str],
+                                  colors: Union[str, Tuple[ColorMap, ColorMap]] = 'rk',
+                                  title: str = '', atol: float = A_TOL) -> None:
+    ''' Plots the steady state population of each state as bars'''
+    populations = np.asarray(populations, dtype=np.float64)
+    if np.isnan(populations).any() or not np.any(populations > 0):
+        return
+
+    fig = plt.figure()
+    ax = fig.add_subplot(1, 1, 1)
+    fig.suptitle(title)
+
+    positions = np.arange(len(populations))
+    # non positive populations aren't shown in the log scale
+    ax.bar(positions, np.maximum(populations, atol), color=colors[0], edgecolor=colors[1])
+    ax.set_yscale('log')
+    ax.set_ylim(bottom=max(atol, 0.7*np.min(populations[populations > 0])),
+                top=1.3*np.max(populations))
+    ax.set_xticks(positions)
+    ax.set_xticklabels([label.replace('_', ' ') for label in state_labels],
+                       rotation=45, horizontalalignment='right')
+    ax.set_ylabel('Population')
+    fig.subplots_adjust(bottom=0.2)
+
+
 def plot_power_dependence(sim_data_arr: np.ndarray, power_dens_arr: np.ndarray,
                           state_labels: List[str]) -> None:
     ''' Plots the intensity as a function of power density for each state'''
@@ -17,14 +17,10 @@ import time
 import itertools
 import os
 import logging
+import copy
 import numba
-from typing import Dict, List, Tuple
-
-import warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import h5py
-import ruamel.yaml as yaml
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Iterator
 
 import numpy as np
 import scipy.sparse
@@ -33,18 +29,155 @@ from scipy.sparse import csr_matrix
 import simetuc.lattice as lattice
 from simetuc.lattice import LatticeError
 import simetuc.settings as settings
-from simetuc.util import IonType, log_exceptions_warnings
+from simetuc.util import IonType, log_exceptions_warnings, profile_phase
 
 
-def _load_lattice(filename: str) -> Dict:
-    '''Loads the filename and returns its associanted lattice_info
+class _DataCache():
+    '''Least recently used cache of dictionaries of arrays, lists of arrays or sparse matrices.
+        The oldest entries are removed when the memory used by their arrays
+        is larger than max_size (in bytes). The cached arrays are read-only.
+    '''
+    def __init__(self, max_size: float = 500e6) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self._data = OrderedDict()  # type: OrderedDict
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def keys(self) -> List[Tuple]:
+        '''Keys of all entries, from the oldest to the newest.'''
+        return list(self._data)
+
+    @staticmethod
+    def _arrays(data: Dict) -> Iterator[np.ndarray]:
+        '''All arrays in data.'''
+        for value in data.values():
+            if isinstance(value, np.ndarray):
+                yield value
+            elif isinstance(value, list) and value and isinstance(value[0], np.ndarray):
+                yield from value
+            elif scipy.sparse.isspmatrix_csr(value):
+                yield from (value.data, value.indices, value.indptr)
+
+    def get(self, key: Tuple) -> Dict:
+        '''Returns the data of key or None if it's not cached.'''
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key][0]
+
+    def add(self, key: Tuple, data: Dict) -> None:
+        '''Adds the data to the cache, removing the oldest entries if needed.'''
+        self.remove(key)
+        nbytes = sum(arr.nbytes for arr in self._arrays(data))
+        if nbytes > self.max_size:
+            return
+        for arr in self._arrays(data):
+            arr.flags.writeable = False
+        self._data[key] = (data, nbytes)
+        self.size += nbytes
+        self.resize(self.max_size)
+
+    def remove(self, key: Tuple) -> None:
+        '''Removes the entry of key, if it's cached.'''
+        if key in self._data:
+            _, nbytes = self._data.pop(key)
+            self.size -= nbytes
+
+    def resize(self, max_size: float) -> None:
+        '''Changes the maximum size and removes the oldest entries if needed.'''
+        self.max_size = max_size
+        while self.size > self.max_size and self._data:
+            _, (_, nbytes) = self._data.popitem(last=False)
+            self.size -= nbytes
+
+    def clear(self) -> None:
+        '''Removes all entries.'''
+        self._data.clear()
+        self.size = 0
+
+
+# parsed lattice files
+_lattice_cache = _DataCache()
+# energy transfer matrices of unit strength of each lattice
+_ET_topology_cache = _DataCache()
+# matrices that average the populations of each lattice
+_averaging_cache = _DataCache(100e6)
+
+
+def clear_lattice_cache() -> None:
+    '''Removes all lattices and their energy transfer matrices from the in-memory cache.'''
+    _lattice_cache.clear()
+    _ET_topology_cache.clear()
+    _averaging_cache.clear()
+
+
+def _read_lattice_data(filename: str) -> Dict:
+    '''Reads the lattice_info and all data structures of the microscopic
+        rate equations from filename.
         Exceptions aren't handled by this function
     '''
-    with h5py.File(filename, mode='r') as file:
-        # deserialze lattice_info
-        lattice_info = yaml.safe_load(file.attrs['lattice_info'])
+    # i: current S ion
+    # j: current A ion
+    # k: other S ion that interacts
+    # l: other A ion that interacts
+    file_data = lattice.load_lattice(filename)
+
+    lattice_data = {}  # type: Dict
+    lattice_data['lattice_info'] = file_data['lattice_info']
+    lattice_data['index_S_i'] = np.ravel(file_data['indices_S_i']).tolist()
+    lattice_data['index_A_j'] = np.ravel(file_data['indices_A_j']).tolist()
+
+    # S interact with S, S with A, A with S and A with A, as CSR arrays
+    for label in lattice.INTERACTION_LABELS:
+        lattice_data['indptr_' + label] = file_data['indptr_' + label]
+        lattice_data['indices_' + label] = file_data['index_' + label]
+        lattice_data['dists_' + label] = file_data['dist_' + label]
 
-    return lattice_info
+    lattice_data['initial_population'] = file_data['initial_population']
+
+    return lattice_data
+
+
+def _load_lattice_data(filename: str, cte: settings.Settings, reload: bool = False) -> Dict:
+    '''Returns the lattice data of filename, from the in-memory cache if possible.
+        The cache key are the lattice parameters and the file path, size and modification time.
+        reload=True always reads the file and replaces the cached data, use it after the
+        file is rewritten: the key may not change if the file system has coarse timestamps.
+        Exceptions aren't handled by this function
+    '''
+    file_stat = os.stat(filename)
+    key = (cte.lattice['name'], cte.lattice['N_uc'], cte.lattice.get('radius', None),
+           float(cte.lattice['S_conc']), float(cte.lattice['A_conc']),
+           os.path.abspath(filename), file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+    _lattice_cache.resize(1e6*cte.get('simulation_params', {}).get('lattice_cache_size', 500))
+    if reload:
+        # the ET matrices calculated from the previous data are also out of date
+        for topology_key in _ET_topology_cache.keys():
+            if topology_key[0] == key:
+                _ET_topology_cache.remove(topology_key)
+    lattice_data = None if reload else _lattice_cache.get(key)
+    if lattice_data is None:
+        lattice_data = _read_lattice_data(filename)
+        _lattice_cache.add(key, lattice_data)
+
+    # shallow copies so the lists of the cache are never modified
+    # and read-only views of the arrays, they are shared with the cache
+    lattice_data = {label: (list(value) if isinstance(value, list) else _read_only(value))
+                    for label, value in lattice_data.items()}
+    lattice_data['cache_key'] = key
+    return lattice_data
+
+
+def _read_only(value: object) -> object:
+    '''Returns a read-only view of value if it's an array, otherwise value.'''
+    if not isinstance(value, np.ndarray):
+        return value
+    view = value.view()
+    view.flags.writeable = False
+    return view
 
 
 #@profile
@@ -76,16 +209,13 @@ def _create_absorption_matrix(abs_sensitizer: np.array, abs_activator: np.array,
     return absorption_matrix
 
 
-def _create_total_absorption_matrix(sensitizer_states: int, activator_states: int,
-                                    num_energy_states: int,
-                                    excitations_dict: Dict, index_S_i: List[int],
-                                    index_A_j: List[int]) -> scipy.sparse.csr_matrix:
-    '''Returns the total absorption matrix'''
-
-    # list absorption matrices: a list of abs_matrix that are active
-    # (multiplied by the power density)
-    total_abs_matrix = scipy.sparse.csr_matrix((num_energy_states,
-                                                num_energy_states), dtype=np.float64)
+def _create_unit_absorption_matrices(sensitizer_states: int, activator_states: int,
+                                     excitations_dict: Dict, index_S_i: List[int],
+                                     index_A_j: List[int]) -> List[scipy.sparse.csr_matrix]:
+    '''Returns a list with the absorption matrix of each active excitation
+        for a power density of 1 W/cm2, in the same order as excitations_dict.
+    '''
+    unit_abs_matrices = []
 
     # for each excitation
     for exc_lst in excitations_dict.values():
@@ -96,7 +226,6 @@ def _create_total_absorption_matrix(sensitizer_states: int, activator_states: in
             abs_sensitizer = np.zeros((sensitizer_states, sensitizer_states), dtype=np.float64)
             abs_activator = np.zeros((activator_states, activator_states), dtype=np.float64)
 
-            power_dens = current_exc.power_dens
             pump_rate = current_exc.pump_rate
             degeneracy = current_exc.degeneracy
             init_state = current_exc.transition.state_i
@@ -109,7 +238,6 @@ def _create_total_absorption_matrix(sensitizer_states: int, activator_states: in
                     abs_sensitizer[init_state, final_state] = +degeneracy*pump_rate
                     abs_sensitizer[final_state, init_state] = +pump_rate
                     abs_sensitizer[final_state, final_state] = -degeneracy*pump_rate
-                    abs_sensitizer *= power_dens  # multiply by the power density
 
             elif ion_exc == settings.IonType.A and activator_states:
                 if init_state < activator_states and final_state < activator_states:
@@ -117,15 +245,41 @@ def _create_total_absorption_matrix(sensitizer_states: int, activator_states: in
                     abs_activator[init_state, final_state] = +degeneracy*pump_rate
                     abs_activator[final_state, init_state] = +pump_rate
                     abs_activator[final_state, final_state] = -degeneracy*pump_rate
-                    abs_activator *= power_dens  # multiply by the power density
             # create matrix with this process
-            absorption_matrix = _create_absorption_matrix(abs_sensitizer, abs_activator,
-                                                          index_S_i, index_A_j)
-            # add it to the matrix with all processes of all active excitations
-            total_abs_matrix = total_abs_matrix + absorption_matrix
+            unit_abs_matrices.append(_create_absorption_matrix(abs_sensitizer, abs_activator,
+                                                               index_S_i, index_A_j))
+
+    return unit_abs_matrices
+
+
+def _scale_absorption_matrices(unit_abs_matrices: List[scipy.sparse.csr_matrix],
+                               num_energy_states: int,
+                               excitations_dict: Dict) -> scipy.sparse.csr_matrix:
+    '''Returns the total absorption matrix: the sum of the unit absorption matrices
+        of the active excitations multiplied by their power density.
+    '''
+    total_abs_matrix = scipy.sparse.csr_matrix((num_energy_states,
+                                                num_energy_states), dtype=np.float64)
+
+    active_excitations = [exc for exc_lst in excitations_dict.values()
+                          for exc in exc_lst if exc.active is not False]
+    for current_exc, unit_abs_matrix in zip(active_excitations, unit_abs_matrices):
+        # add it to the matrix with all processes of all active excitations
+        total_abs_matrix = total_abs_matrix + current_exc.power_dens*unit_abs_matrix
 
     return total_abs_matrix
 
+
+def _create_total_absorption_matrix(sensitizer_states: int, activator_states: int,
+                                    num_energy_states: int,
+                                    excitations_dict: Dict, index_S_i: List[int],
+                                    index_A_j: List[int]) -> scipy.sparse.csr_matrix:
+    '''Returns the total absorption matrix'''
+    unit_abs_matrices = _create_unit_absorption_matrices(sensitizer_states, activator_states,
+                                                         excitations_dict, index_S_i, index_A_j)
+    return _scale_absorption_matrices(unit_abs_matrices, num_energy_states, excitations_dict)
+
+
 @log_exceptions_warnings
 def _create_branching_ratios(sensitizer_states: int, activator_states: int,
                              decay_dict: Dict) -> Tuple[np.array, np.array]:
@@ -232,14 +386,19 @@ def _create_decay_matrix(sensitizer_states: int, activator_states: int, decay_di
 
 #@profile
 @log_exceptions_warnings
-def _create_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET: Dict,
-                        indices_S_k: List[np.array], indices_S_l: List[np.array],
-                        indices_A_k: List[np.array], indices_A_l: List[np.array],
-                        dists_S_k: List[np.array], dists_S_l: List[np.array],
-                        dists_A_k: List[np.array], dists_A_l: List[np.array],
+def _create_ET_topology(index_S_i: List[int], index_A_j: List[int], dict_ET: Dict,
+                        indptr_S_k: np.array, indptr_S_l: np.array,
+                        indptr_A_k: np.array, indptr_A_l: np.array,
+                        indices_S_k: np.array, indices_S_l: np.array,
+                        indices_A_k: np.array, indices_A_l: np.array,
+                        dists_S_k: np.array, dists_S_l: np.array,
+                        dists_A_k: np.array, dists_A_l: np.array,
                         sensitizer_states: int, activator_states: int
-                       ) -> Tuple[scipy.sparse.csr_matrix, np.array]:
+                       ) -> Tuple[scipy.sparse.csr_matrix, np.array, np.array, List[str]]:
     '''Calculates the ET_matrix and N_indices matrices of energy transfer
+       for processes of unit strength (see _create_ET_matrices).
+       It also returns the process of each interaction (column of ET_matrix)
+       as an index into the returned list of process names.
        The ET_matrix has size num_interactions x num_states:
        at each column there are 4 nonzero values corresponding to the ET rate.
        Their positions in the column are at the indices of the populations affected
@@ -250,70 +409,21 @@ def _create_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET: Dic
        The total ET contribution to the rate equations is then:
        ET_matrix * y(N_indices[:,0]) * y(N_indices[:,1]).
     '''
-#    @profile
-    def add_ET_process(index_ion: int, indices_ions: np.array, dist_ions: np.array,
-                       strength: float, mult: int,
-                       ii_state: int, fi_state: int, if_state: int, ff_state: int) -> None:
-        ''' Adds an energy transfer process
-            ii_state: initial ion, initial state
-            fi_state: final ion, initial state
-
-            if_state: initial ion, final state
-            ff_state: final ion, final state
-            '''
-
-        # this tells python to use the outer uc_index variable
-        # the other outer variables (x_index, N_index_X, ...) are mutable and
-        # are modified without problems
-        nonlocal uc_index
-
-        indices_ions = indices_ions[indices_ions != -1]
-        dist_ions = dist_ions[indices_ions != -1]
-
-        # len(indices_ions): number of interactions that we add at once
-
-        # state numbers for GS of ion1, ES ion1, GS ion2 and ES ion2
-        # repeat the current ion's initial and final states
-        ii_states = np.repeat(np.array([index_ion+ii_state], dtype=np.uint32), len(indices_ions))
-        if_states = np.repeat(np.array([index_ion+if_state], dtype=np.uint32), len(indices_ions))
-        # calculate the interacting ions' initial and final states
-        fi_states = np.uint32(indices_ions+fi_state)
-        ff_states = np.uint32(indices_ions+ff_state)
-        # rows: interweave i_vec_Xs
-        i_index.append(np.ravel(np.column_stack((ii_states, if_states, fi_states, ff_states))))
-
-        # cols: interaction # uc_index
-        col_nums = np.arange(uc_index, uc_index+len(indices_ions), dtype=np.uint32)
-        j_index.append(np.ravel(np.column_stack((col_nums, col_nums, col_nums, col_nums))))
-
-        w_strengths = dist_ions**(-mult)*strength
-        v_index.append(np.ravel(np.column_stack((-w_strengths, w_strengths,
-                                                 -w_strengths, w_strengths))))
-        # initial states from both ions
-        N_index_I.append(ii_states)
-        N_index_J.append(fi_states)
-
-        uc_index += len(indices_ions)
-
     num_S_atoms = np.count_nonzero(np.array(index_S_i) != -1)
     num_A_atoms = np.count_nonzero(np.array(index_A_j) != -1)
-    num_total_ions = num_S_atoms + num_A_atoms
     num_energy_states = sensitizer_states*num_S_atoms + activator_states*num_A_atoms
 
+    # processes with non-zero strength
+    proc_names = [proc_name for proc_name, process in dict_ET.items()
+                  if not np.isclose(process.strength, 0.0)]
+    empty_processes = np.array([], dtype=np.uint32)
+
     # if there are 2 states or fewer, return emtpy matrices
     if num_energy_states <= 2:
         ET_matrix = csr_matrix(np.zeros((num_energy_states, 0), dtype=np.float64))
         N_indices = np.column_stack((np.array([], dtype=np.uint32),
                                      np.array([], dtype=np.uint32)))
-        return (ET_matrix, N_indices)
-
-    N_index_I = []  # type: List[np.array]
-    N_index_J = []  # type: List[np.array]
-
-    uc_index = 0
-    i_index = []  # type: List[np.array]
-    j_index = []  # type: List[np.array]
-    v_index = []  # type: List[np.array]
+        return (ET_matrix, N_indices, empty_processes, proc_names)
 
     # indices legend:
     # i, i+1 = current S
@@ -344,74 +454,145 @@ def _create_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET: Dic
                'than required by process {}.').format(proc_name)
         raise lattice.LatticeError(msg)
 
-    # go over each ion and calculate its interactions
-    num_A = num_S = 0
-    for num in range(num_total_ions):
-        if index_A_j[num] != -1 and activator_states != 0:  # Tm ions
-            index_j = index_A_j[num]  # position of ion num on the solution vector
-            # add all A-A ET processes
-            for proc_name, process in dict_ET.items():
-                if not np.isclose(process.strength, 0.0) and process.type == (IonType.A, IonType.A):
-                    # reshape to (n,) from (n,1)
-                    indices_l = indices_A_l[num_A].reshape((len(indices_A_l[num_A]),))
-                    dists_l = dists_A_l[num_A]
-                    add_ET_process(index_j, indices_l, dists_l,
-                                   process.strength,
-                                   process.mult,
-                                   *process.indices)
-            # add all A-S ET processes
-            for proc_name, process in dict_ET.items():
-                if not np.isclose(process.strength, 0.0) and process.type == (IonType.A, IonType.S):
-                    indices_k = indices_A_k[num_A].reshape((len(indices_A_k[num_A]),))
-                    dists_k = dists_A_k[num_A]
-                    add_ET_process(index_j, indices_k, dists_k,
-                                   process.strength,
-                                   process.mult,
-                                   *process.indices)
-            num_A += 1
-        if index_S_i[num] != -1 and sensitizer_states != 0:  # Yb ions
-            index_i = index_S_i[num]  # position of ion num on the solution vector
-            # add all S-S ET processes
-            for proc_name, process in dict_ET.items():
-                if not np.isclose(process.strength, 0.0) and process.type == (IonType.S, IonType.S):
-                    indices_k = indices_S_k[num_S].reshape((len(indices_S_k[num_S]),))
-                    dists_k = dists_S_k[num_S]
-                    add_ET_process(index_i, indices_k, dists_k,
-                                   process.strength,
-                                   process.mult,
-                                   *process.indices)
-            # add all S-A ET processes
+    def get_ion_data(index_X: List[int], indptr_X: np.array
+                    ) -> Tuple[np.array, np.array, np.array, np.array]:
+        '''Returns the ion number and position on the solution vector of all ions of one type,
+            and for each interaction the ion and its position in the ion's interactions.'''
+        index_X_arr = np.array(index_X, dtype=np.int64)
+        nums = np.nonzero(index_X_arr != -1)[0]
+        indptr_X = np.asarray(indptr_X, dtype=np.int64)
+        ions = np.repeat(np.arange(len(indptr_X) - 1), np.diff(indptr_X))
+        others = np.arange(indptr_X[-1]) - indptr_X[ions]
+        return (nums, index_X_arr[nums], ions, others)
+
+    # number, position, interactions and distances of each A and S ion
+    ion_data = {}
+    if activator_states != 0:
+        ion_data[(IonType.A, IonType.A)] = (get_ion_data(index_A_j, indptr_A_l) +
+                                            (indices_A_l, dists_A_l))
+        ion_data[(IonType.A, IonType.S)] = (get_ion_data(index_A_j, indptr_A_k) +
+                                            (indices_A_k, dists_A_k))
+    if sensitizer_states != 0:
+        ion_data[(IonType.S, IonType.S)] = (get_ion_data(index_S_i, indptr_S_k) +
+                                            (indices_S_k, dists_S_k))
+        ion_data[(IonType.S, IonType.A)] = (get_ion_data(index_S_i, indptr_S_l) +
+                                            (indices_S_l, dists_S_l))
+
+    # all interactions of each process at once.
+    # The interactions are sorted by ion number, then by the process order
+    # (A-A and A-S for A ions, S-S and S-A for S ions) and then by the interacting ion
+    sort_num = []  # type: List[np.array]
+    sort_proc = []  # type: List[np.array]
+    sort_other = []  # type: List[np.array]
+    ii_states_lst = []  # type: List[np.array]
+    if_states_lst = []  # type: List[np.array]
+    fi_states_lst = []  # type: List[np.array]
+    ff_states_lst = []  # type: List[np.array]
+    w_strengths_lst = []  # type: List[np.array]
+    P_index = []  # type: List[np.array]
+    proc_order = 0
+    for proc_types in [((IonType.A, IonType.A), (IonType.A, IonType.S)),
+                       ((IonType.S, IonType.S), (IonType.S, IonType.A))]:
+        for proc_type in proc_types:
+            if proc_type not in ion_data:
+                continue
+            nums, index_ions, ions, others, indices_others, dists_others = ion_data[proc_type]
+            indices_others = np.asarray(indices_others, dtype=np.int64)
             for proc_name, process in dict_ET.items():
-                if not np.isclose(process.strength, 0.0) and process.type == (IonType.S, IonType.A):
-                    indices_l = indices_S_l[num_S].reshape((len(indices_S_l[num_S]),))
-                    dists_l = dists_S_l[num_S]
-                    add_ET_process(index_i, indices_l, dists_l,
-                                   process.strength,
-                                   process.mult,
-                                   *process.indices)
-            num_S += 1
+                if np.isclose(process.strength, 0.0) or process.type != proc_type:
+                    continue
+                ii_state, fi_state, if_state, ff_state = process.indices
+                # state numbers for GS of ion1, ES ion1, GS ion2 and ES ion2
+                ii_states_lst.append(np.uint32(index_ions[ions]+ii_state))
+                if_states_lst.append(np.uint32(index_ions[ions]+if_state))
+                fi_states_lst.append(np.uint32(indices_others+fi_state))
+                ff_states_lst.append(np.uint32(indices_others+ff_state))
+                w_strengths_lst.append(dists_others**(-process.mult))
+                # process of each interaction
+                P_index.append(np.full((len(ions), ), proc_names.index(proc_name),
+                                       dtype=np.uint32))
+                sort_num.append(nums[ions])
+                sort_proc.append(np.full((len(ions), ), proc_order, dtype=np.int64))
+                sort_other.append(others)
+                proc_order += 1
+
+    num_interactions = sum(len(elem) for elem in P_index)
 
     # no ET processes
-    if uc_index == 0:
+    if num_interactions == 0:
         ET_matrix = csr_matrix(np.zeros((num_energy_states, 0), dtype=np.float64))
         N_indices = np.column_stack((np.array([], dtype=np.uint32),
                                      np.array([], dtype=np.uint32)))
-        return (ET_matrix, N_indices)
+        return (ET_matrix, N_indices, empty_processes, proc_names)
 
-    # flatten lists and covert them to np.arrays
-    N_index_I = np.concatenate(N_index_I).ravel()
-    N_index_J = np.concatenate(N_index_J).ravel()
+    order = np.lexsort((np.concatenate(sort_other), np.concatenate(sort_proc),
+                        np.concatenate(sort_num)))
+    ii_states = np.concatenate(ii_states_lst)[order]
+    if_states = np.concatenate(if_states_lst)[order]
+    fi_states = np.concatenate(fi_states_lst)[order]
+    ff_states = np.concatenate(ff_states_lst)[order]
+    w_strengths = np.concatenate(w_strengths_lst)[order]
+    ET_processes = np.concatenate(P_index)[order]
 
-    i_index = np.concatenate(i_index).ravel()
-    j_index = np.concatenate(j_index).ravel()
-    v_index = np.concatenate(v_index).ravel()
+    # rows: interweave i_vec_Xs
+    i_index = np.ravel(np.column_stack((ii_states, if_states, fi_states, ff_states)))
+    # cols: interaction number
+    col_nums = np.arange(num_interactions, dtype=np.uint32)
+    j_index = np.ravel(np.column_stack((col_nums, col_nums, col_nums, col_nums)))
+    v_index = np.ravel(np.column_stack((-w_strengths, w_strengths,
+                                        -w_strengths, w_strengths)))
 
     # create ET matrix
     ET_matrix = csr_matrix((v_index, (i_index, j_index)),
-                           shape=(num_energy_states, uc_index),
+                           shape=(num_energy_states, num_interactions),
                            dtype=np.float64)
-    N_indices = np.column_stack((N_index_I, N_index_J))
+    # initial states from both ions
+    N_indices = np.column_stack((ii_states, fi_states))
+
+    return (ET_matrix, N_indices, ET_processes, proc_names)
+
+
+def _scale_ET_matrix(unit_ET_matrix: scipy.sparse.csr_matrix, ET_processes: np.array,
+                     proc_names: List[str], dict_ET: Dict) -> scipy.sparse.csr_matrix:
+    '''Multiplies each column of the unit_ET_matrix by the strength of its process.'''
+    strengths = np.array([dict_ET[proc_name].strength for proc_name in proc_names],
+                         dtype=np.float64)
+    ET_matrix = unit_ET_matrix.copy()
+    if ET_matrix.nnz:
+        ET_matrix.data = unit_ET_matrix.data*strengths[ET_processes[unit_ET_matrix.indices]]
+    return ET_matrix
+
 
+def _create_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET: Dict,
+                        indptr_S_k: np.array, indptr_S_l: np.array,
+                        indptr_A_k: np.array, indptr_A_l: np.array,
+                        indices_S_k: np.array, indices_S_l: np.array,
+                        indices_A_k: np.array, indices_A_l: np.array,
+                        dists_S_k: np.array, dists_S_l: np.array,
+                        dists_A_k: np.array, dists_A_l: np.array,
+                        sensitizer_states: int, activator_states: int
+                       ) -> Tuple[scipy.sparse.csr_matrix, np.array]:
+    '''Calculates the ET_matrix and N_indices matrices of energy transfer
+       The ET_matrix has size num_interactions x num_states:
+       at each column there are 4 nonzero values corresponding to the ET rate.
+       Their positions in the column are at the indices of the populations affected
+       by that particular ET process.
+       N_indices has size 2 x num_interactions: each row corresponds to the populations
+       that need to be multiplied: y(N_indices[:,0]) * y(N_indices[:,1]).
+
+       The total ET contribution to the rate equations is then:
+       ET_matrix * y(N_indices[:,0]) * y(N_indices[:,1]).
+    '''
+    (unit_ET_matrix, N_indices,
+     ET_processes, proc_names) = _create_ET_topology(index_S_i, index_A_j, dict_ET,
+                                                     indptr_S_k, indptr_S_l,
+                                                     indptr_A_k, indptr_A_l,
+                                                     indices_S_k, indices_S_l,
+                                                     indices_A_k, indices_A_l,
+                                                     dists_S_k, dists_S_l,
+                                                     dists_A_k, dists_A_l,
+                                                     sensitizer_states, activator_states)
+    ET_matrix = _scale_ET_matrix(unit_ET_matrix, ET_processes, proc_names, dict_ET)
     return (ET_matrix, N_indices)
 
 
@@ -424,15 +605,19 @@ def _create_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET: Dic
 # unused arguments
 # pylint: disable=W0613
 #@profile
-def _create_coop_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET: Dict,
-                             indices_S_k: List[np.array], indices_S_l: List[np.array],
-                             indices_A_k: List[np.array], indices_A_l: List[np.array],
+def _create_coop_ET_topology(index_S_i: List[int], index_A_j: List[int], dict_ET: Dict,
+                             indptr_S_k: np.array, indptr_S_l: np.array,
+                             indptr_A_k: np.array, indptr_A_l: np.array,
+                             indices_S_k: np.array, indices_S_l: np.array,
+                             indices_A_k: np.array, indices_A_l: np.array,
                              dists_S_k: np.array, dists_S_l: np.array,
                              dists_A_k: np.array, dists_A_l: np.array,
                              sensitizer_states: int, activator_states: int,
                              d_max_coop: float = np.inf,
-                            ) -> Tuple[scipy.sparse.csr_matrix, np.array]:
+                            ) -> Tuple[scipy.sparse.csr_matrix, np.array, str]:
     '''Calculates the cooperative coop_ET_matrix and coop_N_indices matrices of energy transfer
+       for a process of unit strength (see _create_coop_ET_matrices).
+       It also returns the name of the cooperative process (None if there isn't any).
        The coop_ET_matrix has size num_interactions x num_states:
        at each column there are 6 nonzero values corresponding to the ET rates.
        Their positions in the column are at the indices of the populations affected
@@ -454,47 +639,46 @@ def _create_coop_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET
 
 
 #    @profile
-    def get_all_processes(indices_this: np.array, indices_others: np.array,
-                          dists_others: np.array,
-                          d_max_coop: float, interaction_estimate: int) -> np.array:
+    def get_all_processes(indices_this: np.array, indptr_others: np.array,
+                          indices_others: np.array, dists_others: np.array,
+                          d_max_coop: float) -> np.array:
         '''Calculate all cooperative processes from ions indices_this to all indices_others.'''
-        processes_arr = np.empty((interaction_estimate, ), dtype=proc_dtype)
-
-        indices_others = [row.reshape(len(row),) for row in indices_others]
-
         indices_this = np.array(indices_this)
         indices_this = indices_this[indices_this != -1]
 
+        # other ions that are closer than d_max_coop
+        valid_all = np.asarray(dists_others) < d_max_coop
+        cum_valid = np.concatenate(([0], np.cumsum(valid_all, dtype=np.int64)))
+        num_valid = cum_valid[indptr_others[1:]] - cum_valid[indptr_others[:-1]]
+        processes_arr = np.empty((np.sum(num_valid*(num_valid-1)//2), ), dtype=proc_dtype)
+
         # for each ion, and the other ions it interacts with
         num = 0
         # XXX: parallelize?
-        for index_this, indices_k, dists_k in zip(indices_this, indices_others, dists_others):
+        for ion_num, index_this in enumerate(indices_this):
+            row_slice = slice(indptr_others[ion_num], indptr_others[ion_num+1])
+            indices_k = indices_others[row_slice]
+            dists_k = dists_others[row_slice]
+            valid = valid_all[row_slice]
             # pairs of other ions
-            pairs = list(itertools.combinations(indices_k, 2))
+            pairs = list(itertools.combinations(indices_k[valid], 2))
             # distances from this to the pairs of others
-            pairs_dist = list(itertools.combinations(dists_k, 2))
+            pairs_dist = list(itertools.combinations(dists_k[valid], 2))
             new_rows = [(pair[0], pair[1], index_this, dists[0], dists[1], 0.0)
-                        for pair, dists in zip(pairs, pairs_dist) if max(dists) < d_max_coop]
-#            processes.extend(new_rows)
+                        for pair, dists in zip(pairs, pairs_dist)]
             processes_arr[num:num+len(new_rows)] = new_rows
             num += len(new_rows)
-        return processes_arr[0:num]
-
-    # slowest function, use numba jit
-    @numba.jit(nopython=True, cache=False, nogil=True)
-    def get_i_k_ions(proc_i: np.array, proc_k: np.array,
-                     index_S_i: np.array) -> Tuple[np.array, np.array]:  # pragma: no cover
-        '''Get the ion number of states i and k.'''
-        # list of GS of S ions
-        index_S_i_red = index_S_i[index_S_i != -1]
+        return processes_arr
 
-        ion_i = np.zeros_like(proc_i, dtype=np.int64)
-        ion_k = np.zeros_like(ion_i)
-        for num, (i, k) in enumerate(zip(proc_i, proc_k)):
-            ion_i[num] = np.where(index_S_i_red == i)[0][0]
-            ion_k[num] = np.where(index_S_i_red == k)[0][0]
+    def get_S_dist_matrix(index_S_i: List[int], indptr_S_k: np.array, indices_S_k: np.array,
+                          dists_S_k: np.array, num_energy_states: int) -> csr_matrix:
+        '''Sparse matrix with the distance between the GS of each pair of interacting S ions.'''
+        index_S_i_arr = np.array(index_S_i, dtype=np.int64)
+        index_S_i_arr = index_S_i_arr[index_S_i_arr != -1]
 
-        return (ion_i, ion_k)
+        rows = np.repeat(index_S_i_arr, np.diff(indptr_S_k))
+        return csr_matrix((dists_S_k, (rows, indices_S_k)),
+                          shape=(num_energy_states, num_energy_states), dtype=np.float64)
 
     @numba.jit(nopython=True, cache=False, nogil=True)
     def calculate_coop_strength(processes_arr: np.array, mult: int) -> np.array:  # pragma: no cover
@@ -512,11 +696,13 @@ def _create_coop_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET
 
     # get the process of the coop step
     coop_process = None
-    for process in dict_ET.values():
+    coop_proc_name = None
+    for proc_name, process in dict_ET.items():
         ### TODO: ONLY SSA COOPERATIVE PROCESSES
         if not np.isclose(process.strength, 0.0) and process.type == (IonType.S, IonType.S,
                                                                       IonType.A):
             coop_process = process
+            coop_proc_name = proc_name
             break
 
     # if there are 5 states or fewer, return empty matrices
@@ -525,36 +711,33 @@ def _create_coop_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET
         coop_N_indices = np.column_stack((np.array([], dtype=np.uint32),
                                           np.array([], dtype=np.uint32),
                                           np.array([], dtype=np.uint32)))
-        return (coop_ET_matrix, coop_N_indices)
+        return (coop_ET_matrix, coop_N_indices, coop_proc_name)
 
     # get all coop processes with distances smaller than d_max_coop
     index_A_j_arr = np.array(index_A_j).astype(np.int64)
     index_A_j_arr = index_A_j_arr[index_A_j_arr != -1]
     index_A_j_arr = index_A_j_arr.astype(np.uint32)
-    indices_A_k_arr = np.array([row.reshape(len(row), 1) for row in indices_A_k], dtype=np.uint32)
-    indices_A_k_arr.shape = indices_A_k_arr.shape[0:2]
-
-    interaction_estimate = num_A_atoms*num_S_atoms*(num_S_atoms-1)//2  # max number
-    factor = np.count_nonzero(dists_A_k < d_max_coop)/dists_A_k.size
-    interaction_estimate *= factor
-#    print(factor, interaction_estimate)
-    processes_arr = get_all_processes(index_A_j_arr, indices_A_k_arr,
-                                      dists_A_k, d_max_coop, int(interaction_estimate))
-#    print(processes_arr)
+    processes_arr = get_all_processes(index_A_j_arr, indptr_A_k, indices_A_k, dists_A_k,
+                                      d_max_coop)
     num_inter = len(processes_arr)
 #    logger.debug('Number of cooperative processes: %d', num_inter)
 
-    # no interactions, dealt with above
-#    if num_inter == 0:
-#        coop_ET_matrix = csr_matrix(np.zeros((num_energy_states, 0), dtype=np.float64))
-#        coop_N_indices = np.column_stack((np.array([], dtype=np.uint32),
-#                                          np.array([], dtype=np.uint32),
-#                                          np.array([], dtype=np.uint32)))
-#        return (coop_ET_matrix, coop_N_indices)
+    # no interactions closer than d_max_coop
+    if num_inter == 0:
+        coop_ET_matrix = csr_matrix(np.zeros((num_energy_states, 0), dtype=np.float64))
+        coop_N_indices = np.column_stack((np.array([], dtype=np.uint32),
+                                          np.array([], dtype=np.uint32),
+                                          np.array([], dtype=np.uint32)))
+        return (coop_ET_matrix, coop_N_indices, coop_proc_name)
 
     # update the last columm of processes_arr with the distance between i and k
-    i_ion_arr, k_ion_arr = get_i_k_ions(processes_arr['i'], processes_arr['k'], np.array(index_S_i))
-    processes_arr['d_ik'] = dists_S_k[i_ion_arr, k_ion_arr-1]
+    # S ions further apart than d_max don't interact: infinite distance
+    S_dist_matrix = get_S_dist_matrix(index_S_i, indptr_S_k, indices_S_k, dists_S_k,
+                                      num_energy_states)
+    d_ik = np.asarray(S_dist_matrix[processes_arr['i'].astype(np.int64),
+                                    processes_arr['k'].astype(np.int64)]).ravel()
+    d_ik[d_ik == 0] = np.inf
+    processes_arr['d_ik'] = d_ik
 #    logger.debug('Cooperative distances calculated.')
 
     # unpack requested process
@@ -580,9 +763,8 @@ def _create_coop_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET
                                         num_cols, num_cols,
                                         num_cols, num_cols)))
 
-    value = coop_process.strength
     mult = coop_process.mult
-    w_strengths = value*calculate_coop_strength(processes_arr, mult)
+    w_strengths = calculate_coop_strength(processes_arr, mult)
     v_index = np.ravel(np.column_stack((-w_strengths, w_strengths,
                                         -w_strengths, w_strengths,
                                         -w_strengths, w_strengths)))
@@ -596,9 +778,54 @@ def _create_coop_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET
     # initial states
     coop_N_indices = np.column_stack((i_i_states, k_i_states, l_i_states))
 
+    return (coop_ET_matrix, coop_N_indices, coop_proc_name)
+
+
+def _create_coop_ET_matrices(index_S_i: List[int], index_A_j: List[int], dict_ET: Dict,
+                             indptr_S_k: np.array, indptr_S_l: np.array,
+                             indptr_A_k: np.array, indptr_A_l: np.array,
+                             indices_S_k: np.array, indices_S_l: np.array,
+                             indices_A_k: np.array, indices_A_l: np.array,
+                             dists_S_k: np.array, dists_S_l: np.array,
+                             dists_A_k: np.array, dists_A_l: np.array,
+                             sensitizer_states: int, activator_states: int,
+                             d_max_coop: float = np.inf,
+                            ) -> Tuple[scipy.sparse.csr_matrix, np.array]:
+    '''Calculates the cooperative coop_ET_matrix and coop_N_indices matrices of energy transfer
+       The coop_ET_matrix has size num_interactions x num_states:
+       at each column there are 6 nonzero values corresponding to the ET rates.
+       Their positions in the column are at the indices of the populations affected
+       by that particular ET process.
+       coop_N_indices has size 3 x num_interactions: each row corresponds to the populations
+       that need to be multiplied:
+           y(coop_N_indices[:,0])*y(coop_N_indices[:,1])*y(coop_N_indices[:,2]).
+
+       The total ET contribution to the rate equations is then:
+       coop_ET_matrix * y(coop_N_indices[:,0])*y(coop_N_indices[:,1])*y(coop_N_indices[:,2]).
+    '''
+    (unit_coop_ET_matrix, coop_N_indices,
+     coop_proc_name) = _create_coop_ET_topology(index_S_i, index_A_j, dict_ET,
+                                                indptr_S_k, indptr_S_l,
+                                                indptr_A_k, indptr_A_l,
+                                                indices_S_k, indices_S_l,
+                                                indices_A_k, indices_A_l,
+                                                dists_S_k, dists_S_l,
+                                                dists_A_k, dists_A_l,
+                                                sensitizer_states, activator_states,
+                                                d_max_coop=d_max_coop)
+    coop_ET_matrix = _scale_coop_ET_matrix(unit_coop_ET_matrix, coop_proc_name, dict_ET)
     return (coop_ET_matrix, coop_N_indices)
 
 
+def _scale_coop_ET_matrix(unit_coop_ET_matrix: scipy.sparse.csr_matrix, coop_proc_name: str,
+                          dict_ET: Dict) -> scipy.sparse.csr_matrix:
+    '''Multiplies the unit_coop_ET_matrix by the strength of its process.'''
+    coop_ET_matrix = unit_coop_ET_matrix.copy()
+    if coop_proc_name is not None and coop_ET_matrix.nnz:
+        coop_ET_matrix.data = unit_coop_ET_matrix.data*dict_ET[coop_proc_name].strength
+    return coop_ET_matrix
+
+
 #@profile
 def _calculate_jac_matrices(N_indices: np.array) -> np.array:
     '''Calculates the jacobian matrix helper data structures (non-zero values):
@@ -699,6 +926,87 @@ def _calculate_coop_jac_matrices(coop_N_indices: np.array) -> np.array:
     return coop_jac_indices
 
 
+def _create_averaging_index(index_S_i: List[int], index_A_j: List[int],
+                            sensitizer_states: int, activator_states: int) -> Dict:
+    '''Returns the ion-to-state index used to average the populations:
+        the first state, first averaged state and number of states of each ion,
+        and the weight (one over the number of ions) of each averaged state.
+        The indices are cached for each lattice.
+    '''
+    index_S_i = np.asarray(index_S_i, dtype=np.int64)
+    index_A_j = np.asarray(index_A_j, dtype=np.int64)
+    key = (index_S_i.tobytes(), index_A_j.tobytes(), sensitizer_states, activator_states)
+    avg_index = _averaging_cache.get(key)
+    if avg_index is not None:
+        return avg_index
+
+    is_S = index_S_i != -1
+    is_A = index_A_j != -1
+    num_S = np.count_nonzero(is_S)
+    num_A = np.count_nonzero(is_A)
+    avg_index = {}
+    avg_index['ion_starts'] = np.concatenate((index_S_i[is_S], index_A_j[is_A]))
+    avg_index['ion_rows'] = np.concatenate((np.zeros((num_S,), dtype=np.int64),
+                                            np.full((num_A,), sensitizer_states, dtype=np.int64)))
+    avg_index['ion_states'] = np.concatenate((np.full((num_S,), sensitizer_states, dtype=np.int64),
+                                              np.full((num_A,), activator_states, dtype=np.int64)))
+    avg_index['weights'] = np.array([1/num_S if num_S else 0.0]*sensitizer_states +
+                                    [1/num_A if num_A else 0.0]*activator_states)
+    _averaging_cache.add(key, avg_index)
+    return avg_index
+
+
+@numba.jit(nopython=True, cache=False, nogil=True)
+def _average_kernel(y_sol: np.array, ion_starts: np.array, ion_rows: np.array,
+                    ion_states: np.array, out: np.array) -> None:  # pragma: no cover
+    '''Adds the populations of all ions to their averaged states, one time step at a time.'''
+    acc = np.zeros((out.shape[1],))
+    for t in range(y_sol.shape[0]):
+        y_t = y_sol[t]
+        acc[:] = 0
+        for ion in range(ion_starts.size):
+            start = ion_starts[ion]
+            row = ion_rows[ion]
+            for state in range(ion_states[ion]):
+                acc[row+state] += y_t[start+state]
+        out[t] = acc
+
+
+def average_populations(y_sol: np.array, index_S_i: List[int], index_A_j: List[int],
+                        sensitizer_states: int, activator_states: int) -> np.array:
+    '''Returns the average population of each state (rows) at each time (columns),
+        first the sensitizer states and then the activator ones.
+        y_sol has the populations of all states (columns) at each time (rows),
+        it can be an array or a HDF5 dataset.
+    '''
+    avg_index = _create_averaging_index(index_S_i, index_A_j, sensitizer_states, activator_states)
+    populations = np.zeros((y_sol.shape[0], sensitizer_states+activator_states))
+    # y_sol can also be a HDF5 dataset, read it in blocks of about 100 MB
+    block_rows = max(1, int(100e6//(8*max(1, y_sol.shape[1]))))
+    for start in range(0, y_sol.shape[0], block_rows):
+        block = np.ascontiguousarray(y_sol[start:start+block_rows], dtype=np.float64)
+        _average_kernel(block, avg_index['ion_starts'], avg_index['ion_rows'],
+                        avg_index['ion_states'], populations[start:start+block_rows])
+    return (populations*avg_index['weights']).T
+
+
+def create_averaging_matrix(index_S_i: List[int], index_A_j: List[int],
+                            sensitizer_states: int, activator_states: int,
+                            num_states: int) -> csr_matrix:
+    '''Returns the (sensitizer_states+activator_states) x num_states sparse matrix whose product
+        with the populations of all states are the average populations of each state.
+    '''
+    avg_index = _create_averaging_index(index_S_i, index_A_j, sensitizer_states, activator_states)
+    ion_states = avg_index['ion_states']
+    # position of each state within its ion
+    first_states = np.repeat(np.cumsum(ion_states) - ion_states, ion_states)
+    state_offsets = np.arange(np.sum(ion_states), dtype=np.int64) - first_states
+    rows = np.repeat(avg_index['ion_rows'], ion_states) + state_offsets
+    cols = np.repeat(avg_index['ion_starts'], ion_states) + state_offsets
+    return csr_matrix((avg_index['weights'][rows], (rows, cols)),
+                      shape=(sensitizer_states+activator_states, num_states))
+
+
 def get_lifetimes(cte: settings.Settings) -> List[float]:
     '''Returns a list of all lifetimes in seconds.
        First sensitizer and then activator
@@ -757,39 +1065,42 @@ def setup_microscopic_eqs(cte: settings.Settings, gen_lattice: bool = False, ful
         full_path = lattice.make_full_path(folder_path, num_uc, S_conc, A_conc, radius=radius)
         filename = full_path
 
-    try:
-        # generate the lattice in any case
-        if gen_lattice:  # pragma: no cover
-            logger.debug('User request to recreate lattice.')
-            raise FileNotFoundError('Recalculate lattice')
-
-        # try load the lattice data from disk
-        lattice_info = _load_lattice(filename)
-
-        # check that the number of states is correct, except if the full_path has been passed
-        if full_path is not None:
-            cte.states['sensitizer_states'] = lattice_info['sensitizer_states']
-            cte.states['activator_states'] = lattice_info['activator_states']
-        elif (lattice_info['sensitizer_states'] != cte.states['sensitizer_states'] or
-                lattice_info['activator_states'] != cte.states['activator_states']):
-            logger.info('Wrong number of states, recalculate lattice...')
-            raise FileNotFoundError('Wrong number of states, recalculate lattice...')
-
-    except OSError:
-        logger.info('Creating lattice...')
-
-        # don't show the plot
-        old_no_plot = cte['no_plot']
-        cte['no_plot'] = True
-        # generate lattice, data will be saved to disk
-        lattice.generate(cte, full_path=filename)
-        cte['no_plot'] = old_no_plot
-
-        # load data from disk
-        lattice_info = _load_lattice(filename)
-        logger.info('Lattice data created.')
-    else:
-        logger.info('Lattice data found.')
+    with profile_phase('lattice'):
+        try:
+            # generate the lattice in any case
+            if gen_lattice:  # pragma: no cover
+                logger.debug('User request to recreate lattice.')
+                raise FileNotFoundError('Recalculate lattice')
+
+            # try load the lattice data from the cache or disk
+            lattice_data = _load_lattice_data(filename, cte)
+            lattice_info = lattice_data['lattice_info']
+
+            # check that the number of states is correct, except if the full_path has been passed
+            if full_path is not None:
+                cte.states['sensitizer_states'] = lattice_info['sensitizer_states']
+                cte.states['activator_states'] = lattice_info['activator_states']
+            elif (lattice_info['sensitizer_states'] != cte.states['sensitizer_states'] or
+                    lattice_info['activator_states'] != cte.states['activator_states']):
+                logger.info('Wrong number of states, recalculate lattice...')
+                raise FileNotFoundError('Wrong number of states, recalculate lattice...')
+
+        except OSError:
+            logger.info('Creating lattice...')
+
+            # don't show the plot
+            old_no_plot = cte['no_plot']
+            cte['no_plot'] = True
+            # generate lattice, data will be saved to disk
+            lattice.generate(cte, full_path=filename)
+            cte['no_plot'] = old_no_plot
+
+            # load the new data from disk, never the cached data of a previous lattice
+            lattice_data = _load_lattice_data(filename, cte, reload=True)
+            lattice_info = lattice_data['lattice_info']
+            logger.info('Lattice data created.')
+        else:
+            logger.info('Lattice data found.')
 
     cte.ions = {}
     cte.ions['total'] = lattice_info['num_total']
@@ -811,64 +1122,84 @@ def setup_microscopic_eqs(cte: settings.Settings, gen_lattice: bool = False, ful
     logger.info('Calculating parameters...')
 
     # get data structures from the file
-    # i: current S ion
-    # j: current A ion
-    # k: other S ion that interacts
-    # l: other A ion that interacts
-    with h5py.File(filename, mode='r') as file:
-        index_S_i = list(itertools.chain.from_iterable(np.array(file['indices_S_i']).tolist()))
-        index_A_j = list(itertools.chain.from_iterable(np.array(file['indices_A_j']).tolist()))
-
-        # S interact with S
-        indices_S_k = [np.array(x, dtype=np.int64) for x in file['index_S_k']]
-        dists_S_k = np.array(file['dist_S_k'])
-
-        # S interact with A
-        indices_S_l = [np.array(x, dtype=np.int64) for x in file['index_S_l']]
-        dists_S_l = np.array(file['dist_S_l'])
-
-        # A interact with S
-        indices_A_k = [np.array(x, dtype=np.int64) for x in file['index_A_k']]
-        dists_A_k = np.array(file['dist_A_k'])
-
-        # A interact with A
-        indices_A_l = [np.array(x, dtype=np.int64) for x in file['index_A_l']]
-        dists_A_l = np.array(file['dist_A_l'])
-
-        initial_population = np.array(file['initial_population'])
+    index_S_i = lattice_data['index_S_i']
+    index_A_j = lattice_data['index_A_j']
+    (indptr_S_k, indices_S_k,
+     dists_S_k) = [lattice_data[name + 'S_k'] for name in ['indptr_', 'indices_', 'dists_']]
+    (indptr_S_l, indices_S_l,
+     dists_S_l) = [lattice_data[name + 'S_l'] for name in ['indptr_', 'indices_', 'dists_']]
+    (indptr_A_k, indices_A_k,
+     dists_A_k) = [lattice_data[name + 'A_k'] for name in ['indptr_', 'indices_', 'dists_']]
+    (indptr_A_l, indices_A_l,
+     dists_A_l) = [lattice_data[name + 'A_l'] for name in ['indptr_', 'indices_', 'dists_']]
+    initial_population = np.array(lattice_data['initial_population'])
 
     logger.info('Building matrices...')
 
     logger.info('Absorption and decay matrices...')
-    total_abs_matrix = _create_total_absorption_matrix(sensitizer_states, activator_states,
-                                                       num_energy_states, cte.excitations,
-                                                       index_S_i, index_A_j)
-    decay_matrix = _create_decay_matrix(sensitizer_states, activator_states,
-                                        cte.decay, index_S_i, index_A_j)
-
-    # ET matrices
-    logger.info('Energy transfer matrices...')
-    ET_matrix, N_indices = _create_ET_matrices(index_S_i, index_A_j, cte.energy_transfer,
-                                               indices_S_k, indices_S_l,
-                                               indices_A_k, indices_A_l,
-                                               dists_S_k, dists_S_l,
-                                               dists_A_k, dists_A_l,
-                                               sensitizer_states, activator_states)
-    jac_indices = _calculate_jac_matrices(N_indices)
+    with profile_phase('abs_decay_matrices'):
+        total_abs_matrix = _create_total_absorption_matrix(sensitizer_states, activator_states,
+                                                           num_energy_states, cte.excitations,
+                                                           index_S_i, index_A_j)
+        decay_matrix = _create_decay_matrix(sensitizer_states, activator_states,
+                                            cte.decay, index_S_i, index_A_j)
+
+    # the ET matrices only depend on the strengths through a factor per process,
+    # reuse the matrices of unit strength if the lattice and processes are the same
+    d_max_coop = cte.lattice.get('d_max_coop', np.inf)
+    topology_key = (lattice_data['cache_key'], sensitizer_states, activator_states, d_max_coop,
+                    tuple((proc_name, process.type, tuple(process.indices), process.mult)
+                          for proc_name, process in cte.energy_transfer.items()
+                          if not np.isclose(process.strength, 0.0)))
+    with profile_phase('ET_matrices'):
+        _ET_topology_cache.resize(_lattice_cache.max_size)
+        topology = _ET_topology_cache.get(topology_key)
+        if topology is None:
+            topology = {}
+            # ET matrices
+            logger.info('Energy transfer matrices...')
+            (topology['unit_ET_matrix'], topology['N_indices'],
+             topology['ET_processes'],
+             topology['proc_names']) = _create_ET_topology(index_S_i, index_A_j,
+                                                           cte.energy_transfer,
+                                                           indptr_S_k, indptr_S_l,
+                                                           indptr_A_k, indptr_A_l,
+                                                           indices_S_k, indices_S_l,
+                                                           indices_A_k, indices_A_l,
+                                                           dists_S_k, dists_S_l,
+                                                           dists_A_k, dists_A_l,
+                                                           sensitizer_states, activator_states)
+            topology['jac_indices'] = _calculate_jac_matrices(topology['N_indices'])
+
+            # Cooperative matrices
+            logger.info('Cooperative energy transfer matrices...')
+            (topology['unit_coop_ET_matrix'], topology['coop_N_indices'],
+             topology['coop_proc_name']) = _create_coop_ET_topology(index_S_i, index_A_j,
+                                                                    cte.energy_transfer,
+                                                                    indptr_S_k, indptr_S_l,
+                                                                    indptr_A_k, indptr_A_l,
+                                                                    indices_S_k, indices_S_l,
+                                                                    indices_A_k, indices_A_l,
+                                                                    dists_S_k, dists_S_l,
+                                                                    dists_A_k, dists_A_l,
+                                                                    sensitizer_states,
+                                                                    activator_states,
+                                                                    d_max_coop=d_max_coop)
+            topology['coop_jac_indices'] = _calculate_coop_jac_matrices(topology['coop_N_indices'])
+            _ET_topology_cache.add(topology_key, topology)
+        else:
+            logger.info('Energy transfer matrices found.')
+
+        ET_matrix = _scale_ET_matrix(topology['unit_ET_matrix'], topology['ET_processes'],
+                                     topology['proc_names'], cte.energy_transfer)
+        coop_ET_matrix = _scale_coop_ET_matrix(topology['unit_coop_ET_matrix'],
+                                               topology['coop_proc_name'], cte.energy_transfer)
+    N_indices = topology['N_indices']
+    jac_indices = topology['jac_indices']
     logger.info('Number of interactions: {:,}.'.format(N_indices.shape[0]))  # pylint: disable=W1202
 
-    # Cooperative matrices
-    logger.info('Cooperative energy transfer matrices...')
-    d_max_coop = cte.lattice.get('d_max_coop', np.inf)
-    (coop_ET_matrix,
-     coop_N_indices) = _create_coop_ET_matrices(index_S_i, index_A_j, cte.energy_transfer,
-                                                indices_S_k, indices_S_l,
-                                                indices_A_k, indices_A_l,
-                                                dists_S_k, dists_S_l,
-                                                dists_A_k, dists_A_l,
-                                                sensitizer_states, activator_states,
-                                                d_max_coop=d_max_coop)
-    coop_jac_indices = _calculate_coop_jac_matrices(coop_N_indices)
+    coop_N_indices = topology['coop_N_indices']
+    coop_jac_indices = topology['coop_jac_indices']
     logger.info('Number of cooperative interactions: {:,}.'.format(coop_N_indices.shape[0]))  # pylint: disable=W1202
 
     logger.info('Setup finished. Total time: %.2fs.', time.time()-start_time)
@@ -975,53 +1306,51 @@ def setup_average_eqs(cte: settings.Settings, gen_lattice: bool = False, full_pa
     (indices_S_i, indices_A_j,
      initial_population) = lattice.create_ground_states(ion_type, lattice_info)
 
-    (indices_S_k, indices_S_l,
+    (indptr_S_k, indptr_S_l,
+     indptr_A_k, indptr_A_l,
+     indices_S_k, indices_S_l,
      indices_A_k, indices_A_l,
      dists_S_k, dists_S_l,
      dists_A_k, dists_A_l) = lattice.create_interaction_matrices(ion_type, dist_array,
                                                                  indices_S_i, indices_A_j,
                                                                  lattice_info)
-    indices_S_k = [np.array(x, dtype=np.int64) for x in indices_S_k]
-    dists_S_k = np.array(dists_S_k)
-    indices_S_l = [np.array(x, dtype=np.int64) for x in indices_S_l]
-    dists_S_l = np.array(dists_S_l)
-    indices_A_k = [np.array(x, dtype=np.int64) for x in indices_A_k]
-    dists_A_k = np.array(dists_A_k)
-    indices_A_l = [np.array(x, dtype=np.int64) for x in indices_A_l]
-    dists_A_l = np.array(dists_A_l)
 
     logger.info('Building matrices...')
     logger.info('Absorption and decay matrices...')
-    total_abs_matrix = _create_total_absorption_matrix(sensitizer_states, activator_states,
-                                                       num_energy_states, cte.excitations,
-                                                       indices_S_i, indices_A_j)
-    decay_matrix = _create_decay_matrix(sensitizer_states, activator_states, cte.decay,
-                                        indices_S_i, indices_A_j)
+    with profile_phase('abs_decay_matrices'):
+        total_abs_matrix = _create_total_absorption_matrix(sensitizer_states, activator_states,
+                                                           num_energy_states, cte.excitations,
+                                                           indices_S_i, indices_A_j)
+        decay_matrix = _create_decay_matrix(sensitizer_states, activator_states, cte.decay,
+                                            indices_S_i, indices_A_j)
 
     # ET matrices
     logger.info('Energy transfer matrices...')
-    # use the avg value if present
-    ET_dict = cte.energy_transfer.copy()
-    for process in ET_dict.values():
-        if process.strength_avg is not None:
+    # use the avg value if present, without changing the settings
+    with profile_phase('ET_matrices'):
+        ET_dict = {label: copy.copy(process) for label, process in cte.energy_transfer.items()}
+        for process in ET_dict.values():
             process.strength = process.strength_avg
-    ET_matrix, N_indices = _create_ET_matrices(indices_S_i, indices_A_j, ET_dict,
-                                               indices_S_k, indices_S_l,
-                                               indices_A_k, indices_A_l,
-                                               dists_S_k, dists_S_l,
-                                               dists_A_k, dists_A_l,
-                                               sensitizer_states, activator_states)
-    # clean emtpy columns in the matrix due to energy migration
-    ET_matrix = ET_matrix.toarray()
-    emtpy_indices = [ind for ind in range(N_indices.shape[0]) if np.allclose(ET_matrix[:,ind], 0)]
-    if emtpy_indices:
-        ET_matrix = csr_matrix(np.delete(ET_matrix, np.array(emtpy_indices), axis=1))
-        N_indices = np.delete(N_indices, np.array(emtpy_indices), axis=0)
-    else:
-        ET_matrix = csr_matrix(ET_matrix)
+        ET_matrix, N_indices = _create_ET_matrices(indices_S_i, indices_A_j, ET_dict,
+                                                   indptr_S_k, indptr_S_l,
+                                                   indptr_A_k, indptr_A_l,
+                                                   indices_S_k, indices_S_l,
+                                                   indices_A_k, indices_A_l,
+                                                   dists_S_k, dists_S_l,
+                                                   dists_A_k, dists_A_l,
+                                                   sensitizer_states, activator_states)
+        # clean emtpy columns in the matrix due to energy migration
+        ET_matrix = ET_matrix.toarray()
+        emtpy_indices = [ind for ind in range(N_indices.shape[0])
+                         if np.allclose(ET_matrix[:,ind], 0)]
+        if emtpy_indices:
+            ET_matrix = csr_matrix(np.delete(ET_matrix, np.array(emtpy_indices), axis=1))
+            N_indices = np.delete(N_indices, np.array(emtpy_indices), axis=0)
+        else:
+            ET_matrix = csr_matrix(ET_matrix)
 
-    jac_indices = _calculate_jac_matrices(N_indices)
-    logger.info('Number of interactions: %d.', N_indices.shape[0])
+        jac_indices = _calculate_jac_matrices(N_indices)
+        logger.info('Number of interactions: %d.', N_indices.shape[0])
 
     coop_ET_matrix = csr_matrix(np.zeros((num_energy_states, 0), dtype=np.float64))
     coop_N_indices = np.column_stack((np.array([], dtype=np.uint32),
@@ -1034,6 +1363,8 @@ def setup_average_eqs(cte: settings.Settings, gen_lattice: bool = False, full_pa
 #    logger.info('Cooperative energy transfer matrices...')
 #    (coop_ET_matrix,
 #     coop_N_indices) = _create_coop_ET_matrices(indices_S_i, indices_A_j, ET_dict,
+#                                                indptr_S_k, indptr_S_l,
+#                                                indptr_A_k, indptr_A_l,
 #                                                indices_S_k, indices_S_l,
 #                                                indices_A_k, indices_A_l,
 #                                                dists_S_k, dists_S_l,
@@ -1051,6 +1382,50 @@ def setup_average_eqs(cte: settings.Settings, gen_lattice: bool = False, full_pa
             coop_ET_matrix, coop_N_indices, coop_jac_indices)
 
 
+class IncrementalEqs():
+    '''Equations of a setup where only the power density of the excitations changes.
+        The power-independent matrices (decay, ET, cooperative and the jacobian indices)
+        are calculated once. The absorption matrix is rebuilt from the cached
+        absorption matrices of each active excitation at 1 W/cm2.
+    '''
+    def __init__(self, cte: settings.Settings, equations: Tuple) -> None:
+        '''equations are the values returned by setup_microscopic_eqs or
+            setup_average_eqs except the cte.'''
+        (self.initial_population, self.index_S_i, self.index_A_j,
+         _, *self.other_matrices) = equations
+
+        self.num_energy_states = cte.states['energy_states']
+        self.unit_abs_matrices = _create_unit_absorption_matrices(cte.states['sensitizer_states'],
+                                                                  cte.states['activator_states'],
+                                                                  cte.excitations,
+                                                                  self.index_S_i, self.index_A_j)
+
+    def equations(self, excitations_dict: Dict) -> Tuple:
+        '''Returns the equations (all values of the setup functions except the cte)
+            for the power densities of excitations_dict.
+            The active excitations must be the same ones used to create the instance.
+        '''
+        total_abs_matrix = _scale_absorption_matrices(self.unit_abs_matrices,
+                                                      self.num_energy_states, excitations_dict)
+        return (self.initial_population, self.index_S_i, self.index_A_j,
+                total_abs_matrix, *self.other_matrices)
+
+
+def setup_incremental_eqs(cte: settings.Settings, average: bool = False,
+                          gen_lattice: bool = False, full_path: str = None
+                         ) -> Tuple[settings.Settings, IncrementalEqs]:
+    '''Setups the microscopic (or average, if average=True) rate equations once and
+        returns the updated cte and an IncrementalEqs instance that
+        only rebuilds the absorption matrix when the power density changes.
+    '''
+    setup_func = setup_microscopic_eqs
+    if average:
+        setup_func = setup_average_eqs
+
+    (cte, *equations) = setup_func(cte, gen_lattice=gen_lattice, full_path=full_path)
+    return (cte, IncrementalEqs(cte, tuple(equations)))
+
+
 #if __name__ == "__main__":
 #    logger = logging.getLogger()
 #    logging.basicConfig(level=logging.INFO,
@@ -356,6 +356,31 @@ def _parse_simulation_params(settings: Settings) -> Dict:
     new_settings = dict(default_settings)
     new_settings.update(user_settings)
 
+    jacobian = new_settings.get('jacobian', 'dense')
+    if jacobian not in ('dense', 'sparse'):
+        msg = 'The jacobian in simulation_params must be "dense" or "sparse", not "{}".'
+        raise SettingsValueError(msg.format(jacobian))
+
+    backend = new_settings.get('backend', 'scipy')
+    if backend not in ('scipy', 'numba'):
+        msg = 'The backend in simulation_params must be "scipy" or "numba", not "{}".'
+        raise SettingsValueError(msg.format(backend))
+
+    steady_state = new_settings.get('steady_state', 'newton')
+    if steady_state not in ('newton', 'integrate'):
+        msg = 'The steady_state in simulation_params must be "newton" or "integrate", not "{}".'
+        raise SettingsValueError(msg.format(steady_state))
+
+    output = new_settings.get('output', 'full')
+    if output not in ('full', 'average'):
+        msg = 'The output in simulation_params must be "full" or "average", not "{}".'
+        raise SettingsValueError(msg.format(output))
+
+    compression = new_settings.get('compression', 'lzf')
+    if compression not in ('lzf', 'gzip', 'none'):
+        msg = 'The compression in simulation_params must be "lzf", "gzip" or "none", not "{}".'
+        raise SettingsValueError(msg.format(compression))
+
     return new_settings
 
 @log_exceptions_warnings
@@ -44,6 +44,7 @@ settings = {'version': Value(int, val_max=1, val_min=1),
                                   'radius' : Value(float, val_min=min_float, kind=Value.exclusive),
                                   'cif_file' : Value(str, kind=Kind.optional),
                                   'ion_sites' : Value(Dict[str, str], kind=Kind.optional),
+                                  'seed' : Value(int, val_min=0, kind=Kind.optional),
                                   }),
             'states': DictValue({'sensitizer_ion_label': str,
                                  'activator_ion_label': str,
@@ -82,7 +83,10 @@ settings = {'version': Value(int, val_max=1, val_min=1),
                                        'options': DictValue({'N_points': Value(int, kind=Value.optional),
                                                              'max_factor': Value(float, kind=Value.optional),
                                                              'min_factor': Value(float, kind=Value.optional),
-                                                             'tol': Value(float, kind=Value.optional)},
+                                                             'tol': Value(float, kind=Value.optional),
+                                                             'cache': Value(bool, kind=Value.optional),
+                                                             'max_evals': Value(int, val_min=1, kind=Value.optional),
+                                                             'prefit_factor': Value(float, val_min=1, kind=Value.optional)},
                                                          	 kind=Value.optional)},
                                       kind=Value.optional),
 
@@ -90,6 +94,14 @@ settings = {'version': Value(int, val_max=1, val_min=1),
                                             'atol': Value(float, kind=Value.optional),
                                             'N_steps_pulse': Value(int, kind=Value.optional),
                                             'N_steps': Value(int, kind=Value.optional),
+                                            'jacobian': Value(str, kind=Value.optional),
+                                            'backend': Value(str, kind=Value.optional),
+                                            'steady_state': Value(str, kind=Value.optional),
+                                            'output': Value(str, kind=Value.optional),
+                                            'compression': Value(str, kind=Value.optional),
+                                            'jobs': Value(int, val_min=1, kind=Value.optional),
+                                            'seed': Value(int, val_min=0, kind=Value.optional),
+                                            'lattice_cache_size': Value(float, val_min=0, kind=Value.optional),
                                            }, kind=Value.optional),
 
             'power_dependence': Value(List[float], len_min=3, len_max=3, kind=Value.optional),
@@ -6,12 +6,14 @@ Created on Mon Nov  9 14:22:41 2015
 """
 
 import time
-import csv
 import logging
 import warnings
 import os
-from typing import List, Tuple, Iterator, Sequence, cast, Callable, Any, Union
+from typing import List, Tuple, Iterator, Sequence, cast, Callable, Any, Union, Dict
 import copy
+import hashlib
+import multiprocessing
+import tempfile
 
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
@@ -20,6 +22,8 @@ import ruamel.yaml as yaml
 
 import numpy as np
 
+import scipy.sparse
+from scipy.sparse import csr_matrix
 import scipy.signal as signal
 import scipy.interpolate as interpolate
 from scipy import integrate
@@ -34,10 +38,338 @@ import simetuc.odesolver as odesolver
 import simetuc.plotter as plotter
 from simetuc.util import Conc, save_file_full_name
 from simetuc.util import cached_property, log_exceptions_warnings, disable_loggers, exp_to_10
+from simetuc.util import Profile, profiled, profile_phase
 import simetuc.settings as settings
 from simetuc.settings import Settings
 
 
+# the C YAML loader is much faster, if available
+_YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+
+# HDF5 filters of each compression option of the saved solutions
+_COMPRESSION_FILTERS = {'lzf': {'compression': 'lzf', 'shuffle': True},
+                        'gzip': {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+                        'none': {}}  # type: Dict[str, Dict]
+
+
+def _get_compression_filters(compression: str) -> Dict:
+    '''Returns the HDF5 filters of the compression option.'''
+    if compression not in _COMPRESSION_FILTERS:
+        msg = 'Wrong compression: {}. Use "lzf", "gzip" or "none".'
+        raise ValueError(msg.format(compression))
+    return _COMPRESSION_FILTERS[compression]
+
+
+def _get_chunk_shape(num_steps: int, num_states: int, chunk_size: float = 1e6) -> Tuple[int, int]:
+    '''Shape of the chunks of a num_steps x num_states dataset of about chunk_size bytes.'''
+    chunk_cols = max(1, min(num_states, 16384))
+    chunk_rows = max(1, min(num_steps, int(chunk_size//(8*chunk_cols))))
+    return chunk_rows, chunk_cols
+
+
+def _get_inputs_hash(equations: Tuple, *params: Any) -> str:
+    '''Hash of the rate equations and the parameters of the solver.
+        It identifies the simulation whose populations are streamed to a file.'''
+    sha = hashlib.sha1()
+    for value in list(equations) + list(params):
+        if value is None:
+            arrays = []  # type: List[np.array]
+        elif scipy.sparse.issparse(value):
+            value = csr_matrix(value)
+            arrays = [value.data, value.indices, value.indptr, np.array(value.shape)]
+        else:
+            arrays = [np.asarray(value)]
+        for arr in arrays:
+            sha.update(repr((arr.dtype.str, arr.shape)).encode())
+            sha.update(np.ascontiguousarray(arr).tobytes())
+    return sha.hexdigest()
+
+
+class SolutionWriter():
+    '''Writes the populations of a solution to a HDF5 file while they are being calculated,
+        it can be used as the output array of the ode solver.
+        The populations are buffered and appended in chunks to a resizable, compressed
+        y_sol dataset. Its num_steps attribute is the number of times that have been written,
+        so a simulation that was interrupted can continue from the last one (resume=True).
+        The file is only resumed if it has the same inputs_hash (see _get_inputs_hash),
+        otherwise it's overwritten.
+    '''
+    def __init__(self, full_path: str, t_sol: np.array, num_states: int,
+                 compression: str = 'lzf', resume: bool = False, inputs_hash: str = '') -> None:
+        self.full_path = full_path
+        self.t_sol = np.asarray(t_sol, dtype=np.float64)
+        self.num_states = num_states
+        self.inputs_hash = inputs_hash
+        # the solver writes its first time in this row
+        self.offset = 0
+
+        resume = resume and os.path.isfile(full_path) and h5py.is_hdf5(full_path)
+        self._file = h5py.File(full_path, 'a' if resume else 'w')
+        if resume and self._is_resumable():
+            self._dataset = self._file['y_sol']
+        else:
+            for name in list(self._file):
+                del self._file[name]
+            self._file.attrs['inputs_hash'] = inputs_hash
+            self._file.create_dataset('t_sol', data=self.t_sol)
+            chunks = _get_chunk_shape(len(self.t_sol), num_states)
+            self._dataset = self._file.create_dataset('y_sol', shape=(0, num_states),
+                                                      maxshape=(None, num_states),
+                                                      chunks=chunks, dtype=np.float64,
+                                                      **_get_compression_filters(compression))
+            self._dataset.attrs['num_steps'] = 0
+        # number of times whose populations are in the file
+        self.num_steps = int(self._dataset.attrs['num_steps'])
+
+        self._buffer = np.zeros((self._dataset.chunks[0], num_states), dtype=np.float64)
+        self._buffer_start = self.num_steps
+        self._buffer_len = 0
+
+    def _is_resumable(self) -> bool:
+        '''True if the file has the populations of the same simulation:
+            same inputs, times and number of states.'''
+        if 't_sol' not in self._file or 'y_sol' not in self._file:
+            return False
+        return (self._file.attrs.get('inputs_hash', None) == self.inputs_hash and
+                self._file['y_sol'].shape[1] == self.num_states and
+                self._file['t_sol'].shape == self.t_sol.shape and
+                np.array_equal(self._file['t_sol'][()], self.t_sol))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        '''Shape of the output of the solver, from the offset to the last time.'''
+        return (len(self.t_sol) - self.offset, self.num_states)
+
+    def last_populations(self) -> np.array:
+        '''Populations of the last time written to the file.'''
+        return self._dataset[self.num_steps-1, :]
+
+    def __setitem__(self, key: Union[int, Tuple], values: np.array) -> None:
+        '''Stores the populations of a time step, like y_arr[step, :] = values.'''
+        step = key[0] if isinstance(key, tuple) else key
+        row = self.offset + step
+        if row != self._buffer_start + self._buffer_len:
+            self.flush()
+            self._buffer_start = row
+        self._buffer[self._buffer_len] = values
+        self._buffer_len += 1
+        if self._buffer_len == self._buffer.shape[0]:
+            self.flush()
+
+    def flush(self) -> None:
+        '''Appends the buffered populations to the file.'''
+        if self._buffer_len:
+            end = self._buffer_start + self._buffer_len
+            if end > self._dataset.shape[0]:
+                self._dataset.resize(end, axis=0)
+            self._dataset[self._buffer_start:end, :] = self._buffer[:self._buffer_len]
+            self.num_steps = max(self.num_steps, end)
+            self._dataset.attrs['num_steps'] = self.num_steps
+            self._buffer_start = end
+            self._buffer_len = 0
+        self._file.flush()
+
+    def close(self) -> None:
+        '''Writes the remaining populations and closes the file.'''
+        if self._file:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self) -> 'SolutionWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def _write_solution(group: h5py.Group, sol: 'Solution', compression: str) -> None:
+    '''Writes the datasets of the solution to the HDF5 group or file.
+        The populations aren't written again if they were streamed to this group.'''
+    filters = _get_compression_filters(compression)
+    streamed_here = (isinstance(sol.y_sol, h5py.Dataset) and 'y_sol' in group and
+                     group['y_sol'] == sol.y_sol)
+    for name in ('t_sol', 'y_sol', 'y_sol_avg', 'index_S_i', 'index_A_j'):
+        if name in group and not (name == 'y_sol' and streamed_here):
+            del group[name]
+
+    group.create_dataset("t_sol", data=sol.t_sol, **filters)
+    if isinstance(sol.y_sol, h5py.Dataset):
+        if not streamed_here:
+            group.copy(sol.y_sol, 'y_sol')
+    else:
+        chunks = _get_chunk_shape(*sol.y_sol.shape) if sol.y_sol.size else None
+        group.create_dataset("y_sol", data=sol.y_sol, chunks=chunks, **filters)
+    group.create_dataset("y_sol_avg", data=sol.list_avg_data, **filters)
+    group.create_dataset("index_S_i", data=sol.index_S_i, **filters)
+    group.create_dataset("index_A_j", data=sol.index_A_j, **filters)
+    _write_profile(group, sol)
+
+
+def _write_profile(group: h5py.Group, sol: Union['Solution', 'SolutionList']) -> None:
+    '''Writes the total time and the profile of the solution as attributes of the group.'''
+    for key in [key for key in group.attrs if key.startswith('profile_')]:
+        del group.attrs[key]
+    group.attrs['time'] = sol.time
+    for key, value in sol.profile.to_attrs().items():
+        group.attrs[key] = value
+
+
+def _load_profile(group: h5py.Group, sol: Union['Solution', 'SolutionList']) -> None:
+    '''Reads the total time and the profile of the solution, if they were saved.'''
+    sol.time = float(group.attrs.get('time', 0.0))
+    sol.profile = Profile.from_attrs(group.attrs)
+
+
+def _load_settings(cte_text: str, parsed_configs: Dict[str, Settings]) -> Settings:
+    '''Deserializes the settings of a saved solution.
+        Each config file is only parsed once, parsed_configs has the settings of each one.'''
+    with warnings.catch_warnings():
+        # the C loader warns about floats like 1e-08 (valid in YAML 1.2)
+        warnings.simplefilter('ignore')
+        cte_dict = yaml.load(cte_text, Loader=_YAML_LOADER)
+    config_file = cte_dict['config_file']
+    if config_file not in parsed_configs:
+        parsed_configs[config_file] = settings.load_from_text(config_file)
+    cte = copy.deepcopy(parsed_configs[config_file])
+    for key, value in cte_dict.items():
+        cte[key] = value
+    return cte
+
+
+def _load_solution(group: h5py.Group, sol_class: type, parsed_configs: Dict[str, Settings],
+                   average: bool = False, lazy: bool = False) -> 'Solution':
+    '''Loads a solution of type sol_class from the HDF5 group or file.
+        The average populations are read from the file if they were saved.'''
+    t_sol = np.array(group['t_sol'])
+    y_sol = group['y_sol'] if lazy else np.array(group['y_sol'])
+    index_S_i = list(np.array(group['index_S_i']).flatten())
+    index_A_j = list(np.array(group['index_A_j']).flatten())
+    cte = _load_settings(group.attrs['cte'], parsed_configs)
+
+    sol = sol_class(t_sol, y_sol, index_S_i, index_A_j, cte, average=average)
+    if 'y_sol_avg' in group:
+        sol.list_avg_data = list(np.array(group['y_sol_avg']))
+    _load_profile(group, sol)
+    return sol
+
+
+# normalized experimental data, keyed by (path, filter_window), with the mtime and size of the file
+_exp_data_cache = {}  # type: Dict[Tuple[str, int], Tuple[int, int, np.array]]
+# contents of the compiled experimental data files, keyed by path, with their mtime
+_compiled_exp_data_cache = {}  # type: Dict[str, Tuple[int, Dict[str, Tuple[np.array, int, int, int]]]]
+COMPILED_EXP_DATA_FILENAME = 'exp_data.hdf5'
+
+
+def _get_exp_data_folder(lattice_name: str) -> str:
+    '''Returns the folder with the experimental data of the lattice, or None if there isn't one.'''
+    if os.path.isdir("expData"):  # pragma: no cover
+        return os.path.join('expData', lattice_name)
+    elif os.path.isdir(os.path.join('simetuc', 'expData')):
+        return os.path.join('simetuc', 'expData', lattice_name)
+    return None
+
+
+def _read_exp_data(path: str) -> np.array:
+    '''Reads two columns of numbers separated by spaces, tabs, commas or semicolons.
+        Empty lines, comments and rows without two columns are ignored.
+        Raises ValueError if there's no valid data.'''
+    with open(path, 'rt') as file:
+        text = file.read().replace(',', ' ').replace(';', ' ')
+    lines = text.splitlines()
+    # fast path: convert all numbers at once if every line has two of them
+    try:
+        data = np.array(text.split(), dtype=np.float64)
+    except ValueError:
+        pass
+    else:
+        if data.size and data.size == 2*sum(1 for line in lines if line.strip()):
+            return data.reshape(-1, 2)
+    data = np.array([row for row in (line.split() for line in lines)
+                     if len(row) == 2 and not row[0].startswith('#')],
+                    dtype=np.float64)
+    if len(data.shape) != 2 or data.shape[1] != 2:
+        raise ValueError('Invalid experimental data.')
+    return data
+
+
+def _normalize_exp_data(data: np.array, filter_window: int = 35) -> np.array:
+    '''Normalizes the intensity of the data to the smoothed average maximum.'''
+    # smooth the data to get an "average" of the maximum
+    smooth_data = signal.savgol_filter(data[:, 1], filter_window, 5, mode='nearest')
+    smooth_data = smooth_data.clip(min=0)
+
+    # average maximum
+    max_point = np.where(smooth_data == np.max(smooth_data))[0][0]
+    # average over 0.5% of points around max_point
+    delta = int(0.005*len(smooth_data))
+    delta = delta if delta > 1 else 1  # at least 1 point
+    if max_point == 0:
+        avg_max = np.max(smooth_data)
+    elif max_point > delta//2:
+        avg_max = np.mean(smooth_data[max_point-delta//2:max_point+delta//2])
+    else:
+        avg_max = np.mean(smooth_data[:max_point+delta//2])
+    # normalize data
+    data[:, 1] = (data[:, 1]-np.min(smooth_data))/(avg_max-np.min(smooth_data))
+    # set negative values to zero
+    data = data.clip(min=0)
+    return data
+
+
+def _get_compiled_exp_data(folder: str) -> Dict[str, Tuple[np.array, int, int, int]]:
+    '''Returns the contents of the compiled experimental data file of the folder:
+        the normalized data, mtime, size and filter window of each original file.
+        The file is only read again if it changes.'''
+    path = os.path.abspath(os.path.join(folder, COMPILED_EXP_DATA_FILENAME))
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if path not in _compiled_exp_data_cache or _compiled_exp_data_cache[path][0] != mtime:
+        contents = {}
+        with h5py.File(path, 'r') as file:
+            for filename, dataset in file.items():
+                data = np.array(dataset)
+                data.flags.writeable = False
+                contents[filename] = (data, int(dataset.attrs['mtime']),
+                                      int(dataset.attrs['size']), int(dataset.attrs['filter_window']))
+        _compiled_exp_data_cache[path] = (mtime, contents)
+    return _compiled_exp_data_cache[path][1]
+
+
+def compile_exp_data(lattice_name: str, filter_window: int = 35) -> str:
+    '''Reads and normalizes all experimental data files of the lattice
+        and saves them to a single binary file in the same folder.
+        DynamicsSolution uses it instead of the text files that haven't changed since.
+        Returns the path of the compiled file.'''
+    logger = logging.getLogger(__name__)
+    folder = _get_exp_data_folder(lattice_name)
+    if folder is None or not os.path.isdir(folder):
+        raise FileNotFoundError('No experimental data folder for lattice "{}".'.format(lattice_name))
+
+    path = os.path.join(folder, COMPILED_EXP_DATA_FILENAME)
+    temp_path = path + '.tmp'
+    with h5py.File(temp_path, 'w') as file:
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith('.txt'):
+                continue
+            file_path = os.path.join(folder, filename)
+            stat = os.stat(file_path)
+            try:
+                data = _normalize_exp_data(_read_exp_data(file_path), filter_window)
+            except ValueError:
+                warnings.warn('Invalid experimental data in' +
+                              ' file "{}", it will be ignored.'.format(filename))
+                continue
+            dataset = file.create_dataset(filename, data=data)
+            dataset.attrs['mtime'] = stat.st_mtime_ns
+            dataset.attrs['size'] = stat.st_size
+            dataset.attrs['filter_window'] = filter_window
+    os.replace(temp_path, path)
+    logger.info('Experimental data of %s compiled to %s.', lattice_name, path)
+    return path
+
+
 class Solution():
     '''Base class for solutions of rate equation problems'''
 
@@ -63,6 +395,11 @@ class Solution():
 
         # total time for the simulation of this solution
         self.time = 0.0
+        # time of each phase, ode solver statistics and peak memory
+        self.profile = Profile()
+
+        # open HDF5 file that y_sol reads from, if any (see close)
+        self._file = None  # type: h5py.File
 
         # The first is the sim color, the second the exp data color.
         self.cte['colors'] = 'bk' if average else 'rk'
@@ -70,6 +407,19 @@ class Solution():
         # prefix for the name of the saved files
         self._prefix = 'solution'
 
+    def close(self) -> None:
+        '''Closes the HDF5 file that y_sol reads from, if any.
+            After that y_sol can't be read anymore.'''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> 'Solution':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
     def __bool__(self) -> bool:
         '''Instance is True if all its data structures have been filled out'''
         return (self.t_sol.size != 0 and self.y_sol.size != 0 and bool(self.cte) and
@@ -99,33 +449,10 @@ class Solution():
 
     def _calculate_avg_populations(self) -> List[np.array]:
         '''Returs the average populations of each state. First S then A states.'''
-        cte = self.cte
-        index_S_i = self.index_S_i
-        index_A_j = self.index_A_j
-        y_sol = self.y_sol
-
-        # average population of the ground and excited states of S
-        if cte.ions['sensitizers'] is not 0:
-            sim_data_Sensitizer = []
-            for state in range(cte.states['sensitizer_states']):
-                population = np.sum([y_sol[:, index_S_i[i]+state]
-                                     for i in range(cte.ions['total'])
-                                     if index_S_i[i] != -1], 0)/cte.ions['sensitizers']
-                sim_data_Sensitizer.append(population.clip(0).reshape((y_sol.shape[0],)))
-        else:
-            sim_data_Sensitizer = cte.states['sensitizer_states']*[np.zeros((y_sol.shape[0],))]
-        # average population of the ground and excited states of A
-        if cte.ions['activators'] is not 0:
-            sim_data_Activator = []
-            for state in range(cte.states['activator_states']):
-                population = np.sum([y_sol[:, index_A_j[i]+state]
-                                     for i in range(cte.ions['total'])
-                                     if index_A_j[i] != -1], 0)/cte.ions['activators']
-                sim_data_Activator.append(population.clip(0).reshape((y_sol.shape[0],)))
-        else:
-            sim_data_Activator = cte.states['activator_states']*[np.zeros((y_sol.shape[0],))]
-
-        return sim_data_Sensitizer + sim_data_Activator
+        populations = precalculate.average_populations(self.y_sol, self.index_S_i, self.index_A_j,
+                                                       self.cte.states['sensitizer_states'],
+                                                       self.cte.states['activator_states'])
+        return list(populations.clip(0))
 
     def _get_ion_state_labels(self) -> List[str]:
         '''Returns a list of ion_state labels'''
@@ -224,21 +551,41 @@ class Solution():
             msg = 'The selected state does not exist!'
             raise ValueError(msg)
 
-    def save(self, full_path: str = None) -> None:
-        '''Save data to disk as a HDF5 file'''
+    def save(self, full_path: str = None, compression: str = None) -> None:
+        '''Save data to disk as a HDF5 file.
+            compression can be 'lzf', 'gzip' (level 1) or 'none',
+            by default simulation_params['compression'] or 'lzf'.
+            If the populations were streamed to full_path they aren't written again.
+        '''
         logger = logging.getLogger(__name__)
         if full_path is None:  # pragma: no cover
             full_path = save_file_full_name(self.cte.lattice, self._prefix) + '.hdf5'
+        if compression is None:
+            compression = self.cte.get('simulation_params', {}).get('compression', 'lzf')
         logger.info('Saving solution to {}.'.format(full_path))
-        with h5py.File(full_path, 'w') as file:
-            file.create_dataset("t_sol", data=self.t_sol, compression='gzip')
-            file.create_dataset("y_sol", data=self.y_sol, compression='gzip')
-            file.create_dataset("y_sol_avg", data=self.list_avg_data, compression='gzip')
-            file.create_dataset("index_S_i", data=self.index_S_i, compression='gzip')
-            file.create_dataset("index_A_j", data=self.index_A_j, compression='gzip')
-            file.attrs['config_file'] = self.cte['config_file']
-            # serialize cte
-            file.attrs['cte'] = yaml.dump(self.cte.settings)
+        if self._is_streamed_to(full_path):
+            # reopen the populations after adding the rest of the data
+            self.close()
+            with h5py.File(full_path, 'a') as file:
+                self.y_sol = file['y_sol']
+                self._save(file, compression)
+            self._file = h5py.File(full_path, 'r')
+            self.y_sol = self._file['y_sol']
+        else:
+            with h5py.File(full_path, 'w') as file:
+                self._save(file, compression)
+
+    def _is_streamed_to(self, full_path: str) -> bool:
+        '''True if the populations are stored in the file full_path.'''
+        return (isinstance(self.y_sol, h5py.Dataset) and
+                os.path.abspath(self.y_sol.file.filename) == os.path.abspath(full_path))
+
+    def _save(self, file: h5py.File, compression: str) -> None:
+        '''Writes all data to the open file.'''
+        _write_solution(file, self, compression)
+        file.attrs['config_file'] = self.cte['config_file']
+        # serialize cte
+        file.attrs['cte'] = yaml.dump(self.cte.settings)
 
     def save_txt(self, full_path: str = None, mode: str = 'wt', cmd : str = '') -> None:  # pragma: no cover
         '''Save the settings, the time and the average populations to disk as a textfile'''
@@ -264,27 +611,31 @@ class Solution():
 
     @classmethod
     @log_exceptions_warnings
-    def load(cls, full_path: str) -> 'Solution':
-        '''Load data from a HDF5 file'''
+    def load(cls, full_path: str, lazy: bool = False) -> 'Solution':
+        '''Load data from a HDF5 file.
+            If lazy is True, y_sol is a read-only view of the dataset in the file,
+            which is kept open until the solution is closed (see close),
+            and its values are only read when they are needed.
+        '''
         logger = logging.getLogger(__name__)
         logger.info('Loading solution from {}.'.format(full_path))
         try:
-            with h5py.File(full_path, 'r') as file:
-                t_sol = np.array(file['t_sol'])
-                y_sol = np.array(file['y_sol'])
-                index_S_i = list(file['index_S_i'])
-                index_A_j = list(file['index_A_j'])
-                # deserialze cte
-                cte_dict = yaml.load(file.attrs['cte'], Loader=yaml.Loader)
-                cte = settings.load_from_text(cte_dict['config_file'])
-                for key, value in cte_dict.items():
-                    cte[key] = value
-
-            return cls(t_sol, y_sol, index_S_i, index_A_j, cte)
+            file = h5py.File(full_path, 'r')
         except OSError as err:
             msg = 'File not found! ({})'.format(full_path)
             raise OSError(msg) from err
 
+        try:
+            sol = _load_solution(file, cls, {}, lazy=lazy)
+        except Exception:
+            file.close()
+            raise
+        if lazy:
+            sol._file = file
+        else:
+            file.close()
+        return sol
+
 
 class SteadyStateSolution(Solution):
     '''Class representing the solution to a steady state problem'''
@@ -317,6 +668,24 @@ class SteadyStateSolution(Solution):
         # if empty, calculate
         return self._calculate_final_populations()
 
+    def _plot_avg(self) -> None:
+        '''Overrides the Solution method to plot the steady state populations of
+            each state as bars, the solution may only have the initial and final times.
+        '''
+        title = '{}: {}% {}, {}% {}. P={} W/cm²'.format(self.cte.lattice['name'],
+                self.concentration.S_conc, self.cte.states['sensitizer_ion_label'],
+                self.concentration.A_conc, self.cte.states['activator_ion_label'],
+                exp_to_10(self.power_dens))
+        index_GS_S = 0
+        index_GS_A = self.cte.states['sensitizer_states']
+        # exclude the ground states from the plot
+        populations = [elem for num, elem in enumerate(self.steady_state_populations)
+                       if num not in {index_GS_S, index_GS_A}]
+        list_labels = [elem for num, elem in enumerate(self.state_labels)
+                       if num not in {index_GS_S, index_GS_A}]
+        plotter.plot_steady_state_populations(populations, list_labels,
+                                              colors=self.cte['colors'], title=title)
+
     def log_populations(self) -> None:
         '''Log the steady state populations'''
         logger = logging.getLogger(__name__)
@@ -345,6 +714,11 @@ class DynamicsSolution(Solution):
 
         self._errors = np.array([])
 
+        # populations of the states of selected ions and linear projections of all populations
+        # that were calculated while solving (see Simulations.simulate_dynamics)
+        self.ion_populations = {}  # type: Dict[int, np.array]
+        self.projected_data = np.array([])
+
         # prefix for the name of the saved files
         self._prefix = 'dynamics'
 
@@ -353,72 +727,49 @@ class DynamicsSolution(Solution):
     @log_exceptions_warnings
     def _load_exp_data(filename: str, lattice_name: str, filter_window: int = 35) -> np.array:
         '''Load the experimental data from the expData/lattice_name folder.
-           Two columns of numbers: first is time (seconds), second intensity
+           Two columns of numbers: first is time (seconds), second intensity.
+           The normalized data is cached until the file changes,
+           and read from the compiled file of the folder if it's up to date (see compile_exp_data).
         '''
         logger = logging.getLogger(__name__)
 
-        # use absolute path from here
-        if os.path.isdir("expData"):  # pragma: no cover
-            path = os.path.join('expData', lattice_name, filename)
-        elif os.path.isdir(os.path.join('simetuc', 'expData')):
-            path = os.path.join(os.path.join('simetuc', 'expData'), lattice_name, filename)
-        else:
+        folder = _get_exp_data_folder(lattice_name)
+        if folder is None:
             return None
+        path = os.path.join(folder, filename)
 
         logger.debug('Trying to read experimental data file: %s', filename)
 
-        delimiters = [' ', '\t', ',', ';']
-        for delim in delimiters:
-            try:
-                with open(path, 'rt') as file:
-                    try:  # TODO: get a better way to read data, PANDAS?
-                        #  data = np.loadtxt(path, usecols=(0, 1)) # 10x slower
-                        csv_data = csv.reader(file, delimiter=delim)
-                        # ignore emtpy lines and comments
-                        data = np.array([row for row in csv_data
-                                         if len(row) == 2 and not row[0].startswith('#')],
-                                        dtype=np.float64)
-
-                        # if data isn't right, retry with a different delimiter
-                        if (not isinstance(data, np.ndarray) or
-                                len(data.shape) != 2 or data.shape[1] != 2):
-                            raise ValueError
-                    except ValueError:  # pragma: no cover
-                        continue
-                    else:  # success
-                        break
-            except FileNotFoundError:
-                # exp data doesn't exist. not a problem.
-                logger.debug('File not found.')
-                return None
-
-        # make sure data is valid
-        if not isinstance(data, np.ndarray) or len(data.shape) != 2 or data.shape[1] != 2:
-            warnings.warn('Invalid experimental data in' +
-                          ' file "{}", it will be ignored.'.format(filename))
+        compiled = _get_compiled_exp_data(folder).get(filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if compiled is not None and compiled[3] == filter_window:
+                return compiled[0]
+            # exp data doesn't exist. not a problem.
+            logger.debug('File not found.')
             return None
 
-        logger.debug('Experimental data succesfully read.')
-
-        # smooth the data to get an "average" of the maximum
-        smooth_data = signal.savgol_filter(data[:, 1], filter_window, 5, mode='nearest')
-        smooth_data = smooth_data.clip(min=0)
-
-        # average maximum
-        max_point = np.where(smooth_data == np.max(smooth_data))[0][0]
-        # average over 0.5% of points around max_point
-        delta = int(0.005*len(smooth_data))
-        delta = delta if delta > 1 else 1  # at least 1 point
-        if max_point == 0:
-            avg_max = np.max(smooth_data)
-        elif max_point > delta//2:
-            avg_max = np.mean(smooth_data[max_point-delta//2:max_point+delta//2])
+        # the data is only read and normalized again if the file changes
+        key = (os.path.abspath(path), filter_window)
+        if key in _exp_data_cache and _exp_data_cache[key][:2] == (stat.st_mtime_ns, stat.st_size):
+            return _exp_data_cache[key][2]
+
+        if compiled is not None and compiled[1:] == (stat.st_mtime_ns, stat.st_size, filter_window):
+            data = compiled[0]
         else:
-            avg_max = np.mean(smooth_data[:max_point+delta//2])
-        # normalize data
-        data[:, 1] = (data[:, 1]-np.min(smooth_data))/(avg_max-np.min(smooth_data))
-        # set negative values to zero
-        data = data.clip(min=0)
+            try:
+                data = _read_exp_data(path)
+            except ValueError:
+                warnings.warn('Invalid experimental data in' +
+                              ' file "{}", it will be ignored.'.format(filename))
+                return None
+            logger.debug('Experimental data succesfully read.')
+            data = _normalize_exp_data(data, filter_window)
+            # the cached data is shared by all solutions
+            data.flags.writeable = False
+
+        _exp_data_cache[key] = (stat.st_mtime_ns, stat.st_size, data)
         return data
 
     @staticmethod
@@ -581,13 +932,14 @@ class DynamicsSolution(Solution):
             decay curves.'''
         t_sol = self.t_sol
         y_steady = np.array([integrate.cumtrapz(y_state, x=t_sol, initial=0)
-                             for y_state in self.y_sol.T]).T
+                             for y_state in np.asarray(self.y_sol).T]).T
 
         # store solution and settings
         steady_sol = SteadyStateSolution(self.t_sol, y_steady,
                                          self.index_S_i, self.index_A_j,
                                          self.cte, average=self.average)
         steady_sol.time = self.time
+        steady_sol.profile = Profile.merged([self.profile])
         return steady_sol
 
     def log_errors(self) -> None:
@@ -675,6 +1027,26 @@ class SolutionList(Sequence[Solution]):
 
         # total time for the simulation of all solutions
         self.time = 0.0
+        # profiles of all solutions merged with that of the simulation of the list
+        self.profile = Profile()
+
+        # open HDF5 file shared by the solutions of a lazy list (see close)
+        self._file = None  # type: h5py.File
+
+    def close(self) -> None:
+        '''Closes the HDF5 file shared by the solutions of a lazy list, and those of the
+            solutions themselves. After that their y_sol can't be read anymore.'''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for sol in self:
+            sol.close()
+
+    def __enter__(self) -> 'SolutionList':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
 
     def __bool__(self) -> bool:
         '''Instance is True if its list is not emtpy.'''
@@ -714,59 +1086,70 @@ class SolutionList(Sequence[Solution]):
         if sol_list:
             self.solution_list.extend(list(sol_list))
             self.average = self.solution_list[0].average
+            for sol in sol_list:
+                self.profile.merge(sol.profile)
 
-    def save(self, full_path: str = None) -> None:
-        '''Save all data from all solutions in a HDF5 file'''
+    def save(self, full_path: str = None, compression: str = None) -> None:
+        '''Save all data from all solutions in a HDF5 file.
+            compression can be 'lzf', 'gzip' (level 1) or 'none',
+            by default simulation_params['compression'] or 'lzf'.
+        '''
         logger = logging.getLogger(__name__)
         if full_path is None:  # pragma: no cover
             full_path = save_file_full_name(self[0].cte.lattice, self._prefix) + '.hdf5'
+        if compression is None:
+            compression = self[0].cte.get('simulation_params', {}).get('compression', 'lzf')
 
         logger.info('Saving solution to {}.'.format(full_path))
         with h5py.File(full_path, 'w') as file:
             for num, sol in enumerate(self):
                 group = file.create_group(str(num))
-                group.create_dataset("t_sol", data=sol.t_sol, compression='gzip')
-                group.create_dataset("y_sol", data=sol.y_sol, compression='gzip')
-                group.create_dataset("y_sol_avg", data=sol.list_avg_data, compression='gzip')
-                group.create_dataset("index_S_i", data=sol.index_S_i, compression='gzip')
-                group.create_dataset("index_A_j", data=sol.index_A_j, compression='gzip')
+                _write_solution(group, sol, compression)
                 # serialze cte as text and store it as an attribute
                 group.attrs['cte'] = yaml.dump(sol.cte.settings)
                 file.attrs['config_file'] = sol.cte['config_file']
                 file.attrs['average'] = self.average
                 file.attrs['dynamics'] = self.dynamics
+            _write_profile(file, self)
 
     @classmethod
     @log_exceptions_warnings
-    def load(cls, full_path: str) -> 'SolutionList':
-        '''Load data from a HDF5 file'''
+    def load(cls, full_path: str, lazy: bool = False) -> 'SolutionList':
+        '''Load data from a HDF5 file.
+            If lazy is True, the y_sol of each solution is a read-only view of its dataset
+            in the file, which is kept open until the list is closed (see close),
+            and its values are only read when needed.
+        '''
         solutions = []
         try:
-            with h5py.File(full_path, 'r') as file:
-                average = file.attrs['average']
-                dynamics = file.attrs['dynamics']
-                if dynamics:
-                    sol_list = cls(dynamics)  # type: ignore
-                else:
-                    sol_list = cls()
-                sol_list.dynamics = dynamics
-                for group_num in file:
-                    group = file[group_num]
-                    # deserialze cte
-                    cte_dict = yaml.load(group.attrs['cte'], Loader=yaml.Loader)
-                    cte = settings.load_from_text(cte_dict['config_file'])
-                    for key, value in cte_dict.items():
-                        cte[key] = value
-                    # create appropiate object
-                    index_S_i = list(np.array(group['index_S_i']).flatten())
-                    index_A_j = list(np.array(group['index_A_j']).flatten())
-                    sol = sol_list._items_class(np.array(group['t_sol']), np.array(group['y_sol']),
-                                                index_S_i, index_A_j, cte, average=average)
-                    solutions.append(sol)
+            file = h5py.File(full_path, 'r')
         except OSError as err:
             msg = 'File not found! ({})'.format(full_path)
             raise OSError(msg) from err
-        sol_list.add_solutions(solutions)
+
+        try:
+            average = file.attrs['average']
+            dynamics = file.attrs['dynamics']
+            if dynamics:
+                sol_list = cls(dynamics)  # type: ignore
+            else:
+                sol_list = cls()
+            sol_list.dynamics = dynamics
+            # settings parsed from each config file, shared by all its solutions
+            parsed_configs = {}  # type: Dict[str, Settings]
+            for group_num in file:
+                solutions.append(_load_solution(file[group_num], sol_list._items_class,
+                                                parsed_configs, average=average, lazy=lazy))
+            sol_list.add_solutions(solutions)
+            # the saved profile already includes those of the solutions
+            _load_profile(file, sol_list)
+        except Exception:
+            file.close()
+            raise
+        if lazy:
+            sol_list._file = file
+        else:
+            file.close()
         return sol_list
 
     def save_txt(self, full_path: str = None, mode: str = 'w', cmd : str = '') -> None:
@@ -1042,6 +1425,68 @@ class ConcentrationDependenceSolution(SolutionList):
             self._plot_steady()
 
 
+# state of each worker process of the parallel power dependence
+_power_dep_worker_state = {}  # type: Dict
+
+
+def _init_power_dep_worker(sim: 'Simulations', incremental_eqs: precalculate.IncrementalEqs,
+                           average: bool) -> None:
+    '''Stores the simulation and the shared equations in the worker process.'''
+    _power_dep_worker_state['sim'] = sim
+    _power_dep_worker_state['incremental_eqs'] = incremental_eqs
+    _power_dep_worker_state['average'] = average
+
+
+def _power_dep_worker(power_dens: float) -> SteadyStateSolution:
+    '''Simulate the steady state of a single power density in a worker process.'''
+    sim = _power_dep_worker_state['sim']
+    incremental_eqs = _power_dep_worker_state['incremental_eqs']
+    average = _power_dep_worker_state['average']
+
+    sim._set_power_dens(power_dens)
+    with disable_loggers([__name__+'.steady_state', __name__+'.dynamics',
+                          'simetuc.precalculate', 'simetuc.lattice']):
+        equations = incremental_eqs.equations(sim.cte.excitations)
+        return sim.simulate_steady_state(average=average, equations=equations)
+
+
+# state of each worker process of the parallel sampling
+_sample_worker_state = {}  # type: Dict
+
+
+def _init_sample_worker(simulation_fun: Callable, folder: str,
+                        args: Tuple, kwargs: Dict) -> None:
+    '''Stores the sampled function, its arguments and the lattice folder in the worker process.'''
+    _sample_worker_state['simulation_fun'] = simulation_fun
+    _sample_worker_state['folder'] = folder
+    _sample_worker_state['args'] = args
+    _sample_worker_state['kwargs'] = kwargs
+
+
+def _get_lattice_seed(seed_seq: np.random.SeedSequence) -> int:
+    '''Seed of the lattice of a sample, derived from its random stream.'''
+    return int(seed_seq.generate_state(1, dtype=np.uint64)[0])
+
+
+def _sample_worker(sample: Tuple[int, np.random.SeedSequence]) -> Tuple[int, Solution]:
+    '''Simulate a single sample in a worker process.
+        Each sample generates its lattice with its own random stream in its own file.'''
+    index, seed_seq = sample
+    simulation_fun = _sample_worker_state['simulation_fun']
+    sim = simulation_fun.__self__
+    sim.full_path = os.path.join(_sample_worker_state['folder'], 'sample_{}.hdf5'.format(index))
+
+    sim.cte.lattice['seed'] = _get_lattice_seed(seed_seq)
+    with disable_loggers([__name__+'.dynamics', __name__+'.steady_state',
+                          __name__ + '.concentration_dependence',
+                          'simetuc.precalculate', 'simetuc.lattice']):
+        sol = simulation_fun(*_sample_worker_state['args'], **_sample_worker_state['kwargs'])
+
+    if os.path.exists(sim.full_path):
+        os.remove(sim.full_path)
+    return index, sol
+
+
 class Simulations():
     '''Setup and solve a dynamics or a steady state problem'''
 
@@ -1093,33 +1538,42 @@ class Simulations():
         return (15*np.max(precalculate.get_lifetimes(self.cte))).round(8)  # total simulation time
 
 #    @profile
-    def simulate_dynamics(self, average: bool = False) -> DynamicsSolution:
+    @profiled
+    def simulate_dynamics(self, average: bool = False, equations: Tuple = None,
+                          output: str = None, ions: List[int] = None,
+                          projection: Union[np.array, csr_matrix] = None,
+                          stream_to: str = None, resume: bool = False) -> DynamicsSolution:
         ''' Simulates the absorption, decay and energy transfer processes contained in cte
             Returns a DynamicsSolution instance
             average=True solves an average rate equation problem instead of the microscopic one.
+            equations are the already calculated matrices (see _setup_equations).
+            output='average' (by default simulation_params['output'] or 'full') only keeps
+            the average populations of each state while solving the microscopic equations,
+            the solution is then stored like that of the average equations.
+            The populations of the states of the ions with indices in ions are stored in
+            the ion_populations dictionary of the solution, and the product of the
+            projection matrix (one column per state) and the populations in projected_data.
+            If stream_to is a file path, the populations of the relaxation are written to that
+            HDF5 file while they are calculated and the solution reads them from there
+            (close the solution when it's no longer needed).
+            With resume=True, an interrupted simulation streamed to the same file continues
+            where it stopped, but only if the equations and solver parameters are the same.
         '''
         logger = logging.getLogger(__name__ + '.dynamics')
 
         start_time = time.time()
         logger.info('Starting simulation...')
 
-        setup_func = precalculate.setup_microscopic_eqs
-        if average:
-            setup_func = precalculate.setup_average_eqs
-
-        # regenerate the lattice even if it already exists?
-        gen_lattice = self.cte.get('gen_lattice', False)
-
         # get matrices of interaction, initial conditions, abs, decay, etc
-        (cte_updated, initial_population, index_S_i, index_A_j,
+        if equations is None:
+            # regenerate the lattice even if it already exists?
+            gen_lattice = self.cte.get('gen_lattice', False)
+            equations = self._setup_equations(average=average, gen_lattice=gen_lattice)
+        (initial_population, index_S_i, index_A_j,
          total_abs_matrix, decay_matrix,
          ET_matrix, N_indices, jac_indices,
          coop_ET_matrix, coop_N_indices,
-         coop_jac_indices) = setup_func(self.cte, full_path=self.full_path,
-                                        gen_lattice=gen_lattice)
-
-        # update cte
-        self.cte = cte_updated
+         coop_jac_indices) = equations
 
         # initial and final times for excitation and relaxation
         t0 = 0
@@ -1133,6 +1587,29 @@ class Simulations():
 
         rtol = self.cte.simulation_params['rtol']
         atol = self.cte.simulation_params['atol']
+        jacobian = self.cte.simulation_params.get('jacobian', 'dense')
+        backend = self.cte.simulation_params.get('backend', 'scipy')
+
+        if output is None:
+            output = self.cte.simulation_params.get('output', 'full')
+        if output not in ('full', 'average'):
+            raise ValueError('Wrong output: {}. Use "full" or "average".'.format(output))
+        reduce_output = output == 'average' and not average
+
+        # the selected ions and projection and, if reduced, the averages before them
+        num_states = initial_population.shape[0]
+        obs_matrix, ion_num_states = self._get_observables_matrix(index_S_i, index_A_j,
+                                                                  num_states, ions, projection)
+        solver_projection = None
+        if reduce_output:
+            num_avg_states = (self.cte.states['sensitizer_states'] +
+                              self.cte.states['activator_states'])
+            solver_projection = precalculate.create_averaging_matrix(
+                index_S_i, index_A_j, self.cte.states['sensitizer_states'],
+                self.cte.states['activator_states'], num_states)
+            if obs_matrix is not None:
+                solver_projection = scipy.sparse.vstack([solver_projection, obs_matrix],
+                                                        format='csr')
 
         start_time_ODE = time.time()
         logger.info('Solving equations...')
@@ -1145,19 +1622,55 @@ class Simulations():
             if excitation[0].active is True:
                 logger.info(exc_label)
         t_pulse = np.linspace(t0_p, tf_p, N_steps_pulse, dtype=np.float64)
-        y_pulse = odesolver.solve_pulse(t_pulse, initial_population.transpose(),
-                                        total_abs_matrix, decay_matrix,
-                                        ET_matrix, N_indices, jac_indices,
-                                        coop_ET_matrix, coop_N_indices, coop_jac_indices,
-                                        rtol=rtol, atol=atol, quiet=self.cte['no_console'])
+        with profile_phase('pulse'):
+            y_pulse = odesolver.solve_pulse(t_pulse, initial_population.transpose(),
+                                            total_abs_matrix, decay_matrix,
+                                            ET_matrix, N_indices, jac_indices,
+                                            coop_ET_matrix, coop_N_indices, coop_jac_indices,
+                                            rtol=rtol, atol=atol, quiet=self.cte['no_console'],
+                                            jacobian=jacobian, backend=backend)
 
         # relaxation
         logger.info('Solving relaxation...')
         t_sol = np.logspace(np.log10(t0_sol), np.log10(tf_sol), N_steps, dtype=np.float64)
-        y_sol = odesolver.solve_relax(t_sol, y_pulse[-1, :], decay_matrix,
-                                      ET_matrix, N_indices, jac_indices,
-                                      coop_ET_matrix, coop_N_indices, coop_jac_indices,
-                                      rtol=rtol, atol=atol, quiet=self.cte['no_console'])
+        t_relax, initial_relax = t_sol, y_pulse[-1, :]
+        writer = None
+        stream_file = None
+        if stream_to is not None:
+            num_outputs = num_states if solver_projection is None else solver_projection.shape[0]
+            compression = self.cte.simulation_params.get('compression', 'lzf')
+            inputs_hash = _get_inputs_hash(equations, solver_projection, t_pulse, rtol, atol)
+            # only the full populations can be used to continue an interrupted simulation
+            writer = SolutionWriter(stream_to, t_sol - t_sol[0], num_outputs,
+                                    compression=compression,
+                                    resume=resume and solver_projection is None,
+                                    inputs_hash=inputs_hash)
+            if writer.num_steps > 1:
+                logger.info('Resuming relaxation from time step %d.', writer.num_steps)
+                writer.offset = writer.num_steps - 1
+                t_relax, initial_relax = t_sol[writer.offset:], writer.last_populations()
+        with profile_phase('relaxation'):
+            y_sol = odesolver.solve_relax(t_relax, initial_relax, decay_matrix,
+                                          ET_matrix, N_indices, jac_indices,
+                                          coop_ET_matrix, coop_N_indices, coop_jac_indices,
+                                          rtol=rtol, atol=atol, quiet=self.cte['no_console'],
+                                          jacobian=jacobian, backend=backend,
+                                          projection=solver_projection, out=writer)
+        if writer is not None:
+            writer.close()
+            stream_file = h5py.File(stream_to, 'r')
+            y_sol = stream_file['y_sol']
+
+        with profile_phase('postprocessing'):
+            # split the averages and the observables
+            if reduce_output:
+                observables = y_sol[:, num_avg_states:]
+                y_sol = y_sol[:, :num_avg_states]
+                # store the averages like the solution of the average equations
+                index_S_i = [0, -1]
+                index_A_j = [-1, self.cte.states['sensitizer_states']]
+            elif obs_matrix is not None:
+                observables = obs_matrix.dot(np.asarray(y_sol).T).T
 
         formatted_time = time.strftime("%Mm %Ss", time.localtime(time.time()-start_time_ODE))
         logger.info('Equations solved! Total time: %s.', formatted_time)
@@ -1173,48 +1686,101 @@ class Simulations():
         dynamics_sol = DynamicsSolution(t_sol, y_sol, index_S_i, index_A_j,
                                         self.cte, average=average)
         dynamics_sol.time = total_time
+        if isinstance(dynamics_sol.y_sol, h5py.Dataset):
+            dynamics_sol._file = stream_file
+        elif stream_file is not None:
+            # the reduced populations were read into memory
+            stream_file.close()
+        if obs_matrix is not None:
+            first_col = 0
+            for ion, num in zip(ions or [], ion_num_states):
+                dynamics_sol.ion_populations[ion] = observables[:, first_col:first_col+num]
+                first_col += num
+            dynamics_sol.projected_data = observables[:, first_col:]
         return dynamics_sol
 
+    def _get_observables_matrix(self, index_S_i: List[int], index_A_j: List[int],
+                                num_states: int, ions: List[int] = None,
+                                projection: Union[np.array, csr_matrix] = None
+                               ) -> Tuple[csr_matrix, List[int]]:
+        '''Returns the sparse matrix that selects the states of the ions and applies
+            the projection to the populations (None if there's nothing to select)
+            and the number of states of each ion.
+        '''
+        if not ions and projection is None:
+            return None, []
+
+        rows = []  # type: List[csr_matrix]
+        num_ion_states = []  # type: List[int]
+        for ion in ions or []:
+            if not 0 <= ion < len(index_S_i):
+                raise ValueError('The ion {} does not exist!'.format(ion))
+            if index_S_i[ion] != -1:
+                first_state, num = index_S_i[ion], self.cte.states['sensitizer_states']
+            else:
+                first_state, num = index_A_j[ion], self.cte.states['activator_states']
+            rows.append(scipy.sparse.eye(num, num_states, k=first_state, format='csr'))
+            num_ion_states.append(num)
+        if projection is not None:
+            if projection.shape[1] != num_states:
+                msg = 'The projection must have {} columns, not {}.'
+                raise ValueError(msg.format(num_states, projection.shape[1]))
+            rows.append(csr_matrix(projection))
+        return scipy.sparse.vstack(rows, format='csr'), num_ion_states
+
+    def _setup_equations(self, average: bool = False, gen_lattice: bool = False) -> Tuple:
+        '''Calculates the matrices of interaction, initial conditions, abs, decay, etc
+            and updates the cte. Returns all values of the setup function except the cte.
+        '''
+        setup_func = precalculate.setup_microscopic_eqs
+        if average:
+            setup_func = precalculate.setup_average_eqs
+
+        (self.cte, *equations) = setup_func(self.cte, full_path=self.full_path,
+                                            gen_lattice=gen_lattice)
+        return tuple(equations)
+
     def simulate_avg_dynamics(self) -> DynamicsSolution:
         '''Simulates the dynamics of a average rate equations system,
             it calls simulate_dynamics
         '''
         return self.simulate_dynamics(average=True)
 
-    def simulate_steady_state(self, average: bool = False) -> SteadyStateSolution:
+    def simulate_steady_state(self, average: bool = False, equations: Tuple = None
+                             ) -> SteadyStateSolution:
         '''Check if active excitation(s) is pulsed, use simulate_pulsed_steady_state if so and
         simulate_steady_state if not.'''
         logger = logging.getLogger(__name__)
-        for excitation in self.cte.excitations.keys():
-            for exc in self.cte.excitations[excitation]:
-                if exc.active and exc.t_pulse is not None:
-                    logger.info('A pulsed excitation source is active.')
-                    return self.simulate_pulsed_steady_state(average=average)
-        return self.simulate_CW_steady_state(average=average)
-
-    def simulate_CW_steady_state(self, average: bool = False) -> SteadyStateSolution:
+        if self._is_pulsed():
+            logger.info('A pulsed excitation source is active.')
+            if equations is None:
+                return self.simulate_pulsed_steady_state(average=average)
+            return self.simulate_pulsed_steady_state(average=average, equations=equations)
+        if equations is None:
+            return self.simulate_CW_steady_state(average=average)
+        return self.simulate_CW_steady_state(average=average, equations=equations)
+
+    @profiled
+    def simulate_CW_steady_state(self, average: bool = False, equations: Tuple = None
+                                ) -> SteadyStateSolution:
         ''' Simulates the steady state of the problem for a CW source
             Returns a SteadyStateSolution instance
             average=True solves an average rate equation problem instead of the microscopic one.
+            equations are the already calculated matrices (see _setup_equations).
         '''
         logger = logging.getLogger(__name__ + '.steady_state')
 
         start_time = time.time()
         logger.info('Starting simulation...')
 
-        setup_func = precalculate.setup_microscopic_eqs
-        if average:
-            setup_func = precalculate.setup_average_eqs
-
         # get matrices of interaction, initial conditions, abs, decay, etc
-        (cte_updated, initial_population, index_S_i, index_A_j,
+        if equations is None:
+            equations = self._setup_equations(average=average)
+        (initial_population, index_S_i, index_A_j,
          total_abs_matrix, decay_matrix,
          ET_matrix, N_indices, jac_indices,
          coop_ET_matrix, coop_N_indices,
-         coop_jac_indices) = setup_func(self.cte, full_path=self.full_path)
-
-        # update cte
-        self.cte = cte_updated
+         coop_jac_indices) = equations
 
         # initial and final times for excitation and relaxation
         t0 = 0
@@ -1225,6 +1791,8 @@ class Simulations():
 
         rtol = self.cte.simulation_params['rtol']
         atol = self.cte.simulation_params['atol']
+        jacobian = self.cte.simulation_params.get('jacobian', 'dense')
+        backend = self.cte.simulation_params.get('backend', 'scipy')
 
         start_time_ODE = time.time()
         logger.info('Solving equations...')
@@ -1236,13 +1804,33 @@ class Simulations():
             # if the current excitation is not active jump to the next one
             if excitation[0].active is True:
                 logger.info('{}: P = {} W/cm2.'.format(exc_label, excitation[0].power_dens))
-        t_pulse = np.linspace(t0_p, tf_p, N_steps_pulse)
-        y_pulse = odesolver.solve_pulse(t_pulse, initial_population.transpose(),
-                                        total_abs_matrix, decay_matrix,
-                                        ET_matrix, N_indices, jac_indices,
-                                        coop_ET_matrix, coop_N_indices, coop_jac_indices,
-                                        nsteps=1000, method='bdf',
-                                        rtol=rtol, atol=atol, quiet=self.cte['no_console'])
+        with profile_phase('steady_state'):
+            y_steady = None
+            if self.cte.simulation_params.get('steady_state', 'newton') == 'newton':
+                ion_states = self._get_ion_states(index_S_i, index_A_j)
+                y_steady = odesolver.solve_steady_state(initial_population.transpose(),
+                                                        ion_states,
+                                                        total_abs_matrix, decay_matrix,
+                                                        ET_matrix, N_indices, jac_indices,
+                                                        coop_ET_matrix, coop_N_indices,
+                                                        coop_jac_indices,
+                                                        jacobian=jacobian, backend=backend)
+                if y_steady is None:
+                    logger.info('Newton method failed, integrating the rate equations instead.')
+
+            if y_steady is not None:
+                t_pulse = np.array([t0_p, tf_p], dtype=np.float64)
+                y_pulse = np.vstack((initial_population.transpose(), y_steady))
+            else:
+                t_pulse = np.linspace(t0_p, tf_p, N_steps_pulse)
+                y_pulse = odesolver.solve_pulse(t_pulse, initial_population.transpose(),
+                                                total_abs_matrix, decay_matrix,
+                                                ET_matrix, N_indices, jac_indices,
+                                                coop_ET_matrix, coop_N_indices, coop_jac_indices,
+                                                nsteps=1000, method='bdf',
+                                                rtol=rtol, atol=atol,
+                                                quiet=self.cte['no_console'],
+                                                jacobian=jacobian, backend=backend)
 
         logger.info('Equations solved! Total time: %.2fs.', time.time()-start_time_ODE)
 
@@ -1256,16 +1844,28 @@ class Simulations():
         steady_sol.time = total_time
         return steady_sol
 
+    def _get_ion_states(self, index_S_i: List[int], index_A_j: List[int]) -> np.array:
+        '''Ion number of each energy state.'''
+        S_states = self.cte.states['sensitizer_states']
+        A_states = self.cte.states['activator_states']
+        first_states = [(index, S_states) for index in index_S_i if index != -1]
+        first_states += [(index, A_states) for index in index_A_j if index != -1]
+        ion_states = np.zeros((sum(num for _, num in first_states), ), dtype=np.int64)
+        for ion, (index, num_states) in enumerate(first_states):
+            ion_states[index:index+num_states] = ion
+        return ion_states
+
     def simulate_avg_steady_state(self) -> SteadyStateSolution:
         '''Simulates the steady state of an average rate equations system,
             it calls simulate_steady_state
         '''
         return self.simulate_steady_state(average=True)
 
-    def simulate_pulsed_steady_state(self, average: bool = False) -> SteadyStateSolution:
+    def simulate_pulsed_steady_state(self, average: bool = False, equations: Tuple = None
+                                    ) -> SteadyStateSolution:
         '''If the excitation source is pulsed, simulate the dynamics and integrate the area
         under the curves.'''
-        dyn_sol = self.simulate_dynamics(average=average)
+        dyn_sol = self.simulate_dynamics(average=average, equations=equations)
         return dyn_sol.calculate_steady_state()
 
     def simulate_avg_pulsed_steady_state(self) -> SteadyStateSolution:
@@ -1274,12 +1874,26 @@ class Simulations():
         '''
         return self.simulate_pulsed_steady_state(average=True)
 
+    def _set_power_dens(self, power_dens: float) -> None:
+        '''Set the power density of all excitations.'''
+        for excitation in self.cte.excitations.keys():
+            for exc in self.cte.excitations[excitation]:
+                exc.power_dens = power_dens
+
+    def _is_pulsed(self) -> bool:
+        '''Returns True if any of the active excitations is pulsed.'''
+        return any(exc.active and exc.t_pulse is not None
+                   for exc_list in self.cte.excitations.values() for exc in exc_list)
+
+    @profiled
     def simulate_power_dependence(self, power_dens_list: List[float],
-                                  average: bool = False) -> PowerDependenceSolution:
+                                  average: bool = False, jobs: int = None
+                                 ) -> PowerDependenceSolution:
         ''' Simulates the power dependence.
             power_dens_list can be a list, tuple or a numpy array
             Returns a PowerDependenceSolution instance
             average=True solves an average rate equation problem instead of the microscopic one.
+            jobs is the number of worker processes, by default simulation_params['jobs'] or 1.
         '''
         logger = logging.getLogger(__name__ + '.pow_dep')
         logger.info('Simulating power dependence curves...')
@@ -1291,18 +1905,33 @@ class Simulations():
         num_power_steps = len(power_dens_list)
         solutions = []  # type: List[Solution]
 
-        for power_dens in tqdm(power_dens_list, unit='points',
-                               total=num_power_steps, disable=self.cte['no_console'],
-                               desc='Total progress'):
-            # update power density
-            for excitation in self.cte.excitations.keys():
-                for exc in self.cte.excitations[excitation]:
-                    exc.power_dens = power_dens
-            # calculate steady state populations
-            with disable_loggers([__name__+'.steady_state', __name__+'.dynamics',
-                                  'simetuc.precalculate', 'simetuc.lattice']):
-                steady_sol = self.simulate_steady_state(average=average)
-            solutions.append(steady_sol)
+        if jobs is None:
+            jobs = self.cte.simulation_params.get('jobs', 1)
+
+        if num_power_steps:
+            # only the absorption matrix changes with the power density,
+            # calculate all other matrices once
+            with disable_loggers(['simetuc.precalculate', 'simetuc.lattice']):
+                self.cte, incremental_eqs = precalculate.setup_incremental_eqs(
+                    self.cte, average=average, full_path=self.full_path,
+                    gen_lattice=self.cte.get('gen_lattice', False))
+
+        if jobs > 1 and num_power_steps > 1:
+            logger.info('Using %d processes.', jobs)
+            solutions = self._simulate_power_dependence_parallel(power_dens_list, incremental_eqs,
+                                                                 average, jobs)
+        else:
+            for power_dens in tqdm(power_dens_list, unit='points',
+                                   total=num_power_steps, disable=self.cte['no_console'],
+                                   desc='Total progress'):
+                # update power density
+                self._set_power_dens(power_dens)
+                # calculate steady state populations
+                with disable_loggers([__name__+'.steady_state', __name__+'.dynamics',
+                                      'simetuc.precalculate', 'simetuc.lattice']):
+                    equations = incremental_eqs.equations(self.cte.excitations)
+                    steady_sol = self.simulate_steady_state(average=average, equations=equations)
+                solutions.append(steady_sol)
         tqdm.write('')
 
         total_time = time.time()-start_time
@@ -1315,6 +1944,26 @@ class Simulations():
 
         return power_dep_solution
 
+    def _simulate_power_dependence_parallel(self, power_dens_list: List[float],
+                                            incremental_eqs: precalculate.IncrementalEqs,
+                                            average: bool, jobs: int) -> List[Solution]:
+        '''Simulate the steady state of each power density in a pool of jobs processes.
+            The power-independent matrices in incremental_eqs are shared with the workers,
+            which only rebuild the absorption matrix.
+            The solutions are returned in the same order as power_dens_list.
+        '''
+        solutions = []  # type: List[Solution]
+        with multiprocessing.Pool(processes=jobs, initializer=_init_power_dep_worker,
+                                  initargs=(self, incremental_eqs, average)) as pool:
+            for steady_sol in tqdm(pool.imap(_power_dep_worker, power_dens_list),
+                                   unit='points', total=len(power_dens_list),
+                                   disable=self.cte['no_console'], desc='Total progress'):
+                solutions.append(steady_sol)
+
+        self._set_power_dens(power_dens_list[-1])
+        return solutions
+
+    @profiled
     def simulate_concentration_dependence(self, concentrations: List[Tuple[float, float]],
                                           N_uc_list: List[int] = None,
                                           dynamics: bool = False, average: bool = False
@@ -1384,10 +2033,15 @@ class Simulations():
 
         return conc_dep_solution
 
+    @profiled
     def sample_simulation(self, simulation_fun: Callable[..., Union[DynamicsSolution, ConcentrationDependenceSolution]],
-                          N_samples : int,
-                          *args: Any, **kwargs: Any) -> Union[DynamicsSolution, ConcentrationDependenceSolution]:
+                          N_samples : int, *args: Any,
+                          jobs: int = None, seed: int = None,
+                          **kwargs: Any) -> Union[DynamicsSolution, ConcentrationDependenceSolution]:
         '''Repeats the simulation_fun N_samples times with different lattices.
+        Each sample uses its own random stream derived from seed, so the results are reproducible
+        for a given seed, with any number of jobs. By default simulation_params['seed'] or random.
+        jobs is the number of worker processes, by default simulation_params['jobs'] or 1.
         *args, **kwargs are passed to simulation_fun.'''
         logger = logging.getLogger(__name__ + '.sample_simulation')
 
@@ -1396,23 +2050,36 @@ class Simulations():
 
         start_time = time.time()
 
+        if jobs is None:
+            jobs = self.cte.simulation_params.get('jobs', 1)
+        if seed is None:
+            seed = self.cte.simulation_params.get('seed', None)
+        seed_seqs = np.random.SeedSequence(seed).spawn(N_samples)
+
         old_no_plot = self.cte['no_plot']
         self.cte['no_plot'] = True
         #self.cte['no_console']  = True
-        errors = []
-        total_errors = []
+        errors = [None]*N_samples  # type: List
+        total_errors = [None]*N_samples  # type: List
+        profiles = []  # type: List[Profile]
 
         self.cte['gen_lattice'] = True
+        # each sample sets its own lattice seed
+        old_seed = self.cte.lattice.get('seed', None)
 
         num_states = self.cte.states['sensitizer_states'] + self.cte.states['activator_states']
         y_sol = np.zeros((num_states, 1000))
         with disable_loggers([__name__+'.dynamics', __name__+'.steady_state',
                               __name__ + '.concentration_dependence',
                               'simetuc.precalculate', 'simetuc.lattice']):
-            for i_sample in trange(N_samples, desc='Sampling'):
-                sol = simulation_fun(*args, **kwargs)
-                errors.append(sol.errors)
-                total_errors.append(sol.total_error)
+            if jobs > 1:
+                logger.info('Using %d processes.', min(jobs, N_samples))
+            samples = self._simulate_samples(simulation_fun, seed_seqs, jobs, args, kwargs)
+            # accumulate the results as the samples finish
+            for index, sol in tqdm(samples, total=N_samples, desc='Sampling'):
+                errors[index] = sol.errors
+                total_errors[index] = sol.total_error
+                profiles.append(sol.profile)
                 if isinstance(sol, DynamicsSolution):
                     y_sol = y_sol + np.array(sol.list_avg_data_ofs)
 
@@ -1430,8 +2097,15 @@ class Simulations():
             sol.total_error = np.mean([sol.total_error for temp_sol in sol])
             sol.errors = np.mean([sol.errors for temp_sol in sol], axis=0)
 
+        # the time and ode statistics of all samples
+        sol.profile = Profile.merged(profiles)
+
         self.cte['no_plot'] = old_no_plot
         self.cte['no_console']  = False
+        if old_seed is None:
+            self.cte.lattice.pop('seed', None)
+        else:
+            self.cte.lattice['seed'] = old_seed
 
         total_time = time.time()-start_time
         formatted_time = time.strftime("%Mm %Ss", time.localtime(total_time))
@@ -1441,6 +2115,25 @@ class Simulations():
         #total_error_lst = total_errors
         return sol #, total_error_lst, errors_lst
 
+    def _simulate_samples(self, simulation_fun: Callable[..., Solution],
+                          seed_seqs: List[np.random.SeedSequence], jobs: int,
+                          args: Tuple, kwargs: Dict) -> Iterator[Tuple[int, Solution]]:
+        '''Yields the index and solution of each sample as soon as it finishes.
+            With more than one job the samples are simulated in a pool of processes,
+            each generating its lattices in a temporary file of its own.
+        '''
+        if jobs <= 1:
+            for index, seed_seq in enumerate(seed_seqs):
+                self.cte.lattice['seed'] = _get_lattice_seed(seed_seq)
+                yield index, simulation_fun(*args, **kwargs)
+            return
+
+        with tempfile.TemporaryDirectory() as folder:
+            with multiprocessing.Pool(processes=min(jobs, len(seed_seqs)),
+                                      initializer=_init_sample_worker,
+                                      initargs=(simulation_fun, folder, args, kwargs)) as pool:
+                yield from pool.imap_unordered(_sample_worker, enumerate(seed_seqs))
+
 #def histogram_errors() -> None:
 #    '''Plot a histogram with the errors of a sample of simulations.
 #    Uncomment the last return statement in sample_simulation'''
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the lattice generation, setup and solution of the rate equations.
+
+Run it from the root of the repository with:
+    python simetuc/test/test_benchmark/benchmark_suite.py [--N-uc 5 10] [--compare file.json]
+
+The results of each run are saved to benchmarks/benchmark_<version>.json in the current folder
+and compared with the most recent baseline of another version there,
+so performance regressions are reported.
+"""
+import os
+import sys
+import json
+import time
+import glob
+import logging
+import argparse
+import platform
+import tempfile
+import warnings
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+import simetuc
+import simetuc.settings as settings
+import simetuc.lattice as lattice
+import simetuc.precalculate as precalculate
+import simetuc.odesolver as odesolver
+import simetuc.simulations as simulations
+
+
+test_folder_path = os.path.dirname(os.path.abspath(__file__))
+# relative to the current folder, never inside the installed package
+BASELINE_FOLDER = 'benchmarks'
+DEFAULT_CONFIG = os.path.join(test_folder_path, '..', 'test_settings', 'test_standard_config.txt')
+
+DEFAULT_N_UC = [5, 10, 20, 30]
+# (S_conc, A_conc) in %
+DEFAULT_CONCENTRATIONS = [(0.0, 0.5), (2.0, 0.5), (5.0, 0.3)]
+# name of the phases in the order they are run
+PHASES = ['lattice', 'setup', 'rhs', 'jacobian', 'dynamics', 'steady_state']
+
+
+def _measure(fun: Callable, *args: Any, repeat: int = 1) -> Tuple[Any, float, int]:
+    '''Runs fun(*args) repeat times and returns its result, the best time (s)
+        and the peak memory allocated during a separate traced run (bytes).'''
+    best_time = np.inf
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = fun(*args)
+        best_time = min(best_time, time.perf_counter() - start_time)
+    tracemalloc.start()
+    try:
+        result = fun(*args)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, best_time, peak_memory
+
+
+def _get_rate_eq_funs(equations: Tuple, backend: str, jacobian: str
+                      ) -> Tuple[Callable, Callable]:
+    '''Rhs fun(t, y) and jacobian jfun(t, y) of the pulse equations as used by the solver.'''
+    (_, _, _, abs_matrix, decay_matrix, ET_matrix, N_indices, jac_indices,
+     coop_ET_matrix, coop_N_indices, coop_jac_indices) = equations
+    if backend == 'numba':
+        return odesolver._setup_numba_kernels(abs_matrix, decay_matrix, ET_matrix, N_indices,
+                                              jac_indices, coop_ET_matrix, coop_N_indices,
+                                              coop_jac_indices, jacobian=jacobian)
+    jac_rate_eq = (odesolver._jac_rate_eq_pulse_sparse if jacobian == 'sparse'
+                   else odesolver._jac_rate_eq_pulse)
+    def fun(t: float, y: np.array) -> np.array:
+        '''RHS with the arguments'''
+        return odesolver._rate_eq_pulse(t, y, abs_matrix, decay_matrix, ET_matrix, N_indices,
+                                        coop_ET_matrix, coop_N_indices)
+    def jfun(t: float, y: np.array) -> np.array:
+        '''Jacobian with the arguments'''
+        return jac_rate_eq(t, y, abs_matrix, decay_matrix, ET_matrix, jac_indices,
+                           coop_ET_matrix, coop_jac_indices)
+    return fun, jfun
+
+
+def benchmark_case(cte: settings.Settings, N_uc: int, S_conc: float, A_conc: float,
+                   folder: str, seed: int = 0, repeat: int = 10) -> Dict:
+    '''Benchmarks all phases for a lattice of N_uc unit cells and the given concentrations.
+        The lattice is saved to folder. The rhs and jacobian are evaluated repeat times.
+        Returns a dictionary with the size of the problem and the time (s)
+        and peak memory (bytes) of each phase.
+    '''
+    cte.lattice['N_uc'] = N_uc
+    cte.lattice['S_conc'] = S_conc
+    cte.lattice['A_conc'] = A_conc
+    cte.lattice['seed'] = seed  # always generate the same lattice
+    full_path = lattice.make_full_path(folder, N_uc, S_conc, A_conc)
+    params = cte.get('simulation_params', {})
+    backend = params.get('backend', None) or 'scipy'
+    jacobian = params.get('jacobian', None) or 'dense'
+
+    phases = {}  # type: Dict[str, Dict[str, float]]
+    def add_phase(name: str, fun: Callable, *args: Any, repeat: int = 1) -> Any:
+        '''Measure a phase and store its results'''
+        result, phase_time, peak_memory = _measure(fun, *args, repeat=repeat)
+        phases[name] = {'time': phase_time, 'peak_memory': peak_memory}
+        return result
+
+    add_phase('lattice', lattice.generate, cte, True, full_path)
+
+    def setup_eqs() -> Tuple:
+        '''Setup the equations from disk'''
+        precalculate.clear_lattice_cache()
+        return precalculate.setup_microscopic_eqs(cte, full_path=full_path)
+    (_, *equations) = add_phase('setup', setup_eqs)
+
+    fun, jfun = _get_rate_eq_funs(tuple(equations), backend, jacobian)
+    y = np.random.RandomState(seed).random_sample(equations[0].shape)
+    fun(0, y)  # compile numba kernels
+    jfun(0, y)
+    add_phase('rhs', fun, 0, y, repeat=repeat)
+    add_phase('jacobian', jfun, 0, y, repeat=repeat)
+
+    sim = simulations.Simulations(cte, full_path=full_path)
+    add_phase('dynamics', sim.simulate_dynamics, False, tuple(equations))
+    add_phase('steady_state', sim.simulate_CW_steady_state, False, tuple(equations))
+
+    return {'N_uc': N_uc, 'S_conc': S_conc, 'A_conc': A_conc,
+            'num_ions': cte.ions['total'], 'num_states': cte.states['energy_states'],
+            'backend': backend, 'jacobian': jacobian, 'phases': phases}
+
+
+def run(config_file: str = DEFAULT_CONFIG, N_uc_list: List[int] = None,
+        concentrations: List[Tuple[float, float]] = None,
+        seed: int = 0, repeat: int = 10) -> Dict:
+    '''Runs the benchmarks for all combinations of lattice sizes and concentrations.'''
+    logger = logging.getLogger(__name__)
+
+    N_uc_list = N_uc_list or DEFAULT_N_UC
+    concentrations = concentrations or DEFAULT_CONCENTRATIONS
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder, warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for N_uc in N_uc_list:
+            for S_conc, A_conc in concentrations:
+                cte = settings.load(config_file)
+                cte['no_console'] = True
+                cte['no_plot'] = True
+                logger.info('Benchmarking N_uc=%d, S_conc=%.2f%%, A_conc=%.2f%%...',
+                            N_uc, S_conc, A_conc)
+                try:
+                    results.append(benchmark_case(cte, N_uc, S_conc, A_conc, folder,
+                                                  seed=seed, repeat=repeat))
+                except lattice.LatticeError as err:
+                    logger.warning('Skipping N_uc=%d, S_conc=%.2f%%, A_conc=%.2f%%: %s',
+                                   N_uc, S_conc, A_conc, err)
+        precalculate.clear_lattice_cache()
+
+    return {'version': simetuc.VERSION, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'seed': seed, 'results': results}
+
+
+def save(results: Dict, filename: str = None) -> str:
+    '''Save the results to filename, by default benchmarks/benchmark_<version>.json.
+        Returns the filename.'''
+    if filename is None:
+        os.makedirs(BASELINE_FOLDER, exist_ok=True)
+        filename = os.path.join(BASELINE_FOLDER, 'benchmark_{}.json'.format(results['version']))
+    with open(filename, 'wt') as file:
+        json.dump(results, file, indent=2)
+    return filename
+
+
+def load(filename: str) -> Dict:
+    '''Load the results from filename.'''
+    with open(filename, 'rt') as file:
+        return json.load(file)
+
+
+def find_baseline(version: str) -> str:
+    '''Returns the most recent baseline of a different version or None.'''
+    baselines = [filename for filename in glob.glob(os.path.join(BASELINE_FOLDER, '*.json'))
+                 if load(filename).get('version') != version]
+    if not baselines:
+        return None
+    return max(baselines, key=os.path.getmtime)
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = 0.25) -> List[str]:
+    '''Compares the results with the baseline, returns a description of every phase
+        whose time or peak memory increased by more than tolerance (relative).
+        Only the cases present in both are compared.'''
+    def get_key(case: Dict) -> Tuple[int, float, float]:
+        '''Cases are identified by their size and concentrations.'''
+        return (case['N_uc'], case['S_conc'], case['A_conc'])
+    baseline_cases = {get_key(case): case for case in baseline['results']}
+
+    regressions = []
+    for case in results['results']:
+        base_case = baseline_cases.get(get_key(case))
+        if base_case is None:
+            continue
+        for phase, values in case['phases'].items():
+            for quantity in ['time', 'peak_memory']:
+                base_value = base_case['phases'].get(phase, {}).get(quantity)
+                if not base_value or values[quantity] <= base_value*(1 + tolerance):
+                    continue
+                regressions.append('N_uc={}, S_conc={}%, A_conc={}%, {} {}: '.format(
+                                       *get_key(case), phase, quantity) +
+                                   '{:.4g} -> {:.4g} (+{:.0%}).'.format(
+                                       base_value, values[quantity],
+                                       values[quantity]/base_value - 1))
+    return regressions
+
+
+def format_results(results: Dict) -> str:
+    '''Table with the time and peak memory of all phases.'''
+    header = '{:>5} {:>7} {:>7} {:>8}'.format('N_uc', 'S_conc', 'A_conc', 'states')
+    header += ''.join(' {:>18}'.format(phase) for phase in PHASES)
+    lines = [header]
+    for case in results['results']:
+        line = '{N_uc:>5} {S_conc:>7} {A_conc:>7} {num_states:>8}'.format(**case)
+        for phase in PHASES:
+            values = case['phases'][phase]
+            line += ' {:>9.3g}s {:>6.1f}MB'.format(values['time'], values['peak_memory']/1e6)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(ext_args: List[str] = None) -> int:
+    '''Run the benchmarks, save them and compare them with a baseline.
+        Returns 1 if there are regressions, 0 otherwise.'''
+    parser = argparse.ArgumentParser(description='Benchmark suite of simetuc.')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG,
+                        help='configuration file with the settings')
+    parser.add_argument('--N-uc', type=int, nargs='+', default=DEFAULT_N_UC,
+                        help='number of unit cells of the lattices')
+    parser.add_argument('--conc', type=float, nargs=2, action='append', metavar=('S', 'A'),
+                        help='concentrations of S and A in %% (can be repeated)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the lattices')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='evaluations of the rhs and jacobian')
+    parser.add_argument('-s', '--save', default=None,
+                        help='output file (default: benchmarks/benchmark_<version>.json)')
+    parser.add_argument('--compare', default=None,
+                        help='baseline to compare with (default: most recent other version)')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative increase considered a regression')
+    args = parser.parse_args(args=ext_args)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('simetuc').setLevel(logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    results = run(args.config, args.N_uc, args.conc, seed=args.seed, repeat=args.repeat)
+    logger.info(format_results(results))
+    filename = save(results, args.save)
+    logger.info('Results saved to %s.', filename)
+
+    baseline_file = args.compare or find_baseline(results['version'])
+    if baseline_file is None:
+        logger.info('No baseline to compare with.')
+        return 0
+    regressions = compare(results, load(baseline_file), args.tolerance)
+    logger.info('Compared with %s.', baseline_file)
+    for regression in regressions:
+        logger.warning('Regression: %s', regression)
+    if not regressions:
+        logger.info('No regressions found.')
+    return int(bool(regressions))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the benchmark suite, they use the smallest lattice only.
+"""
+import os
+import copy
+
+import pytest
+
+import benchmark_suite
+
+
+@pytest.fixture(scope='module')
+def small_results():
+    '''Benchmark the smallest lattice'''
+    return benchmark_suite.run(N_uc_list=[5], concentrations=[(0.0, 2.0)], repeat=1)
+
+def test_benchmark_run(small_results):
+    '''All phases are measured'''
+    assert len(small_results['results']) == 1
+    case = small_results['results'][0]
+    assert (case['N_uc'], case['S_conc'], case['A_conc']) == (5, 0.0, 2.0)
+    assert case['num_states'] == 7*case['num_ions']
+    assert list(case['phases']) == benchmark_suite.PHASES
+    for values in case['phases'].values():
+        assert values['time'] > 0
+        assert values['peak_memory'] >= 0
+    assert 'N_uc' in benchmark_suite.format_results(small_results)
+
+def test_benchmark_compare(small_results, tmp_path):
+    '''Slower or larger phases are regressions'''
+    filename = benchmark_suite.save(small_results, str(tmp_path / 'bench.json'))
+    baseline = benchmark_suite.load(filename)
+    assert baseline == small_results
+    assert benchmark_suite.compare(small_results, baseline) == []
+
+    baseline['results'][0]['phases']['setup']['time'] /= 2
+    regressions = benchmark_suite.compare(small_results, baseline, tolerance=0.5)
+    assert len(regressions) == 1
+    assert 'setup time' in regressions[0]
+    assert benchmark_suite.compare(small_results, baseline, tolerance=1.5) == []
+
+    # different cases aren't compared
+    other = copy.deepcopy(baseline)
+    other['results'][0]['N_uc'] = 10
+    assert benchmark_suite.compare(small_results, other, tolerance=0.5) == []
+
+def test_benchmark_main(small_results, tmp_path, mocker):
+    '''The command line runs, saves and compares the benchmarks'''
+    mocker.patch('benchmark_suite.run', return_value=small_results)
+    mocker.patch('benchmark_suite.BASELINE_FOLDER', str(tmp_path / 'baselines'))
+    baseline = copy.deepcopy(small_results)
+    baseline['results'][0]['phases']['dynamics']['time'] /= 10
+    baseline_file = benchmark_suite.save(baseline, str(tmp_path / 'baseline.json'))
+
+    output_file = str(tmp_path / 'bench.json')
+    assert benchmark_suite.main(['--N-uc', '5', '--conc', '0', '2', '-s', output_file]) == 0
+    assert benchmark_suite.load(output_file) == small_results
+    assert benchmark_suite.main(['-s', output_file, '--compare', output_file]) == 0
+    assert benchmark_suite.main(['-s', output_file, '--compare', baseline_file]) == 1
+
+def test_benchmark_default_folder(small_results, tmp_path, monkeypatch):
+    '''By default the results are saved to benchmarks/ in the current folder'''
+    monkeypatch.chdir(tmp_path)
+    filename = benchmark_suite.save(small_results)
+    assert os.path.abspath(filename) == str(tmp_path / 'benchmarks' /
+                                            'benchmark_{}.json'.format(small_results['version']))
+    assert benchmark_suite.find_baseline(small_results['version']) is None
+    assert benchmark_suite.find_baseline('0.0.0') == filename
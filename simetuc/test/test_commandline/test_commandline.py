@@ -9,7 +9,9 @@ import pytest
 import os
 
 import simetuc.commandline as commandline
-from simetuc.util import temp_config_filename
+import simetuc.optimize as optimize
+import simetuc.simulations as simulations
+from simetuc.util import temp_config_filename, Profile
 
 
 config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_standard_config.cfg')
@@ -79,6 +81,47 @@ def test_cli_conc_dep_dyn(mocker, no_logging):
     commandline.main(ext_args)
     assert mocked_sim.call_count == 1
 
+def test_cli_power_dep_jobs(mocker, no_logging):
+    '''Test that the number of jobs is passed to the power dependence'''
+    mocked_sim = mocker.patch('simetuc.simulations.Simulations')
+    ext_args = [config_file, '--no-plot', '-p', '-j', '2']
+    commandline.main(ext_args)
+    assert mocked_sim.call_count == 1
+    mocked_pow_dep = mocked_sim.return_value.simulate_power_dependence
+    assert mocked_pow_dep.call_count == 1
+    assert mocked_pow_dep.call_args[1]['jobs'] == 2
+
+def test_cli_sample_jobs(mocker, no_logging):
+    '''Test that the number of jobs is passed to the sampling'''
+    mocked_sim = mocker.patch('simetuc.simulations.Simulations')
+    ext_args = [config_file, '--no-plot', '-d', '-N', '4', '-j', '2']
+    commandline.main(ext_args)
+    mocked_sample = mocked_sim.return_value.sample_simulation
+    assert mocked_sample.call_count == 1
+    assert mocked_sample.call_args[1]['N_samples'] == 4
+    assert mocked_sample.call_args[1]['jobs'] == 2
+
+@pytest.mark.parametrize('resume', [False, True])
+def test_cli_stream(mocker, no_logging, resume):
+    '''Test that the stream file and resume are passed to the dynamics and the solution saved there'''
+    mocked_sim = mocker.patch('simetuc.simulations.Simulations')
+    ext_args = [config_file, '--no-plot', '-d', '--stream', 'stream.hdf5'] + (['--resume'] if resume else [])
+    commandline.main(ext_args)
+    mocked_dyn = mocked_sim.return_value.simulate_dynamics
+    assert mocked_dyn.call_count == 1
+    assert mocked_dyn.call_args[1]['stream_to'] == 'stream.hdf5'
+    assert mocked_dyn.call_args[1]['resume'] == resume
+    mocked_dyn.return_value.save.assert_called_once_with('stream.hdf5')
+    assert mocked_dyn.return_value.close.call_count == 1
+
+def test_cli_optim_jobs(mocker, no_logging):
+    '''Test that the number of jobs is passed to the optimization'''
+    mocked_opt = mocker.patch('simetuc.optimize.optimize_dynamics')
+    ext_args = [config_file, '--no-plot', '-o', '-j', '2']
+    commandline.main(ext_args)
+    assert mocked_opt.call_count == 1
+    assert mocked_opt.call_args[1]['jobs'] == 2
+
 def test_cli_plot_dyn(mocker, no_logging):
     '''Test that not using no-plot works'''
     mocked_sim = mocker.patch('simetuc.simulations.Simulations')
@@ -86,6 +129,28 @@ def test_cli_plot_dyn(mocker, no_logging):
     commandline.main(ext_args)
     assert mocked_sim.call_count == 1
 
+def test_cli_migrate(mocker, no_logging):
+    '''Test that the lattice files are converted'''
+    mocked_migrate = mocker.patch('simetuc.lattice.migrate', return_value=[])
+    commandline.main(['migrate'])
+    mocked_migrate.assert_called_once_with('latticeData')
+    commandline.main(['migrate', 'lattices'])
+    mocked_migrate.assert_called_with('lattices')
+
+def test_cli_profile(mocker, no_logging, capsys):
+    '''Test that --profile prints the profile of the solution'''
+    mocked_sim = mocker.patch('simetuc.simulations.Simulations')
+    solution = mocker.MagicMock(spec=simulations.DynamicsSolution)
+    solution.time = 2.0
+    solution.profile = Profile()
+    solution.profile.add_time('relaxation', 1.5)
+    mocked_sim.return_value.simulate_dynamics.return_value = solution
+    ext_args = [config_file, '--no-plot', '--no-save', '-d', '--profile']
+    commandline.main(ext_args)
+    output = capsys.readouterr().out
+    assert 'Profile (total time: 2.00s)' in output
+    assert 'relaxation' in output
+
 def test_cli_no_save(mocker, no_logging):
     '''Test that the --no-save works'''
     mocked_sim = mocker.patch('simetuc.simulations.Simulations')
@@ -112,6 +177,17 @@ def test_cli_optim_options(mocker, no_logging, option):
         commandline.main(ext_args)
         assert mocked_opt.call_count == 1
 
+@pytest.mark.parametrize('option', ['-o', '-oc'])
+def test_cli_optim_prefit(mocker, no_logging, option):
+    '''Test that --prefit runs the optimization pipeline with the right function'''
+    mocked_prefit = mocker.patch('simetuc.optimize.optimize_prefit')
+    ext_args = [config_file, '--no-plot', option, '--prefit', '-j', '2']
+    commandline.main(ext_args)
+    assert mocked_prefit.call_count == 1
+    expected_function = optimize.optimize_dynamics if option == '-o' else optimize.optimize_concentrations
+    assert mocked_prefit.call_args[0][0] is expected_function
+    assert mocked_prefit.call_args[1]['jobs'] == 2
+
 option_list = ['-d', '-cd', '-o', '-oc']
 @pytest.mark.parametrize('option', option_list, ids=option_list)
 @pytest.mark.parametrize('N_samples', [0, 1, 2])
@@ -5,8 +5,10 @@ Created on Fri Oct 21 18:44:07 2016
 @author: Pedro
 """
 import os
+import shutil
 import pytest
 import numpy as np
+import h5py
 # pylint: disable=E1101
 
 import simetuc.lattice as lattice
@@ -53,10 +55,10 @@ def test_cte_ok(setup_cte, params):
         (dist_array, ion_type, doped_lattice,
          initial_population, lattice_info,
          index_S_i, index_A_j,
-         index_S_k, dist_S_k,
-         index_S_l, dist_S_l,
-         index_A_k, dist_A_k,
-         index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
+         indptr_S_k, index_S_k, dist_S_k,
+         indptr_S_l, index_S_l, dist_S_l,
+         indptr_A_k, index_A_k, dist_A_k,
+         indptr_A_l, index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
 
     num_ions = lattice_info['num_total']
     num_activators = lattice_info['num_activators']
@@ -68,9 +70,10 @@ def test_cte_ok(setup_cte, params):
 
     assert dist_array.shape == (num_ions, num_ions)
     # symmetric matrix
-    assert np.allclose(dist_array, dist_array.T)
-    # only positive distances
-    assert np.alltrue(dist_array >= 0)
+    assert np.allclose(dist_array.toarray(), dist_array.T.toarray())
+    # only positive distances inside the cutoff
+    assert np.alltrue(dist_array.data > 0)
+    assert np.alltrue(dist_array.data <= cte['lattice']['d_max'])
 
     assert ion_type.shape == (num_ions, )
     assert np.max(ion_type) == 1 or np.max(ion_type) == 0
@@ -92,37 +95,137 @@ def test_cte_ok(setup_cte, params):
     assert min(index_A_j) >= -1
     assert max(index_A_j) <= num_states-1
 
+    def rows(indptr, values):
+        '''Interactions of each ion'''
+        return np.split(values, indptr[1:-1]) if len(indptr) > 1 else []
+    index_S_k, dist_S_k = rows(indptr_S_k, index_S_k), rows(indptr_S_k, dist_S_k)
+    index_S_l, dist_S_l = rows(indptr_S_l, index_S_l), rows(indptr_S_l, dist_S_l)
+    index_A_k, dist_A_k = rows(indptr_A_k, index_A_k), rows(indptr_A_k, dist_A_k)
+    index_A_l, dist_A_l = rows(indptr_A_l, index_A_l), rows(indptr_A_l, dist_A_l)
+
     if num_sensitizers > 0 and num_S_states > 0:
         assert len(index_S_k) == num_sensitizers
-        assert all(len(list_elem) == num_sensitizers-1 for list_elem in index_S_k)
-        assert all(-1 <= max(list_elem) <= num_states for list_elem in index_S_k if len(list_elem))
+        assert all(len(list_elem) <= num_sensitizers-1 for list_elem in index_S_k)
+        assert all(0 <= max(list_elem) <= num_states for list_elem in index_S_k if len(list_elem))
         assert len(dist_S_k) == num_sensitizers
-        assert all(len(list_elem) == num_sensitizers-1 for list_elem in dist_S_k)
-        assert all(np.alltrue(list_elem >= 0) for list_elem in dist_S_k)
+        assert all(len(list_elem) <= num_sensitizers-1 for list_elem in dist_S_k)
+        assert all(np.alltrue(list_elem > 0) for list_elem in dist_S_k)
 
         if num_activators > 0 and num_A_states > 0:
             assert len(index_S_l) == num_sensitizers
-            assert all(len(list_elem) == num_activators for list_elem in index_S_l)
-            assert all(-1 <= max(list_elem) <= num_states for list_elem in index_S_l if len(list_elem))
+            assert all(len(list_elem) <= num_activators for list_elem in index_S_l)
+            assert all(0 <= max(list_elem) <= num_states for list_elem in index_S_l if len(list_elem))
             assert len(dist_S_l) == num_sensitizers
-            assert all(len(list_elem) == num_activators for list_elem in dist_S_l)
-            assert all(np.alltrue(list_elem >= 0) for list_elem in dist_S_l)
+            assert all(len(list_elem) <= num_activators for list_elem in dist_S_l)
+            assert all(np.alltrue(list_elem > 0) for list_elem in dist_S_l)
 
     if num_activators > 0 and num_A_states > 0:
         assert len(index_A_l) == num_activators
-        assert all(len(list_elem) == num_activators-1 for list_elem in index_A_l)
-        assert all(-1 <= max(list_elem) <= num_states for list_elem in index_A_l if len(list_elem))
+        assert all(len(list_elem) <= num_activators-1 for list_elem in index_A_l)
+        assert all(0 <= max(list_elem) <= num_states for list_elem in index_A_l if len(list_elem))
         assert len(dist_A_l) == num_activators
-        assert all(len(list_elem) == num_activators-1 for list_elem in dist_A_l)
-        assert all(np.alltrue(list_elem >= 0) for list_elem in dist_A_l)
+        assert all(len(list_elem) <= num_activators-1 for list_elem in dist_A_l)
+        assert all(np.alltrue(list_elem > 0) for list_elem in dist_A_l)
 
         if num_sensitizers > 0 and num_S_states > 0:
             assert len(index_A_k) == num_activators
-            assert all(len(list_elem) == num_sensitizers for list_elem in index_A_k)
-            assert all(-1 <= max(list_elem) <= num_states for list_elem in index_A_k if len(list_elem))
+            assert all(len(list_elem) <= num_sensitizers for list_elem in index_A_k)
+            assert all(0 <= max(list_elem) <= num_states for list_elem in index_A_k if len(list_elem))
             assert len(dist_A_k) == num_activators
-            assert all(len(list_elem) == num_sensitizers for list_elem in dist_A_k)
-            assert all(np.alltrue(list_elem >= 0) for list_elem in dist_A_k)
+            assert all(len(list_elem) <= num_sensitizers for list_elem in dist_A_k)
+            assert all(np.alltrue(list_elem > 0) for list_elem in dist_A_k)
+
+    # only the interacting ions are stored
+    for dists in [dist_S_k, dist_S_l, dist_A_k, dist_A_l]:
+        for dist_row in dists:
+            assert np.alltrue(dist_row <= cte['lattice']['d_max'])
+
+@pytest.mark.parametrize('d_max', [5.0, 10.0, 25.0])
+def test_neighbours_d_max(d_max):
+    '''Test that the neighbours inside d_max are the same as with the dense distances'''
+    unit_cell, occupations = lattice._create_unit_cell('P-6', [5.9738, 5.9738, 3.5297, 90, 90, 120],
+                                                       [[0, 0, 0], [2/3, 1/3, 1/2]], [1, 1/2])
+    atoms, _, _ = lattice._create_doped_lattice(unit_cell, 6, 0.2*occupations, 0*occupations)
+
+    dist_array = lattice._calculate_distances(atoms, no_console=True)
+    dist_array[dist_array > d_max] = 0
+    neighbours = lattice._calculate_neighbours(atoms, d_max=d_max, no_console=True)
+
+    assert np.allclose(neighbours.toarray(), dist_array)
+
+
+def test_create_doped_lattice():
+    '''Test that the doped fractions are close to the concentrations'''
+    unit_cell, occupations = lattice._create_unit_cell('P-6', [5.9738, 5.9738, 3.5297, 90, 90, 120],
+                                                       [[0, 0, 0], [2/3, 1/3, 1/2]], [1, 1/2])
+    assert np.array_equal(occupations, [1, 1/2])
+    atoms, ion_type, num_sites = lattice._create_doped_lattice(unit_cell, 20,
+                                                               0.10*occupations, 0.05*occupations,
+                                                               rng=np.random.default_rng(1))
+    assert np.array_equal(num_sites, [20**3]*2)
+    num_host_sites = np.sum(num_sites*occupations)
+
+    assert len(atoms) == len(ion_type)
+    assert ion_type.dtype == np.uint32
+    assert np.isclose(np.sum(ion_type == 0)/num_host_sites, 0.10, atol=0.01)
+    assert np.isclose(np.sum(ion_type == 1)/num_host_sites, 0.05, atol=0.01)
+    # all positions are inside the lattice
+    scaled_pos = atoms.get_scaled_positions(wrap=False)
+    assert np.alltrue(scaled_pos > -1e-10) and np.alltrue(scaled_pos < 1)
+
+def test_create_doped_lattice_sphere():
+    '''Test that a nanoparticle only has sites inside the sphere'''
+    unit_cell, occupations = lattice._create_unit_cell('P-6', [5.9738, 5.9738, 3.5297, 90, 90, 120],
+                                                       [[0, 0, 0], [2/3, 1/3, 1/2]], [1, 1/2])
+    radius = 20.0
+    atoms, ion_type, num_sites = lattice._create_doped_lattice(unit_cell, 12,
+                                                               occupations, 0*occupations,
+                                                               radius=radius)
+    assert np.all(ion_type == 0)
+    assert np.alltrue(np.linalg.norm(atoms.positions, axis=1) <= radius)
+    # about the volume of the sphere
+    num_unit_cells = 4/3*np.pi*radius**3/unit_cell.get_volume()
+    assert np.isclose(num_sites[0], num_unit_cells, rtol=0.05)
+    assert np.isclose(len(atoms), num_unit_cells*np.sum(occupations), rtol=0.1)
+
+@pytest.mark.parametrize('ion_sites', [{'S': 'Y', 'A': 'Y'}, {'S': 'Al', 'A': 'Y'}])
+def test_cif(setup_cte, ion_sites):
+    '''Generate a lattice from a .cif file'''
+    cte = setup_cte
+    cte['lattice']['N_uc'] = 3
+    cte['lattice']['S_conc'] = 10.0
+    cte['lattice']['A_conc'] = 5.0
+    cte['lattice']['cif_file'] = os.path.join(test_folder_path, '..', '..', '4312142_YAG.cif')
+    cte['lattice']['ion_sites'] = ion_sites
+
+    with temp_bin_filename() as temp_filename:
+        (_, ion_type, doped_lattice, *_) = lattice.generate(cte, full_path=temp_filename)
+
+    assert len(ion_type) == len(doped_lattice)
+    assert np.any(ion_type == 0) and np.any(ion_type == 1)
+
+def test_seed(setup_cte):
+    '''The same seed gives the same lattice, different seeds give different ones'''
+    cte = setup_cte
+    cte['lattice']['N_uc'] = 8
+    cte['lattice']['S_conc'] = 5.0
+    cte['lattice']['A_conc'] = 5.0
+
+    def get_lattice(seed):
+        '''Generate a lattice and return its ion types and positions'''
+        cte['lattice']['seed'] = seed
+        with temp_bin_filename() as temp_filename:
+            (_, ion_type, doped_lattice, *_) = lattice.generate(cte, full_path=temp_filename)
+        return ion_type, doped_lattice
+
+    ion_type, positions = get_lattice(1234)
+    ion_type_same, positions_same = get_lattice(1234)
+    ion_type_other, positions_other = get_lattice(4321)
+
+    assert np.array_equal(ion_type, ion_type_same)
+    assert np.array_equal(positions, positions_same)
+    assert (ion_type.shape != ion_type_other.shape or
+            not np.array_equal(positions, positions_other))
 
 
 @pytest.mark.parametrize('params', [# TEST NEGATIVE AND EXCESSIVE CONCS AND N_UC
@@ -163,10 +266,10 @@ def test_cte_wrong(setup_cte, params):
             (dist_array, ion_type, doped_lattice,
              initial_population, lattice_info,
              index_S_i, index_A_j,
-             index_S_k, dist_S_k,
-             index_S_l, dist_S_l,
-             index_A_k, dist_A_k,
-             index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
+             indptr_S_k, index_S_k, dist_S_k,
+             indptr_S_l, index_S_l, dist_S_l,
+             indptr_A_k, index_A_k, dist_A_k,
+             indptr_A_l, index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
 
 
 
@@ -191,10 +294,10 @@ def test_unit_cell(setup_cte, cell_params):
             (dist_array, ion_type, doped_lattice,
              initial_population, lattice_info,
              index_S_i, index_A_j,
-             index_S_k, dist_S_k,
-             index_S_l, dist_S_l,
-             index_A_k, dist_A_k,
-             index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
+             indptr_S_k, index_S_k, dist_S_k,
+             indptr_S_l, index_S_l, dist_S_l,
+             indptr_A_k, index_A_k, dist_A_k,
+             indptr_A_l, index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
 
 
 def idfn_sites(sites):
@@ -222,10 +325,10 @@ def test_sites(setup_cte, sites):
             (dist_array, ion_type, doped_lattice,
              initial_population, lattice_info,
              index_S_i, index_A_j,
-             index_S_k, dist_S_k,
-             index_S_l, dist_S_l,
-             index_A_k, dist_A_k,
-             index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
+             indptr_S_k, index_S_k, dist_S_k,
+             indptr_S_l, index_S_l, dist_S_l,
+             indptr_A_k, index_A_k, dist_A_k,
+             indptr_A_l, index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
 
 @pytest.mark.parametrize('concs', [(0.0, 50.0), (50.0, 0.0)])
 def test_single_atom(setup_cte, concs):
@@ -246,13 +349,93 @@ def test_single_atom(setup_cte, concs):
                 (dist_array, ion_type, doped_lattice,
                  initial_population, lattice_info,
                  index_S_i, index_A_j,
-                 index_S_k, dist_S_k,
-                 index_S_l, dist_S_l,
-                 index_A_k, dist_A_k,
-                 index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
+                 indptr_S_k, index_S_k, dist_S_k,
+                 indptr_S_l, index_S_l, dist_S_l,
+                 indptr_A_k, index_A_k, dist_A_k,
+                 indptr_A_l, index_A_l, dist_A_l) = lattice.generate(cte, full_path=temp_filename)
         except lattice.LatticeError: # no ions were generated, repeat
             pass
         else:
             if len(ion_type) == 1: # only one ion was generated
                 success = True
 
+def test_lattice_file(setup_cte):
+    '''The saved lattice has the current format and loads the same data'''
+    cte = setup_cte
+    cte['lattice']['N_uc'] = 8
+    cte['lattice']['S_conc'] = 5.0
+    cte['lattice']['A_conc'] = 5.0
+    cte['lattice']['d_max'] = 20.0
+
+    with temp_bin_filename() as temp_filename:
+        (_, ion_type, doped_lattice,
+         initial_population, lattice_info,
+         index_S_i, index_A_j,
+         *interactions) = lattice.generate(cte, full_path=temp_filename)
+        with h5py.File(temp_filename, mode='r') as file:
+            assert file.attrs['format_version'] == lattice.LATTICE_FORMAT_VERSION
+            assert 'dist_array' not in file
+            assert file['index_S_k'].ndim == 1
+        lattice_data = lattice.load_lattice(temp_filename)
+
+    assert lattice_data['lattice_info'] == lattice_info
+    assert np.array_equal(lattice_data['ion_type'], ion_type)
+    assert np.array_equal(lattice_data['doped_lattice'], doped_lattice)
+    assert np.array_equal(lattice_data['initial_population'], initial_population)
+    assert np.array_equal(lattice_data['indices_S_i'], index_S_i)
+    assert np.array_equal(lattice_data['indices_A_j'], index_A_j)
+    for num, label in enumerate(lattice.INTERACTION_LABELS):
+        assert np.array_equal(lattice_data['indptr_' + label], interactions[3*num])
+        assert np.array_equal(lattice_data['index_' + label], interactions[3*num+1])
+        assert np.array_equal(lattice_data['dist_' + label], interactions[3*num+2])
+
+def test_interactions_csr():
+    '''The padded interactions and the interaction lists are converted to CSR'''
+    index_list = [np.array([[0], [9]]), np.array([]), np.array([[4]])]
+    dist_list = [np.array([1.0, 2.0]), np.array([]), np.array([3.0])]
+    index_arr, dist_arr = lattice._pad_interactions(index_list, dist_list)
+    indptr, indices, dists = lattice._interactions_to_csr(index_arr, dist_arr)
+    assert np.array_equal(indptr, [0, 2, 2, 3])
+    assert np.array_equal(indices, [0, 9, 4])
+    assert np.array_equal(dists, [1.0, 2.0, 3.0])
+    for new_arr, arr in zip(lattice._lists_to_csr(index_list, dist_list), (indptr, indices, dists)):
+        assert np.array_equal(new_arr, arr) and new_arr.dtype == arr.dtype
+
+    # no ions
+    indptr, indices, dists = lattice._interactions_to_csr(np.array([]), np.array([]))
+    assert np.array_equal(indptr, [0]) and indices.size == 0 and dists.size == 0
+    indptr, indices, dists = lattice._lists_to_csr([], [])
+    assert np.array_equal(indptr, [0]) and indices.size == 0 and dists.size == 0
+    # no interactions
+    indptr, indices, dists = lattice._lists_to_csr([[], []], [[], []])
+    assert np.array_equal(indptr, [0, 0, 0]) and indices.dtype == np.int64 and dists.size == 0
+
+def test_migrate(tmp_path):
+    '''Old lattice files are converted to the current format'''
+    old_file = os.path.join(test_folder_path, '..', 'test_simulations', 'data_2S_2A.hdf5')
+    folder = tmp_path / 'latticeData' / 'bNaYF4'
+    folder.mkdir(parents=True)
+    full_path = str(folder / 'data_2S_2A.hdf5')
+    shutil.copy(old_file, full_path)
+    (folder / 'notes.txt').write_text('not a lattice')
+
+    old_data = lattice.load_lattice(full_path)
+    assert lattice.migrate(str(tmp_path / 'latticeData')) == [full_path]
+    assert lattice.migrate(str(tmp_path / 'latticeData')) == []
+
+    with h5py.File(full_path, mode='r') as file:
+        assert file.attrs['format_version'] == lattice.LATTICE_FORMAT_VERSION
+        assert 'dist_array' not in file
+    new_data = lattice.load_lattice(full_path)
+    assert new_data.keys() == old_data.keys()
+    for label, value in old_data.items():
+        if isinstance(value, np.ndarray):
+            assert np.array_equal(new_data[label], value)
+        else:
+            assert new_data[label] == value
+
+    # newer formats can't be read
+    with h5py.File(full_path, mode='a') as file:
+        file.attrs['format_version'] = lattice.LATTICE_FORMAT_VERSION + 1
+    with pytest.raises(lattice.LatticeError):
+        lattice.load_lattice(full_path)
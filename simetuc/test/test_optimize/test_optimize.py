@@ -4,6 +4,8 @@ Created on Fri Nov 18 17:22:18 2016
 
 @author: Pedro
 """
+import os
+
 import pytest
 import numpy as np
 import warnings
@@ -13,8 +15,11 @@ from lmfit import Parameters
 import simetuc.optimize as optimize
 import simetuc.simulations as simulations
 from simetuc.util import IonType, DecayTransition, EneryTransferProcess, Transition
-from simetuc.util import temp_bin_filename, temp_config_filename
+from simetuc.util import temp_bin_filename, temp_config_filename, Profile
+from simetuc.util import ConfigWarning
+
 
+test_folder_path = os.path.dirname(os.path.abspath(__file__))
 
 B_43 = DecayTransition(IonType.A, 3, 1, branching_ratio=0.3)
 CR50 = EneryTransferProcess([Transition(IonType.A, 5, 3), Transition(IonType.A, 0, 2)],
@@ -111,6 +116,7 @@ def test_optim_fun(setup_cte, mocker, excitations):
         errors = np.ones((setup_cte.states['activator_states'] +
                           setup_cte.states['sensitizer_states'],), dtype=np.float64)
         average = False
+        profile = Profile()
     mocked_dyn.return_value = mocked_dyn_res
 
     sim = simulations.Simulations(setup_cte)
@@ -133,6 +139,261 @@ def test_optim_fun(setup_cte, mocker, excitations):
 
     assert mocked_dyn.called
 
+def test_optim_fun_parallel(setup_cte_sim, tmp_path, monkeypatch):
+    '''Test that simulating the excitations in parallel gives the same error as one by one'''
+    test_filename = os.path.join(test_folder_path, '..', 'test_simulations', 'data_2S_2A.hdf5')
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    excitations = ['Vis_473', 'NIR_980']
+    sim.cte['optimization']['excitations'] = excitations
+    params = Parameters()
+    for process in sim.cte.optimization['processes']:
+        params.add(process.name, value=2*process.value)
+
+    # experimental data for all states and excitations
+    states = sim.cte.states
+    conc_str = '_{}{}_{}{}'.format(float(sim.cte.lattice['S_conc']), states['sensitizer_ion_label'],
+                                   float(sim.cte.lattice['A_conc']), states['activator_ion_label'])
+    labels = ([states['sensitizer_ion_label'] + '_' + label
+               for label in states['sensitizer_states_labels']] +
+              [states['activator_ion_label'] + '_' + label
+               for label in states['activator_states_labels']])
+    exp_folder = tmp_path / 'expData' / sim.cte.lattice['name']
+    exp_folder.mkdir(parents=True)
+    t = np.linspace(0, 1e-2, 1000)
+    for exc_label in excitations:
+        for label in labels:
+            (exp_folder / 'decay_{}_exc_{}{}.txt'.format(label, exc_label, conc_str)).write_text(
+                '\n'.join('{}\t{}'.format(ti, np.exp(-ti/1e-3)) for ti in t))
+    monkeypatch.chdir(tmp_path)
+
+    errors = optimize.optim_fun_dynamics(params, sim)
+    with optimize._optim_worker_pool(2):
+        parallel_errors = optimize.optim_fun_dynamics(params, sim)
+    assert 'pool' not in optimize._optim_worker_state
+
+    assert np.any(errors)
+    assert np.allclose(errors, parallel_errors, equal_nan=True)
+    assert not any(exc_lst[0].active for exc_lst in sim.cte.excitations.values())
+
+def test_optim_jobs(setup_cte, mocker):
+    '''Test that the optimization uses a pool of processes for several excitations'''
+    init_param = np.array([proc.value for proc in setup_cte['optimization']['processes']])
+    def mocked_optim_fun(function, params, sim):
+        assert 'pool' in optimize._optim_worker_state
+        return 2 + (np.array([val for val in params.valuesdict().values()]) - 1.1*init_param)**2
+    mocker.patch('simetuc.optimize.optim_fun', new=mocked_optim_fun)
+
+    setup_cte['optimization']['excitations'] = ['Vis_473', 'NIR_980']
+    with temp_bin_filename() as temp_filename:
+        optim_solution = optimize.optimize_dynamics(setup_cte, full_path=temp_filename, jobs=2)
+    assert optim_solution.best_params is not None
+    assert 'pool' not in optimize._optim_worker_state
+
+def test_optim_parallel_jacobian(setup_cte_sim, mocker):
+    '''Test that the jacobian calculated in parallel is correct'''
+    init_param = np.array([proc.value for proc in setup_cte_sim['optimization']['processes']])
+    def mocked_optim_fun(function, params, sim):
+        return 2 + (np.array([val for val in params.valuesdict().values()]) - 1.1*init_param)**2
+    mocker.patch('simetuc.optimize.optim_fun', new=mocked_optim_fun)
+
+    sim = simulations.Simulations(setup_cte_sim)
+    _, params, _ = optimize.setup_optim(sim.cte)
+    with optimize._optim_worker_pool(2):
+        jacobian, evaluations = optimize._parallel_jacobian(optimize.optim_fun_dynamics, params,
+                                                            (sim, False, None))
+    assert len(evaluations) == len(params) + 1
+    assert np.allclose(evaluations[0][1], mocked_optim_fun(None, params, sim))
+    assert np.allclose(jacobian, np.diag(2*(init_param - 1.1*init_param)), rtol=1e-3)
+
+    # the error vector at params is reused and not evaluated again
+    with optimize._optim_worker_pool(2):
+        jacobian_base, evaluations = optimize._parallel_jacobian(optimize.optim_fun_dynamics, params,
+                                                                 (sim, False, None),
+                                                                 base_residual=evaluations[0][1])
+    assert len(evaluations) == len(params)
+    assert all(eval_params is not params for eval_params, _ in evaluations)
+    assert np.allclose(jacobian_base, jacobian)
+
+def test_optim_leastsq_jobs(setup_cte_sim, mocker):
+    '''Test that leastsq with several jobs reaches the same minimum and shows all evaluations'''
+    init_param = np.array([proc.value for proc in setup_cte_sim['optimization']['processes']])
+    def mocked_optim_fun(function, params, sim):
+        return 2 + (np.array([val for val in params.valuesdict().values()]) - 1.1*init_param)**2
+    mocker.patch('simetuc.optimize.optim_fun', new=mocked_optim_fun)
+    jacobian_spy = mocker.spy(optimize, '_parallel_jacobian')
+    setup_cte_sim['optimization']['method'] = 'leastsq'
+
+    with temp_bin_filename() as temp_filename:
+        serial_solution = optimize.optimize_dynamics(setup_cte_sim, full_path=temp_filename, jobs=1)
+        parallel_solution = optimize.optimize_dynamics(setup_cte_sim, full_path=temp_filename, jobs=3)
+
+    assert parallel_solution.min_f == pytest.approx(serial_solution.min_f, rel=1e-3)
+    assert 'Dfun' in parallel_solution.result.call_kws
+    # the evaluations of the jacobian are shown too
+    assert len(parallel_solution.optim_progress) > parallel_solution.result.nfev
+    # the params of the jacobian were just evaluated, they aren't simulated again
+    assert jacobian_spy.call_count > 0
+    assert all(call[1]['base_residual'] is not None for call in jacobian_spy.call_args_list)
+
+@pytest.mark.parametrize('method', ['leastsq', 'brute'])
+def test_optim_cache(setup_cte_sim, mocker, tmp_path, monkeypatch, method):
+    '''Test that a second optimization reuses the evaluations saved to disk by the first one'''
+    monkeypatch.chdir(tmp_path)
+    init_param = np.array([proc.value for proc in setup_cte_sim['optimization']['processes']])
+    mocked_errors = mocker.Mock(side_effect=lambda function, sim:
+        2 + (np.array([proc.value for proc in sim.cte.optimization['processes']]) - 1.1*init_param)**2)
+    mocker.patch('simetuc.optimize._simulate_errors', new=mocked_errors)
+    setup_cte_sim['optimization']['method'] = method
+    setup_cte_sim['optimization']['options']['N_points'] = 3
+    setup_cte_sim['optimization']['options']['cache'] = True
+
+    with temp_bin_filename() as temp_filename:
+        first_solution = optimize.optimize_dynamics(setup_cte_sim, full_path=temp_filename)
+        num_simulations = mocked_errors.call_count
+        assert first_solution.cache_misses == num_simulations
+        assert os.path.isfile(os.path.join('results', setup_cte_sim.lattice['name'],
+                                           'optim_cache_{}uc_{}S_{}A.hdf5'.format(
+                                               int(setup_cte_sim.lattice['N_uc']),
+                                               float(setup_cte_sim.lattice['S_conc']),
+                                               float(setup_cte_sim.lattice['A_conc']))))
+
+        # reset the initial values
+        for process, value in zip(setup_cte_sim['optimization']['processes'], init_param):
+            process.value = value
+        second_solution = optimize.optimize_dynamics(setup_cte_sim, full_path=temp_filename)
+
+    assert mocked_errors.call_count == num_simulations
+    assert second_solution.cache_hit_rate == 1
+    assert np.allclose(first_solution.best_params, second_solution.best_params)
+
+    # the average equations are different evaluations
+    with temp_bin_filename() as temp_filename:
+        optimize.optimize_dynamics(setup_cte_sim, full_path=temp_filename, average=True)
+    assert mocked_errors.call_count > num_simulations
+
+def test_optim_cache_key(setup_cte_sim):
+    '''Test that the key of the cache depends on the parameters and excitations'''
+    sim = simulations.Simulations(setup_cte_sim)
+    cache = optimize.EvaluationCache('cache.hdf5')
+    key = cache.get_key(sim)
+    assert cache.get_key(sim) == key
+    assert optimize.EvaluationCache('cache.hdf5', context=('fun', True, None)).get_key(sim) != key
+
+    sim.cte.simulation_params['jobs'] = 4
+    assert cache.get_key(sim) == key
+
+    process = sim.cte.optimization['processes'][0]
+    process.value = process.value*(1 + 1e-12)
+    assert cache.get_key(sim) != key
+
+def test_optim_cache_key_excitations(setup_cte_sim):
+    '''Test that the key doesn't depend on which of the optimized excitations is active'''
+    sim = simulations.Simulations(setup_cte_sim)
+    labels = list(sim.cte.excitations.keys())
+    sim.cte.optimization['excitations'] = labels
+    cache = optimize.EvaluationCache('cache.hdf5')
+    key = cache.get_key(sim)
+    for label in labels:
+        for exc in sim.cte.excitations[label]:
+            exc.active = not exc.active
+    assert cache.get_key(sim) == key
+
+    sim.cte.excitations[labels[0]][0].power_dens *= 2
+    assert cache.get_key(sim) != key
+
+@pytest.mark.parametrize('function', ['optimize_dynamics', 'optimize_concentrations'])
+def test_optim_surrogate(setup_cte, mocker, function):
+    '''Test that the surrogate method finds the minimum with few simulations'''
+    init_param = np.array([proc.value for proc in setup_cte['optimization']['processes']])
+    def mocked_optim_fun(function, params, sim):
+        values = np.array([val for val in params.valuesdict().values()])
+        return values/(2*init_param) - 1
+    mocked = mocker.patch('simetuc.optimize.optim_fun', side_effect=mocked_optim_fun)
+
+    setup_cte['optimization']['method'] = 'surrogate'
+    setup_cte['optimization']['options']['max_evals'] = 40
+    setup_cte['simulation_params']['seed'] = 1
+    with temp_bin_filename() as temp_filename:
+        optim_solution = getattr(optimize, function)(setup_cte, full_path=temp_filename)
+
+    # the initial error is about 0.7
+    assert optim_solution.min_f < 0.1
+    assert optim_solution.result.method == 'surrogate'
+    # the final residual is evaluated again
+    assert mocked.call_count <= 40 + 1
+    assert np.allclose(optim_solution.best_params, 2*init_param, rtol=0.1)
+
+def test_optim_surrogate_seed(setup_cte, mocker):
+    '''Test that the surrogate method is reproducible with a seed'''
+    init_param = np.array([proc.value for proc in setup_cte['optimization']['processes']])
+    def mocked_optim_fun(function, params, sim):
+        values = np.array([val for val in params.valuesdict().values()])
+        return values/(2*init_param) - 1
+    mocker.patch('simetuc.optimize.optim_fun', new=mocked_optim_fun)
+
+    setup_cte['optimization']['method'] = 'surrogate'
+    setup_cte['optimization']['options']['max_evals'] = 15
+    setup_cte['simulation_params']['seed'] = 2
+    with temp_bin_filename() as temp_filename:
+        first_solution = optimize.optimize_dynamics(setup_cte, full_path=temp_filename)
+        second_solution = optimize.optimize_dynamics(setup_cte, full_path=temp_filename)
+    assert np.array_equal(first_solution.best_params, second_solution.best_params)
+
+@pytest.mark.parametrize('function', ['optimize_dynamics', 'optimize_concentrations'])
+def test_optim_prefit(setup_cte, mocker, function):
+    '''Test that the microscopic optimization starts from the average one with narrower bounds'''
+    init_param = np.array([proc.value for proc in setup_cte['optimization']['processes']])
+    evaluations = []
+    def mocked_optim_fun(fun, params, sim):
+        values = np.array([val for val in params.valuesdict().values()])
+        evaluations.append((fun.keywords['average'], values))
+        return values/(2*init_param) - 1
+    mocker.patch('simetuc.optimize.optim_fun', new=mocked_optim_fun)
+    setup_cte['optimization']['method'] = 'SLSQP'
+    old_options = dict(setup_cte['optimization']['options'])
+
+    with temp_bin_filename() as temp_filename:
+        optim_solution = optimize.optimize_prefit(getattr(optimize, function), setup_cte,
+                                                  full_path=temp_filename)
+
+    avg_values = [values for average, values in evaluations if average]
+    micro_values = [values for average, values in evaluations if not average]
+    assert avg_values and micro_values
+    assert evaluations.index((False, micro_values[0])) > len(avg_values) - 1
+    avg_best = avg_values[-1]
+    for values in micro_values:
+        assert np.all(values >= avg_best/10*(1 - 1e-6)) and np.all(values <= avg_best*10*(1 + 1e-6))
+    # a few microscopic evaluations, with the final ones by lmfit
+    assert len(micro_values) <= 5*(len(init_param)+1) + 2
+    assert setup_cte['optimization']['options'] == old_options
+
+    assert len(optim_solution.optim_progress) == len(evaluations) + 2
+    assert optim_solution.min_f < 0.1
+
+def test_optim_prefit_strength_avg(setup_cte, mocker):
+    '''A process with a separate strength_avg skips the pre-fit with a warning'''
+    init_param = np.array([proc.value for proc in setup_cte['optimization']['processes']])
+    evaluations = []
+    def mocked_optim_fun(fun, params, sim):
+        values = np.array([val for val in params.valuesdict().values()])
+        evaluations.append(fun.keywords['average'])
+        return values/(2*init_param) - 1
+    mocker.patch('simetuc.optimize.optim_fun', new=mocked_optim_fun)
+    setup_cte['optimization']['method'] = 'SLSQP'
+    process = setup_cte['optimization']['processes'][0]
+    assert not process.has_strength_avg
+    process.strength_avg = 10*process.strength
+    assert process.has_strength_avg
+
+    with temp_bin_filename() as temp_filename:
+        with pytest.warns(ConfigWarning, match=process.name):
+            optim_solution = optimize.optimize_prefit(optimize.optimize_dynamics, setup_cte,
+                                                      full_path=temp_filename)
+
+    assert evaluations and not any(evaluations)
+    assert process.strength_avg == 10*init_param[0]
+    assert optim_solution.min_f < 0.1
+
 def test_optim_save_txt(setup_cte, mocker):
     '''Test that the optim solution is saved as text correctly'''
     init_param = np.array([proc.value for proc in setup_cte['optimization']['processes']])
@@ -1365,6 +1365,16 @@ def test_optim_wrong_excitations(): # ok
     assert excinfo.match(r"not found in excitations section above!")
     assert excinfo.type == settings.LabelError
 
+def test_optim_cache(): # ok
+    data = data_ET_ok + '''optimization:
+        options:
+            cache: True'''
+
+    with temp_config_filename(data) as filename:
+        cte = settings.load(filename)
+
+    assert cte.optimization['options']['cache'] is True
+
 # test simulation params
 data_sim_params = '''simulation_params:
     rtol: 1e-3
@@ -1383,6 +1393,93 @@ def test_sim_params_config1(): # ok
                                             ('N_steps_pulse', 100),
                                             ('N_steps', 1000)])
 
+def test_sim_params_jacobian(): # ok
+    data = data_ET_ok + data_sim_params + '''    jacobian: sparse
+'''
+    with temp_config_filename(data) as filename:
+        cte = settings.load(filename)
+    assert cte.simulation_params['jacobian'] == 'sparse'
+
+def test_sim_params_wrong_jacobian(): # wrong jacobian type
+    data = data_ET_ok + data_sim_params + '''    jacobian: dense_and_sparse
+'''
+    with pytest.raises(SettingsValueError) as excinfo:
+        with temp_config_filename(data) as filename:
+            settings.load(filename)
+    assert excinfo.match(r"must be \"dense\" or \"sparse\"")
+    assert excinfo.type == SettingsValueError
+
+def test_sim_params_backend(): # ok
+    data = data_ET_ok + data_sim_params + '''    backend: numba
+'''
+    with temp_config_filename(data) as filename:
+        cte = settings.load(filename)
+    assert cte.simulation_params['backend'] == 'numba'
+
+def test_sim_params_wrong_backend(): # wrong backend
+    data = data_ET_ok + data_sim_params + '''    backend: fortran
+'''
+    with pytest.raises(SettingsValueError) as excinfo:
+        with temp_config_filename(data) as filename:
+            settings.load(filename)
+    assert excinfo.match(r"must be \"scipy\" or \"numba\"")
+    assert excinfo.type == SettingsValueError
+
+def test_sim_params_seed(): # ok
+    data = data_ET_ok + data_sim_params + '''    seed: 42
+'''
+    with temp_config_filename(data) as filename:
+        cte = settings.load(filename)
+    assert cte.simulation_params['seed'] == 42
+
+def test_sim_params_output(): # ok
+    data = data_ET_ok + data_sim_params + '''    output: average
+'''
+    with temp_config_filename(data) as filename:
+        cte = settings.load(filename)
+    assert cte.simulation_params['output'] == 'average'
+
+def test_sim_params_wrong_output(): # wrong output mode
+    data = data_ET_ok + data_sim_params + '''    output: some
+'''
+    with pytest.raises(SettingsValueError) as excinfo:
+        with temp_config_filename(data) as filename:
+            settings.load(filename)
+    assert excinfo.match(r"must be \"full\" or \"average\"")
+    assert excinfo.type == SettingsValueError
+
+def test_sim_params_compression(): # ok
+    data = data_ET_ok + data_sim_params + '''    compression: gzip
+'''
+    with temp_config_filename(data) as filename:
+        cte = settings.load(filename)
+    assert cte.simulation_params['compression'] == 'gzip'
+
+def test_sim_params_wrong_compression(): # wrong compression
+    data = data_ET_ok + data_sim_params + '''    compression: zip
+'''
+    with pytest.raises(SettingsValueError) as excinfo:
+        with temp_config_filename(data) as filename:
+            settings.load(filename)
+    assert excinfo.match(r"must be \"lzf\", \"gzip\" or \"none\"")
+    assert excinfo.type == SettingsValueError
+
+def test_sim_params_steady_state(): # ok
+    data = data_ET_ok + data_sim_params + '''    steady_state: integrate
+'''
+    with temp_config_filename(data) as filename:
+        cte = settings.load(filename)
+    assert cte.simulation_params['steady_state'] == 'integrate'
+
+def test_sim_params_wrong_steady_state(): # wrong steady state method
+    data = data_ET_ok + data_sim_params + '''    steady_state: guess
+'''
+    with pytest.raises(SettingsValueError) as excinfo:
+        with temp_config_filename(data) as filename:
+            settings.load(filename)
+    assert excinfo.match(r"must be \"newton\" or \"integrate\"")
+    assert excinfo.type == SettingsValueError
+
 
 def test_pow_dep_config1(): # ok
     data = data_ET_ok + '''power_dependence: [1e0, 1e7, 8]'''
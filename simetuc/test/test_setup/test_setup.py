@@ -790,6 +790,243 @@ def test_random_wrong_lattice(setup_cte, params, absorption, problem):
              absorption_matrix, decay_matrix, ET_matrix,
              N_indices, jac_indices, coop_ET_matrix, coop_N_indices, coop_jac_indices) = setup_func(setup_cte, full_path=temp_filename)
 
+@pytest.mark.parametrize('average', [False, True])
+def test_incremental_eqs(setup_cte, average):
+    '''Test that the incremental setup only rebuilds the absorption matrix
+        and that it's the same as a full setup'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    setup_cte['excitations']['NIR_800'][0].active = True
+    setup_cte['excitations']['NIR_800'][1].active = True
+
+    cte, incremental_eqs = precalculate.setup_incremental_eqs(setup_cte, average=average,
+                                                              full_path=test_filename)
+    setup_func = precalculate.setup_average_eqs if average else precalculate.setup_microscopic_eqs
+
+    for power_dens in [1e1, 1e3, 1e5]:
+        for exc_list in cte.excitations.values():
+            for exc in exc_list:
+                exc.power_dens = power_dens
+        equations = incremental_eqs.equations(cte.excitations)
+        (_, *good_equations) = setup_func(cte, full_path=test_filename)
+
+        assert len(equations) == len(good_equations)
+        total_abs_matrix = equations[3]
+        good_abs_matrix = good_equations[3]
+        assert np.array_equal(total_abs_matrix.toarray(), good_abs_matrix.toarray())
+        # the power independent matrices are always the same objects
+        assert equations[4] is incremental_eqs.equations(cte.excitations)[4]
+        for elem, good_elem in zip(equations[4:], good_equations[4:]):
+            if sparse.issparse(elem):
+                elem, good_elem = elem.toarray(), good_elem.toarray()
+            assert np.array_equal(elem, good_elem)
+
+def test_average_eqs_ET_strength(setup_cte):
+    '''Test that the average equations use strength_avg without changing the settings'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    processes = list(setup_cte['energy_transfer'].values())
+    strengths = [process.strength for process in processes]
+    processes[0]._strength_avg = 10*strengths[0]
+
+    precalculate.setup_average_eqs(setup_cte, full_path=test_filename)
+    assert [process.strength for process in processes] == strengths
+
+    # the new value of a process is used, like in the optimization
+    processes[1].value = 3*strengths[1]
+    assert processes[1].strength_avg == 3*strengths[1]
+
+def test_lattice_cache(setup_cte, mocker):
+    '''Test that the lattice data is read from disk only once'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    precalculate.clear_lattice_cache()
+    spy_read = mocker.spy(precalculate, '_read_lattice_data')
+
+    (cte, initial_population, index_S_i, index_A_j,
+     total_abs_matrix, *_) = precalculate.setup_microscopic_eqs(setup_cte, full_path=test_filename)
+    assert spy_read.call_count == 1
+    assert len(precalculate._lattice_cache) == 1
+
+    (cte, initial_population2, index_S_i2, index_A_j2,
+     total_abs_matrix2, *_) = precalculate.setup_microscopic_eqs(setup_cte, full_path=test_filename)
+    assert spy_read.call_count == 1
+    assert index_S_i == index_S_i2 and index_A_j == index_A_j2
+    assert np.array_equal(initial_population, initial_population2)
+    assert np.array_equal(total_abs_matrix.toarray(), total_abs_matrix2.toarray())
+
+    # a different lattice is read from disk
+    precalculate.setup_microscopic_eqs(setup_cte, full_path=os.path.join(test_folder_path,
+                                                                         'data_1S_1A.hdf5'))
+    assert spy_read.call_count == 2
+    assert len(precalculate._lattice_cache) == 2
+
+    # no cache
+    setup_cte['simulation_params']['lattice_cache_size'] = 0
+    precalculate.setup_microscopic_eqs(setup_cte, full_path=test_filename)
+    assert spy_read.call_count == 3
+    assert len(precalculate._lattice_cache) == 0
+
+def test_lattice_data_csr():
+    '''Test that the interactions are read as CSR arrays, without padding'''
+    test_filename = os.path.join(test_folder_path, 'data_3S_2A.hdf5')
+    lattice_data = precalculate._read_lattice_data(test_filename)
+    num_S = np.count_nonzero(np.array(lattice_data['index_S_i']) != -1)
+    num_A = np.count_nonzero(np.array(lattice_data['index_A_j']) != -1)
+    for label, num_ions, num_others in [('S_k', num_S, num_S-1), ('S_l', num_S, num_A),
+                                        ('A_k', num_A, num_S), ('A_l', num_A, num_A-1)]:
+        indptr = lattice_data['indptr_' + label]
+        assert len(indptr) == num_ions + 1
+        assert np.all(np.diff(indptr) == num_others)
+        assert lattice_data['indices_' + label].shape == (indptr[-1], )
+        assert lattice_data['dists_' + label].shape == (indptr[-1], )
+        assert np.all(lattice_data['indices_' + label] != -1)
+
+@pytest.mark.parametrize('cache_size', [500, 0])
+def test_lattice_cache_read_only(setup_cte, cache_size):
+    '''Test that the arrays of the lattice data can't be modified by the callers'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    precalculate.clear_lattice_cache()
+    setup_cte['simulation_params']['lattice_cache_size'] = cache_size
+
+    lattice_data = precalculate._load_lattice_data(test_filename, setup_cte)
+    for label in ['indices_S_k', 'dists_S_k', 'indices_A_l', 'dists_A_l', 'initial_population']:
+        assert not lattice_data[label].flags.writeable
+        with pytest.raises(ValueError):
+            lattice_data[label][0] = 0
+    lattice_data['index_S_i'].append(-1)
+
+    lattice_data2 = precalculate._load_lattice_data(test_filename, setup_cte)
+    assert lattice_data2['index_S_i'] == lattice_data['index_S_i'][:-1]
+
+def test_lattice_cache_modified_file(setup_cte, mocker):
+    '''Test that a lattice file that changed on disk is read again'''
+    cte = setup_cte
+    cte['lattice']['S_conc'] = 10.5
+    cte['lattice']['A_conc'] = 5.2
+    cte['lattice']['N_uc'] = 7
+    cte['states']['sensitizer_states'] = 2
+    cte['states']['activator_states'] = 7
+    precalculate.clear_lattice_cache()
+    spy_read = mocker.spy(precalculate, '_read_lattice_data')
+
+    with temp_bin_filename() as temp_filename:
+        precalculate.setup_microscopic_eqs(cte, full_path=temp_filename)
+        num_reads = spy_read.call_count
+        precalculate.setup_microscopic_eqs(cte, full_path=temp_filename)
+        assert spy_read.call_count == num_reads
+
+        (cte, initial_population, *_) = precalculate.setup_microscopic_eqs(cte, gen_lattice=True,
+                                                                           full_path=temp_filename)
+        assert spy_read.call_count == num_reads + 1
+        assert initial_population.flags.writeable
+
+def test_lattice_cache_regenerated_file(setup_cte, mocker):
+    '''Test that a regenerated lattice is read from disk even if the file seems the same'''
+    cte = setup_cte
+    cte['lattice']['S_conc'] = 10.5
+    cte['lattice']['A_conc'] = 5.2
+    cte['lattice']['N_uc'] = 7
+    cte['states']['sensitizer_states'] = 2
+    cte['states']['activator_states'] = 7
+    precalculate.clear_lattice_cache()
+
+    with temp_bin_filename() as temp_filename:
+        (cte, _, old_index_S_i, *_) = precalculate.setup_microscopic_eqs(cte,
+                                                                          full_path=temp_filename)
+        # file system with coarse timestamps: the regenerated file has the same size and mtime
+        file_stat = os.stat(temp_filename)
+        real_stat = os.stat
+        mocker.patch('os.stat', side_effect=lambda path, *args, **kwargs:
+                     file_stat if path == temp_filename else real_stat(path, *args, **kwargs))
+        spy_ET = mocker.spy(precalculate, '_create_ET_topology')
+
+        cte['lattice']['seed'] = 1
+        (cte, _, index_S_i, *_) = precalculate.setup_microscopic_eqs(cte, gen_lattice=True,
+                                                                     full_path=temp_filename)
+        assert index_S_i == precalculate._read_lattice_data(temp_filename)['index_S_i']
+        assert index_S_i != old_index_S_i
+        assert spy_ET.call_count == 1
+
+def test_ET_topology_cache(setup_cte, mocker):
+    '''Test that changing the ET strengths only rescales the cached ET matrices'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    precalculate.clear_lattice_cache()
+    spy_ET = mocker.spy(precalculate, '_create_ET_topology')
+    spy_coop = mocker.spy(precalculate, '_create_coop_ET_topology')
+
+    precalculate.setup_microscopic_eqs(setup_cte, full_path=test_filename)
+    assert spy_ET.call_count == 1 and spy_coop.call_count == 1
+
+    for process in setup_cte.energy_transfer.values():
+        process.strength = 2.5*process.strength
+    (cte, *_, ET_matrix, N_indices, jac_indices,
+     coop_ET_matrix, coop_N_indices,
+     coop_jac_indices) = precalculate.setup_microscopic_eqs(setup_cte, full_path=test_filename)
+    assert spy_ET.call_count == 1 and spy_coop.call_count == 1
+
+    (cte, initial_population, index_S_i, index_A_j, *_) = precalculate.setup_microscopic_eqs(cte, full_path=test_filename)
+    lattice_data = precalculate._read_lattice_data(test_filename)
+    good_ET_matrix, good_N_indices = precalculate._create_ET_matrices(index_S_i, index_A_j, cte.energy_transfer,
+                                                                      lattice_data['indptr_S_k'], lattice_data['indptr_S_l'],
+                                                                      lattice_data['indptr_A_k'], lattice_data['indptr_A_l'],
+                                                                      lattice_data['indices_S_k'], lattice_data['indices_S_l'],
+                                                                      lattice_data['indices_A_k'], lattice_data['indices_A_l'],
+                                                                      lattice_data['dists_S_k'], lattice_data['dists_S_l'],
+                                                                      lattice_data['dists_A_k'], lattice_data['dists_A_l'],
+                                                                      cte.states['sensitizer_states'],
+                                                                      cte.states['activator_states'])
+    assert np.array_equal(ET_matrix.toarray(), good_ET_matrix.toarray())
+    assert np.array_equal(N_indices, good_N_indices)
+
+    # a process with zero strength changes the matrices
+    num_calls = spy_ET.call_count
+    for process in setup_cte.energy_transfer.values():
+        process.strength = 0
+    (cte, *_, ET_matrix, N_indices, jac_indices,
+     coop_ET_matrix, coop_N_indices,
+     coop_jac_indices) = precalculate.setup_microscopic_eqs(setup_cte, full_path=test_filename)
+    assert spy_ET.call_count == num_calls + 1
+    assert ET_matrix.shape[1] == 0
+
+def test_no_coop_interactions(setup_cte):
+    '''Test a lattice without cooperative interactions closer than d_max_coop'''
+    cte = setup_cte
+    cte['lattice']['S_conc'] = 20
+    cte['lattice']['A_conc'] = 2
+    cte['lattice']['N_uc'] = 5
+    cte['lattice']['d_max_coop'] = 1.0
+    cte['states']['sensitizer_states'] = 2
+    cte['states']['activator_states'] = 7
+
+    with temp_bin_filename() as temp_filename:
+        (cte, initial_population, index_S_i, index_A_j,
+         total_abs_matrix, decay_matrix, ET_matrix,
+         N_indices, jac_indices, coop_ET_matrix, coop_N_indices, coop_jac_indices) = precalculate.setup_microscopic_eqs(cte, full_path=temp_filename)
+
+    num_states = cte['states']['energy_states']
+    assert ET_matrix.shape[1] > 0
+    assert coop_ET_matrix.shape == (num_states, 0)
+    assert coop_N_indices.shape == (0, 3)
+
+@pytest.mark.parametrize('index_S_i, index_A_j', [([0, -1, 2, -1], [-1, 4, -1, 11]),
+                                                   ([-1, -1], [0, 7]),
+                                                   ([0, 2], [-1, -1])],
+                         ids=['2S_2A', '0S_2A', '2S_0A'])
+def test_average_populations(index_S_i, index_A_j):
+    '''Test the average populations against a loop over all ions'''
+    sensitizer_states, activator_states = 2, 7
+    num_states = max(index_S_i[-1]+sensitizer_states, index_A_j[-1]+activator_states)
+    y_sol = np.random.random((50, num_states))
+
+    populations = precalculate.average_populations(y_sol, index_S_i, index_A_j,
+                                                   sensitizer_states, activator_states)
+
+    for first_state, indices, ion_states in ((0, index_S_i, sensitizer_states),
+                                             (sensitizer_states, index_A_j, activator_states)):
+        indices = [index for index in indices if index != -1]
+        for state in range(ion_states):
+            expected = (np.mean([y_sol[:, index+state] for index in indices], axis=0)
+                        if indices else np.zeros((50,)))
+            assert np.allclose(populations[first_state+state], expected)
+
 def test_get_lifetimes(setup_cte):
 
     cte = setup_cte
@@ -14,11 +14,12 @@ with warnings.catch_warnings():
 import numpy as np
 
 import simetuc.simulations as simulations
+import simetuc.odesolver as odesolver
+import simetuc.precalculate as precalculate
 import simetuc.plotter as plotter
 from simetuc.util import temp_config_filename, temp_bin_filename, IonType, DecayTransition
 from simetuc.util import Excitation
 from simetuc.settings import Settings
-### TODO: Test loading exp data with different formats
 
 
 test_folder_path = os.path.dirname(os.path.abspath(__file__))
@@ -90,6 +91,294 @@ def test_sim_dyn_2S_2A(setup_cte_sim):
          y_sol = np.array(file['y_sol'])
     assert np.allclose(y_sol, solution.y_sol)
 
+def test_sim_dyn_2S_2A_sparse_jacobian(setup_cte_sim):
+    '''Test that the sparse jacobian gives the same result as the dense one'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    setup_cte_sim['simulation_params']['jacobian'] = 'sparse'
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+
+    solution = sim.simulate_dynamics()
+
+    with h5py.File(os.path.join(test_folder_path, 't_sol_2S_2A.hdf5')) as file:
+         t_sol = np.array(file['t_sol'])
+    assert np.allclose(t_sol, solution.t_sol)
+
+    with h5py.File(os.path.join(test_folder_path, 'y_sol_2S_2A.hdf5')) as file:
+         y_sol = np.array(file['y_sol'])
+    assert np.allclose(y_sol, solution.y_sol, rtol=1e-3, atol=1e-6)
+
+def test_sim_steady_2S_2A_sparse_jacobian(setup_cte_sim):
+    '''Test that the steady state is the same with the dense and sparse jacobians'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution_dense = sim.simulate_steady_state()
+
+    sim.cte['simulation_params']['jacobian'] = 'sparse'
+    solution_sparse = sim.simulate_steady_state()
+
+    assert np.allclose(solution_dense.steady_state_populations,
+                       solution_sparse.steady_state_populations, rtol=1e-3, atol=1e-6)
+
+@pytest.mark.parametrize('backend', ['scipy', 'numba'])
+@pytest.mark.parametrize('average', [False, True])
+def test_sim_CW_steady_newton(setup_cte_sim, average, backend):
+    '''Test that Newton's method gives the same steady state as integrating the equations'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    for exc_list in setup_cte_sim.excitations.values():
+        for exc in exc_list:
+            exc.t_pulse = None
+    setup_cte_sim['simulation_params']['backend'] = backend
+    setup_cte_sim['simulation_params']['steady_state'] = 'integrate'
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution_integrate = sim.simulate_steady_state(average=average)
+
+    sim.cte['simulation_params']['steady_state'] = 'newton'
+    solution_newton = sim.simulate_steady_state(average=average)
+
+    assert len(solution_newton.t_sol) == 2
+    assert np.allclose(solution_integrate.steady_state_populations,
+                       solution_newton.steady_state_populations, rtol=1e-3, atol=1e-8)
+
+def test_sim_CW_steady_newton_fallback(setup_cte_sim, mocker):
+    '''Test that the equations are integrated if Newton's method fails'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    for exc_list in setup_cte_sim.excitations.values():
+        for exc in exc_list:
+            exc.t_pulse = None
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    mocked_newton = mocker.patch('simetuc.odesolver.solve_steady_state', return_value=None)
+    mocked_ode = mocker.patch('simetuc.odesolver._solve_ode')
+    mocked_ode.return_value = np.random.random((1000, setup_cte_sim.states['energy_states']))
+
+    solution = sim.simulate_steady_state()
+
+    assert mocked_newton.call_count == 1
+    assert mocked_ode.call_count == 1
+    assert solution
+
+def test_sim_CW_steady_newton_no_iterations(setup_cte_sim, mocker):
+    '''Test that Newton's method without iterations fails and the equations are integrated'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    for exc_list in setup_cte_sim.excitations.values():
+        for exc in exc_list:
+            exc.t_pulse = None
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solve_steady_state = odesolver.solve_steady_state
+    newton_results = []
+    def mocked_solve_steady_state(*args, **kwargs):
+        newton_results.append(solve_steady_state(*args, max_iter=0, **kwargs))
+        return newton_results[-1]
+    mocker.patch('simetuc.odesolver.solve_steady_state', new=mocked_solve_steady_state)
+
+    solution = sim.simulate_steady_state()
+
+    assert newton_results == [None]
+    assert len(solution.t_sol) > 2
+
+def test_sim_CW_steady_plot(setup_cte_sim, mocker):
+    '''Test that the steady state populations are plotted, not their evolution'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    for exc_list in setup_cte_sim.excitations.values():
+        for exc in exc_list:
+            exc.t_pulse = None
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution = sim.simulate_steady_state()
+    assert len(solution.t_sol) == 2
+    mocked_decay = mocker.spy(plotter, 'plot_avg_decay_data')
+    mocked_bars = mocker.spy(plotter, 'plot_steady_state_populations')
+
+    solution.plot()
+
+    assert mocked_decay.call_count == 0
+    assert mocked_bars.call_count == 1
+    populations, labels = mocked_bars.call_args[0]
+    index_GS_A = setup_cte_sim.states['sensitizer_states']
+    assert np.allclose(populations, np.delete(solution.steady_state_populations, [0, index_GS_A]))
+    assert labels == [label for num, label in enumerate(solution.state_labels)
+                      if num not in {0, index_GS_A}]
+    plotter.plt.close('all')
+
+@pytest.mark.parametrize('jacobian', ['dense', 'sparse'])
+def test_numba_kernels(setup_cte, jacobian):
+    '''Test that the compiled rhs and jacobian are the same as the scipy functions'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    (cte, initial_population, index_S_i, index_A_j,
+     abs_matrix, decay_matrix,
+     ET_matrix, N_indices, jac_indices,
+     coop_ET_matrix, coop_N_indices,
+     coop_jac_indices) = precalculate.setup_microscopic_eqs(setup_cte, full_path=test_filename)
+    assert coop_N_indices.shape[0] > 0
+
+    y = np.random.random(initial_population.shape)
+    matrices = (decay_matrix, ET_matrix, N_indices, jac_indices,
+                coop_ET_matrix, coop_N_indices, coop_jac_indices)
+    fun, jfun = odesolver._setup_numba_kernels(abs_matrix, *matrices, jacobian=jacobian)
+    fun_relax, jfun_relax = odesolver._setup_numba_kernels(None, *matrices, jacobian=jacobian)
+
+    fargs = (decay_matrix, ET_matrix, N_indices, coop_ET_matrix, coop_N_indices)
+    jargs = (decay_matrix, ET_matrix, jac_indices, coop_ET_matrix, coop_jac_indices)
+    assert np.allclose(fun(0, y), odesolver._rate_eq_pulse(0, y, abs_matrix, *fargs))
+    assert np.allclose(fun_relax(0, y), odesolver._rate_eq(0, y, *fargs))
+
+    jac = jfun(0, y)
+    jac_relax = jfun_relax(0, y)
+    if jacobian == 'sparse':
+        jac = jac.toarray()
+        jac_relax = jac_relax.toarray()
+    assert np.allclose(jac, odesolver._jac_rate_eq_pulse(0, y, abs_matrix, *jargs))
+    assert np.allclose(jac_relax, odesolver._jac_rate_eq(0, y, *jargs))
+
+@pytest.mark.parametrize('jacobian', ['dense', 'sparse'])
+def test_sim_dyn_2S_2A_numba(setup_cte_sim, jacobian):
+    '''Test that the numba backend gives the same result as the scipy one'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    setup_cte_sim['simulation_params']['jacobian'] = jacobian
+    setup_cte_sim['simulation_params']['backend'] = 'numba'
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+
+    solution = sim.simulate_dynamics()
+
+    with h5py.File(os.path.join(test_folder_path, 't_sol_2S_2A.hdf5')) as file:
+         t_sol = np.array(file['t_sol'])
+    assert np.allclose(t_sol, solution.t_sol)
+
+    with h5py.File(os.path.join(test_folder_path, 'y_sol_2S_2A.hdf5')) as file:
+         y_sol = np.array(file['y_sol'])
+    assert np.allclose(y_sol, solution.y_sol, rtol=1e-3, atol=1e-6)
+
+@pytest.mark.parametrize('jacobian', ['dense', 'sparse'])
+def test_sim_dyn_2S_2A_output_average(setup_cte_sim, jacobian):
+    '''Test that reducing the output while solving gives the same averages and observables'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    setup_cte_sim['simulation_params']['jacobian'] = jacobian
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+
+    full_sol = sim.simulate_dynamics()
+    num_states = full_sol.y_sol.shape[1]
+    projection = np.random.random((3, num_states))
+    ions = [0, 3]
+    avg_sol = sim.simulate_dynamics(output='average', ions=ions, projection=projection)
+
+    assert avg_sol.y_sol.shape == (full_sol.y_sol.shape[0], len(full_sol.list_avg_data))
+    assert avg_sol.index_S_i == [0, -1]
+    assert avg_sol.index_A_j == [-1, setup_cte_sim.states['sensitizer_states']]
+    assert np.allclose(full_sol.list_avg_data, avg_sol.list_avg_data, rtol=1e-3, atol=1e-6)
+    assert np.allclose(full_sol.errors, avg_sol.errors, rtol=1e-3, atol=1e-6)
+    for ion in ions:
+        index = full_sol.index_S_i[ion] if full_sol.index_S_i[ion] != -1 else full_sol.index_A_j[ion]
+        num_ion_states = avg_sol.ion_populations[ion].shape[1]
+        assert np.allclose(full_sol.y_sol[:, index:index+num_ion_states],
+                           avg_sol.ion_populations[ion], rtol=1e-3, atol=1e-6)
+    assert np.allclose(full_sol.y_sol.dot(projection.T), avg_sol.projected_data,
+                       rtol=1e-3, atol=1e-6)
+
+@pytest.mark.parametrize('compression', ['lzf', 'gzip', 'none'])
+def test_sim_dyn_2S_2A_stream(setup_cte_sim, compression):
+    '''Test that streaming the populations to a file gives the same solution'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    setup_cte_sim['simulation_params']['compression'] = compression
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution = sim.simulate_dynamics()
+
+    with temp_bin_filename() as stream_filename, temp_bin_filename() as other_filename:
+        with sim.simulate_dynamics(stream_to=stream_filename) as streamed_sol:
+            assert isinstance(streamed_sol.y_sol, h5py.Dataset)
+            assert np.allclose(solution.y_sol, streamed_sol.y_sol)
+            assert np.allclose(solution.list_avg_data, streamed_sol.list_avg_data)
+
+            # the populations are already in the file, only the rest is added
+            streamed_sol.save(stream_filename)
+            streamed_sol.save(other_filename)
+            for filename in (stream_filename, other_filename):
+                loaded_sol = simulations.DynamicsSolution.load(filename)
+                assert np.allclose(loaded_sol.t_sol, solution.t_sol)
+                assert np.allclose(loaded_sol.y_sol, solution.y_sol)
+                assert np.allclose(loaded_sol.list_avg_data, solution.list_avg_data)
+        assert not streamed_sol.y_sol
+
+def test_sim_dyn_2S_2A_stream_resume(setup_cte_sim, mocker):
+    '''Test that an interrupted streamed simulation continues from the last time step,
+        but only if resume=True and the equations are the same'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution = sim.simulate_dynamics()
+    num_steps = solution.y_sol.shape[0]
+
+    def interrupt(filename):
+        '''Keep only the first 600 steps in the file'''
+        with h5py.File(filename, 'a') as file:
+            file['y_sol'].resize(600, axis=0)
+            file['y_sol'].attrs['num_steps'] = 600
+
+    with temp_bin_filename() as stream_filename:
+        sim.simulate_dynamics(stream_to=stream_filename).close()
+        interrupt(stream_filename)
+
+        spy = mocker.spy(odesolver, '_solve_ode')
+        with sim.simulate_dynamics(stream_to=stream_filename, resume=True) as resumed_sol:
+            # the relaxation only solved the remaining times
+            assert len(spy.call_args_list[-1][0][0]) == num_steps - 599
+            assert resumed_sol.y_sol.shape == solution.y_sol.shape
+            assert np.allclose(solution.list_avg_data, resumed_sol.list_avg_data,
+                               rtol=1e-3, atol=1e-6)
+
+        # by default the file is overwritten
+        interrupt(stream_filename)
+        sim.simulate_dynamics(stream_to=stream_filename).close()
+        assert len(spy.call_args_list[-1][0][0]) == num_steps
+
+        # different equations are never resumed
+        interrupt(stream_filename)
+        for process in sim.cte.energy_transfer.values():
+            process.strength *= 100
+        changed_sol = sim.simulate_dynamics()
+        with sim.simulate_dynamics(stream_to=stream_filename, resume=True) as streamed_sol:
+            assert len(spy.call_args_list[-1][0][0]) == num_steps
+            assert np.allclose(changed_sol.y_sol, streamed_sol.y_sol)
+            assert not np.allclose(solution.y_sol, streamed_sol.y_sol)
+
+def test_solution_writer():
+    '''Test the buffered writes of the SolutionWriter'''
+    t_sol = np.linspace(0, 1, 1000)
+    y_sol = np.random.random((1000, 5))
+    with temp_bin_filename() as filename:
+        with simulations.SolutionWriter(filename, t_sol, 5, compression='gzip') as writer:
+            assert writer.shape == (1000, 5)
+            for step in range(1000):
+                writer[step] = y_sol[step]
+        with h5py.File(filename, 'r') as file:
+            assert file['y_sol'].attrs['num_steps'] == 1000
+            assert file['y_sol'].compression == 'gzip'
+            assert np.allclose(file['y_sol'][()], y_sol)
+            assert np.allclose(file['t_sol'][()], t_sol)
+
+        # different times, it starts again
+        with simulations.SolutionWriter(filename, t_sol[:10], 5, resume=True) as writer:
+            assert writer.num_steps == 0
+
+    with pytest.raises(ValueError):
+        with temp_bin_filename() as filename:
+            simulations.SolutionWriter(filename, t_sol, 5, compression='zip')
+
+def test_sim_dyn_wrong_output(setup_cte_sim):
+    '''Test that a wrong output mode, ion or projection raise an error'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    with pytest.raises(ValueError):
+        sim.simulate_dynamics(output='some')
+    with pytest.raises(ValueError):
+        sim.simulate_dynamics(output='average', ions=[100])
+    with pytest.raises(ValueError):
+        sim.simulate_dynamics(projection=np.ones((2, 3)))
+
+def test_sim_wrong_backend(setup_cte_sim):
+    '''Test that a wrong backend raises an error'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    setup_cte_sim['simulation_params']['backend'] = 'fortran'
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    with pytest.raises(ValueError):
+        sim.simulate_dynamics()
+
 def test_sim_dyn_wrong_state_plot(setup_cte_sim):
     '''Test that you can't plot a wrong state.'''
     setup_cte_sim['lattice']['S_conc'] = 0
@@ -169,6 +458,39 @@ def test_sim_dyn_save_txt(setup_cte_sim):
     with temp_config_filename('') as filename:
         solution.save_txt(filename)
 
+def test_sim_dyn_load_lazy(setup_cte_sim, mocker):
+    '''Test that the solutions are loaded lazily from the hdf5 file'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution = sim.simulate_dynamics()
+    conc_solution = simulations.ConcentrationDependenceSolution(dynamics=True)
+    conc_solution.add_solutions([solution, sim.simulate_dynamics()])
+
+    with temp_bin_filename() as filename, temp_bin_filename() as list_filename:
+        solution.save(filename)
+        conc_solution.save(list_filename)
+
+        mocked_avg = mocker.patch('simetuc.precalculate.average_populations')
+        spy_settings = mocker.spy(simulations.settings, 'load_from_text')
+
+        with simulations.DynamicsSolution.load(filename, lazy=True) as lazy_sol:
+            assert isinstance(lazy_sol.y_sol, h5py.Dataset)
+            assert np.allclose(lazy_sol.y_sol, solution.y_sol)
+            assert np.allclose(lazy_sol.list_avg_data, solution.list_avg_data)
+            assert np.allclose(lazy_sol.errors, solution.errors)
+        assert not lazy_sol.y_sol
+
+        # the config is parsed once for all solutions, the averages aren't recalculated
+        spy_settings.reset_mock()
+        with simulations.ConcentrationDependenceSolution.load(list_filename,
+                                                              lazy=True) as lazy_list:
+            assert spy_settings.call_count == 1
+            for lazy_sol, sol in zip(lazy_list, conc_solution):
+                assert isinstance(lazy_sol.y_sol, h5py.Dataset)
+                assert np.allclose(lazy_sol.list_avg_data, sol.list_avg_data)
+            assert mocked_avg.call_count == 0
+        assert not any(lazy_sol.y_sol for lazy_sol in lazy_list)
+
 def test_sim_no_file_hdf5():
     '''Wrong filename'''
     with pytest.raises(OSError):
@@ -213,6 +535,92 @@ def test_sim_steady2(setup_cte_sim):
         solution = sim.simulate_avg_steady_state()
         assert solution
 
+@pytest.fixture(scope='function')
+def exp_data_folder(tmp_path, monkeypatch):
+    '''Empty expData/test_lattice folder in the current directory.'''
+    folder = tmp_path / 'expData' / 'test_lattice'
+    folder.mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(simulations, '_exp_data_cache', {})
+    monkeypatch.setattr(simulations, '_compiled_exp_data_cache', {})
+    return folder
+
+@pytest.mark.parametrize('delimiter', [' ', '\t', ',', ';'])
+def test_load_exp_data_formats(exp_data_folder, delimiter):
+    '''Test that all delimiters, comments and empty lines are read correctly'''
+    t = np.linspace(0, 1e-3, 100)
+    intensity = 100*np.exp(-t/1e-4)
+    lines = ['# time{}intensity'.format(delimiter), '']
+    lines += ['{}{}{}'.format(ti, delimiter, ii) for ti, ii in zip(t, intensity)]
+    (exp_data_folder / 'decay.txt').write_text('\n'.join(lines))
+
+    data = simulations.DynamicsSolution._load_exp_data('decay.txt', 'test_lattice')
+    assert data.shape == (100, 2)
+    assert np.allclose(data, simulations._normalize_exp_data(np.column_stack([t, intensity])))
+
+def test_load_exp_data_invalid(exp_data_folder):
+    '''Test that invalid or missing data is ignored'''
+    (exp_data_folder / 'decay.txt').write_text('1 2 3\n4 5 6\n')
+    with pytest.warns(UserWarning, match='Invalid experimental data'):
+        assert simulations.DynamicsSolution._load_exp_data('decay.txt', 'test_lattice') is None
+    assert simulations.DynamicsSolution._load_exp_data('missing.txt', 'test_lattice') is None
+
+def test_load_exp_data_cache(exp_data_folder, mocker):
+    '''Test that the data is only read again if the file changes'''
+    data_file = exp_data_folder / 'decay.txt'
+    data_file.write_text('\n'.join('{}\t{}'.format(i, 100-i) for i in range(100)))
+    spy = mocker.spy(simulations, '_read_exp_data')
+
+    data = simulations.DynamicsSolution._load_exp_data('decay.txt', 'test_lattice')
+    assert simulations.DynamicsSolution._load_exp_data('decay.txt', 'test_lattice') is data
+    assert spy.call_count == 1
+    assert not data.flags.writeable
+
+    data_file.write_text('\n'.join('{}\t{}'.format(i, 200-i) for i in range(200)))
+    os.utime(data_file, ns=(0, 0))
+    new_data = simulations.DynamicsSolution._load_exp_data('decay.txt', 'test_lattice')
+    assert spy.call_count == 2
+    assert new_data.shape == (200, 2)
+
+def test_compile_exp_data(exp_data_folder, mocker):
+    '''Test that the compiled data is used while the text files don't change'''
+    for num in range(3):
+        (exp_data_folder / 'decay_{}.txt'.format(num)).write_text(
+            '\n'.join('{},{}'.format(i, np.exp(-i/(10+num))) for i in range(100)))
+    (exp_data_folder / 'invalid.txt').write_text('1 2 3\n')
+    data = [simulations.DynamicsSolution._load_exp_data('decay_{}.txt'.format(num), 'test_lattice')
+            for num in range(3)]
+
+    with pytest.warns(UserWarning, match='Invalid experimental data'):
+        path = simulations.compile_exp_data('test_lattice')
+    assert os.path.isfile(path)
+    with h5py.File(path, 'r') as file:
+        assert sorted(file.keys()) == ['decay_{}.txt'.format(num) for num in range(3)]
+
+    simulations._exp_data_cache.clear()
+    spy = mocker.spy(simulations, '_read_exp_data')
+    for num in range(3):
+        compiled_data = simulations.DynamicsSolution._load_exp_data('decay_{}.txt'.format(num),
+                                                                    'test_lattice')
+        assert np.array_equal(compiled_data, data[num])
+    assert spy.call_count == 0
+
+    # a different filter window or a changed file are read again
+    simulations.DynamicsSolution._load_exp_data('decay_0.txt', 'test_lattice', filter_window=11)
+    os.utime(exp_data_folder / 'decay_1.txt', ns=(0, 0))
+    simulations.DynamicsSolution._load_exp_data('decay_1.txt', 'test_lattice')
+    assert spy.call_count == 2
+
+    # the compiled data can be used without the text files
+    os.remove(exp_data_folder / 'decay_2.txt')
+    assert np.array_equal(simulations.DynamicsSolution._load_exp_data('decay_2.txt', 'test_lattice'),
+                          data[2])
+
+def test_compile_exp_data_no_folder(exp_data_folder):
+    '''Test that compiling the data of a lattice without a folder fails'''
+    with pytest.raises(FileNotFoundError):
+        simulations.compile_exp_data('wrong_lattice')
+
 def test_sim_no_plot(setup_cte_sim):
     '''Test that no plot works'''
     setup_cte_sim['no_plot'] = True
@@ -280,6 +688,72 @@ def test_sim_power_dep(setup_cte_sim, mocker, average, excitation_name):
 
     plotter.plt.close('all')
 
+@pytest.mark.parametrize('jacobian', ['dense', 'sparse'])
+def test_sim_dyn_profile(setup_cte_sim, jacobian):
+    '''Test that the time of each phase and the solver statistics are recorded and saved'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    setup_cte_sim['simulation_params']['jacobian'] = jacobian
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution = sim.simulate_dynamics()
+
+    profile = solution.profile
+    assert set(profile.phases) == {'lattice', 'abs_decay_matrices', 'ET_matrices',
+                                   'pulse', 'relaxation', 'postprocessing'}
+    assert sum(profile.phases.values()) <= solution.time
+    for stat in ['steps', 'rhs_calls', 'jac_calls', 'lu_decompositions']:
+        assert profile.solver_stats[stat] > 0
+    assert profile.peak_rss > 0
+
+    with temp_bin_filename() as filename:
+        solution.save(filename)
+        solution_hdf5 = simulations.DynamicsSolution.load(filename)
+    assert solution_hdf5.profile == profile
+    assert solution_hdf5.time == solution.time
+
+def test_sim_power_dep_profile(setup_cte_sim):
+    '''Test that the profile of the power dependence includes those of all solutions'''
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    solution = sim.simulate_power_dependence(np.logspace(1, 3, 3), jobs=1)
+
+    # the equations are setup once for all power densities
+    profile = solution.profile
+    assert 'lattice' in profile.phases
+    assert 'lattice' not in solution[0].profile.phases
+    for name in solution[0].profile.phases:
+        assert profile.phases[name] == pytest.approx(sum(sol.profile.phases[name]
+                                                         for sol in solution))
+    for name in solution[0].profile.solver_stats:
+        assert profile.solver_stats[name] == sum(sol.profile.solver_stats[name]
+                                                 for sol in solution)
+
+    with temp_bin_filename() as filename:
+        solution.save(filename)
+        solution_hdf5 = simulations.PowerDependenceSolution.load(filename)
+    assert solution_hdf5.profile == profile
+    assert solution_hdf5[0].profile == solution[0].profile
+
+@pytest.mark.parametrize('average', [True, False])
+@pytest.mark.parametrize('excitation_name', ['NIR_800', 'Vis_473'])
+def test_sim_power_dep_jobs(setup_cte_sim, average, excitation_name):
+    '''Test that the parallel power dependence gives the same result as the serial one'''
+    for exc_name, exc_list in setup_cte_sim.excitations.items():
+        for exc in exc_list:
+            exc.active = exc_name == excitation_name
+
+    test_filename = os.path.join(test_folder_path, 'data_2S_2A.hdf5')
+    sim = simulations.Simulations(setup_cte_sim, full_path=test_filename)
+    power_dens_list = np.logspace(1, 3, 3)
+    solution_serial = sim.simulate_power_dependence(power_dens_list, average=average, jobs=1)
+    solution_parallel = sim.simulate_power_dependence(power_dens_list, average=average, jobs=2)
+
+    assert len(solution_serial) == len(solution_parallel) == len(power_dens_list)
+    for sol_serial, sol_parallel, power_dens in zip(solution_serial, solution_parallel,
+                                                    power_dens_list):
+        assert sol_parallel.power_dens == power_dens
+        assert np.allclose(sol_serial.steady_state_populations,
+                           sol_parallel.steady_state_populations)
+
 def test_sim_power_dep_save_txt(setup_cte_sim, mocker):
     '''Test that the power dep solution is saved as text correctly'''
     with temp_bin_filename() as temp_filename:
@@ -581,6 +1055,23 @@ def test_sim_sample_dynamics(setup_cte_sim, mocker, N_samples):
         assert solution
         assert mocked.call_count == 2*N_samples
 
+def test_sim_sample_dynamics_parallel(setup_cte_sim):
+    '''Test that sampling in parallel gives the same result as in serial for the same seed'''
+    setup_cte_sim['lattice']['S_conc'] = 0
+    setup_cte_sim['lattice']['N_uc'] = 8
+    setup_cte_sim['lattice']['A_conc'] = 2.0
+
+    with temp_bin_filename() as temp_filename:
+        sim = simulations.Simulations(setup_cte_sim, full_path=temp_filename)
+        serial_sol = sim.sample_simulation(sim.simulate_dynamics, N_samples=3, jobs=1, seed=42)
+        parallel_sol = sim.sample_simulation(sim.simulate_dynamics, N_samples=3, jobs=2, seed=42)
+        other_sol = sim.sample_simulation(sim.simulate_dynamics, N_samples=3, jobs=1, seed=7)
+
+    assert np.allclose(serial_sol.list_avg_data_ofs, parallel_sol.list_avg_data_ofs)
+    assert np.allclose(serial_sol.errors, parallel_sol.errors)
+    assert np.isclose(serial_sol.total_error, parallel_sol.total_error)
+    assert not np.allclose(serial_sol.list_avg_data_ofs, other_sol.list_avg_data_ofs)
+
 @pytest.mark.parametrize('N_samples', [1, 2, 10])
 def test_sim_sample_conc_dynamics(setup_cte_sim, mocker, N_samples):
     '''Test that sampling the dynamics works'''
@@ -10,6 +10,7 @@ import pytest
 
 from simetuc.util import IonType, Transition, DecayTransition, Excitation, EneryTransferProcess
 from simetuc.util import log_exceptions_warnings
+from simetuc.util import Profile, collect_profile, profile_phase, add_solver_stats, profiled
 
 
 def test_transition():
@@ -101,6 +102,10 @@ def test_ET_process():
     et4 = EneryTransferProcess([t1, t2], mult=8, strength=strength, strength_avg=strength_avg)
     assert et4.strength_avg == strength_avg
 
+    # without an average value it follows the strength
+    et1.value = 2*strength
+    assert et1.strength_avg == 2*strength
+
 
 def test_log_exceptions_warnings_nothing():
     '''Tests the logging of exceptions and warnings'''
@@ -138,3 +143,50 @@ def test_log_exceptions_warnings_exception(caplog):
     assert len(caplog.records) == 1
     assert caplog.records[0].levelname == 'ERROR'
     assert 'division by zero' in caplog.text
+
+def test_profile():
+    '''Tests recording, merging and serializing profiles'''
+    profile = Profile()
+    assert not profile
+    with profile_phase('nothing'):  # no active profile
+        add_solver_stats({'steps': 1})
+    assert not profile
+
+    inner_profile = Profile()
+    with collect_profile(profile):
+        with profile_phase('setup'):
+            pass
+        with collect_profile(inner_profile):
+            with profile_phase('pulse'):
+                add_solver_stats({'steps': 10, 'rhs_calls': 20})
+            add_solver_stats({'steps': 5})
+        with profile_phase('setup'):
+            pass
+    assert list(profile.phases) == ['setup']
+    assert not profile.solver_stats
+    assert profile.peak_rss > 0
+    assert list(inner_profile.phases) == ['pulse']
+    assert inner_profile.solver_stats == {'steps': 15, 'rhs_calls': 20}
+
+    total_profile = Profile.merged([profile, inner_profile, inner_profile])
+    assert total_profile.phases['setup'] == profile.phases['setup']
+    assert total_profile.phases['pulse'] == 2*inner_profile.phases['pulse']
+    assert total_profile.solver_stats == {'steps': 30, 'rhs_calls': 40}
+    assert total_profile.peak_rss == max(profile.peak_rss, inner_profile.peak_rss)
+    assert Profile.from_attrs(total_profile.to_attrs()) == total_profile
+    assert 'pulse' in str(total_profile) and 'rhs_calls' in str(total_profile)
+
+def test_profiled():
+    '''Tests that the profile is added to the solution'''
+    class Solution():
+        def __init__(self):
+            self.profile = Profile()
+
+    @profiled
+    def simulate():
+        with profile_phase('relaxation'):
+            add_solver_stats({'jac_calls': 3})
+        return Solution()
+    solution = simulate()
+    assert list(solution.profile.phases) == ['relaxation']
+    assert solution.profile.solver_stats == {'jac_calls': 3}
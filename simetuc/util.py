@@ -5,7 +5,8 @@ Created on Wed Nov 23 16:45:32 2016
 @author: Pedro
 """
 
-#import sys
+import sys
+import time
 import tempfile
 from contextlib import contextmanager
 import os
@@ -17,7 +18,13 @@ from functools import wraps
 import numpy as np
 
 from enum import Enum
-from typing import Generator, Sequence, Callable, Any, Tuple, Dict, List, Union, Optional
+from typing import (Generator, Sequence, Callable, Any, Tuple, Dict, List, Union, Optional,
+                    Iterable)
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # not available on Windows
 
 
 # http://stackoverflow.com/a/11892712
@@ -274,7 +281,7 @@ class EneryTransferProcess():
 #        '''Hash only the transitions and multipolarity b/c these don't change'''
 #        return hash((self.transitions, self.mult))
 
-    @cached_property
+    @property
     def strength_avg(self) -> float:
         '''Return the strength for average rate eqs. If it wasn't given when creating this ET
         process, it returns the normal strength.'''
@@ -283,6 +290,16 @@ class EneryTransferProcess():
         else:
             return self.strength
 
+    @strength_avg.setter
+    def strength_avg(self, val: float) -> None:
+        self._strength_avg = val
+
+    @property
+    def has_strength_avg(self) -> bool:
+        '''True if this ET process has a strength for the average rate eqs. different
+        from the normal strength.'''
+        return self._strength_avg is not None
+
     @property
     def value(self) -> float:
         return self.strength
@@ -391,6 +408,154 @@ class ConfigWarning(UserWarning):
     pass
 
 
+def get_peak_rss() -> int:
+    '''Peak resident set size of this process in bytes (0 if it's not available).'''
+    if resource is None:  # pragma: no cover
+        return 0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return int(peak_rss if sys.platform == 'darwin' else peak_rss*1024)
+
+
+class Profile():
+    '''Wall time of each phase of a simulation, statistics of the ode solver
+        and peak memory of the process.'''
+    def __init__(self) -> None:
+        # time (s) of each phase, in the order they first ran
+        self.phases = {}  # type: Dict[str, float]
+        # number of steps, rhs and jacobian evaluations, etc of the ode solver
+        self.solver_stats = {}  # type: Dict[str, int]
+        # peak resident set size in bytes
+        self.peak_rss = 0
+
+    def __bool__(self) -> bool:
+        '''Instance is True if something has been recorded.'''
+        return bool(self.phases or self.solver_stats or self.peak_rss)
+
+    def __eq__(self, other: object) -> bool:
+        '''Two profiles are equal if all their values are equal.'''
+        if not isinstance(other, Profile):
+            return NotImplemented
+        return (self.phases == other.phases and self.solver_stats == other.solver_stats and
+                self.peak_rss == other.peak_rss)
+
+    def __repr__(self) -> str:
+        '''Representation of a profile.'''
+        return '{}(phases={}, solver_stats={}, peak_rss={})'.format(self.__class__.__name__,
+                                                                   self.phases,
+                                                                   self.solver_stats,
+                                                                   self.peak_rss)
+
+    def __str__(self) -> str:
+        '''Table with the time of each phase, the solver statistics and peak memory.'''
+        lines = ['Phase                          Time (s)']
+        for name, phase_time in self.phases.items():
+            lines.append('{:<26} {:>12.4f}'.format(name, phase_time))
+        lines.append('{:<26} {:>12.4f}'.format('total', sum(self.phases.values())))
+        if self.solver_stats:
+            lines.append('ODE solver statistics:')
+            for name, value in self.solver_stats.items():
+                lines.append('{:<26} {:>12d}'.format(name, value))
+        lines.append('{:<26} {:>9.1f} MB'.format('peak RSS', self.peak_rss/1e6))
+        return '\n'.join(lines)
+
+    def add_time(self, name: str, phase_time: float) -> None:
+        '''Adds phase_time to the time of the phase name.'''
+        self.phases[name] = self.phases.get(name, 0.0) + phase_time
+
+    def add_solver_stats(self, stats: Dict[str, int]) -> None:
+        '''Adds the statistics of an ode solution.'''
+        for name, value in stats.items():
+            self.solver_stats[name] = self.solver_stats.get(name, 0) + int(value)
+
+    def update_peak_rss(self) -> None:
+        '''Records the current peak memory of the process.'''
+        self.peak_rss = max(self.peak_rss, get_peak_rss())
+
+    def merge(self, other: 'Profile') -> None:
+        '''Adds the times and statistics of other, the peak memory is the maximum of both.'''
+        for name, phase_time in other.phases.items():
+            self.add_time(name, phase_time)
+        self.add_solver_stats(other.solver_stats)
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+
+    @classmethod
+    def merged(cls, profiles: Iterable['Profile']) -> 'Profile':
+        '''Returns a new profile with all profiles merged.'''
+        total_profile = cls()
+        for profile in profiles:
+            total_profile.merge(profile)
+        return total_profile
+
+    def to_attrs(self) -> Dict[str, Union[float, int]]:
+        '''Flat dictionary of values, suitable as HDF5 attributes.'''
+        attrs = {'profile_peak_rss': self.peak_rss}  # type: Dict[str, Union[float, int]]
+        attrs.update(('profile_time_' + name, phase_time)
+                     for name, phase_time in self.phases.items())
+        attrs.update(('profile_solver_' + name, value)
+                     for name, value in self.solver_stats.items())
+        return attrs
+
+    @classmethod
+    def from_attrs(cls, attrs: Any) -> 'Profile':
+        '''Creates a profile from the attributes written with to_attrs.'''
+        profile = cls()
+        for key, value in attrs.items():
+            if key == 'profile_peak_rss':
+                profile.peak_rss = int(value)
+            elif key.startswith('profile_time_'):
+                profile.phases[key[len('profile_time_'):]] = float(value)
+            elif key.startswith('profile_solver_'):
+                profile.solver_stats[key[len('profile_solver_'):]] = int(value)
+        return profile
+
+
+# profiles that record the phases that are running, the last one is the current one
+_active_profiles = []  # type: List[Profile]
+
+
+@contextmanager
+def collect_profile(profile: Profile) -> Generator:
+    '''The phases and solver statistics recorded inside the context are added to profile,
+        unless a nested collect_profile is active.'''
+    _active_profiles.append(profile)
+    try:
+        yield profile
+    finally:
+        _active_profiles.pop()
+        profile.update_peak_rss()
+
+
+@contextmanager
+def profile_phase(name: str) -> Generator:
+    '''Adds the wall time of the context to the phase name of the current profile, if any.'''
+    start_time = time.perf_counter()
+    try:
+        yield None
+    finally:
+        if _active_profiles:
+            _active_profiles[-1].add_time(name, time.perf_counter() - start_time)
+
+
+def add_solver_stats(stats: Dict[str, int]) -> None:
+    '''Adds the statistics of an ode solution to the current profile, if any.'''
+    if _active_profiles:
+        _active_profiles[-1].add_solver_stats(stats)
+
+
+def profiled(function: Callable) -> Callable:
+    '''Decorator that collects the profile of a simulation function
+        and adds it to the profile of the solution it returns.'''
+    @wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        profile = Profile()
+        with collect_profile(profile):
+            solution = function(*args, **kwargs)
+        solution.profile.merge(profile)
+        return solution
+    return wrapper
+
+
 def save_file_full_name(lattice: dict, prefix: str = '') -> str:  # pragma: no cover
     '''Return the full name to save a file (without extention or prefix).'''
     path = os.path.join('results', lattice['name'])